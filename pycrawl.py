@@ -33,16 +33,12 @@
 # * some issues with GMT and non GMT times need to be ironed out
 #
 # TO DO LIST:
-# * add filter by domain name
-# * add filter by applying regular expressions to the URLs
-# * have Crawler obey robots.txt (with an option to disable this feature)
 # * possibly divide code into submodules if it grows too much
 # * documentation! as soon as code begins to be more or less stable
 # * find a name for the project, it's so lame not to have one :D
 #
 # FUTURE WORK:
 # * add support for libcurl
-# * replace anydbm with sqlite, it may optimize speed (or it may not!)
 #
 #-----------------------------------------------------------------------------#
 
@@ -57,6 +53,7 @@ __all__ = [
     
     # Simple downloader
     'Downloader',
+    'AsyncDownloader',
     
     # Web crawler
     'Crawler',
@@ -67,14 +64,31 @@ __all__ = [
     # Cookies file
     'Cookies',
     
+    # robots.txt file parser
+    'RobotsRules',
+    
+    # Crawl frontier
+    'Frontier',
+    'DiskFrontier',
+    'ShardedFrontier',
+    'ShardRing',
+    'SeenSet',
+    
     # Hooks for the downloader
     'Hook',             # Base hook (default, does nothing)
     'DomainFilterHook', # Filter URLs by domain
     'RegexpFilterHook', # Filter URLs using regular expressions
     'HistoryHook',      # History file support
+    'RobotsHook',       # Obey robots.txt files
+    'MetricsHook',      # Crawl performance metrics
+    
+    # Metrics reports
+    'MetricsExporter',
     
     # HTTP resource
     'Resource',
+    'Validators',
+    'Timings',
     ]
 
 # system and shell interaction
@@ -83,6 +97,33 @@ import sys
 import errno
 import shutil
 import posixpath
+import glob
+import threading
+import itertools
+import collections
+import Queue
+import optparse
+import multiprocessing
+import BaseHTTPServer
+
+# low level file access
+import mmap
+import tempfile
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+try:
+    import ctypes
+    import ctypes.util
+except ImportError:
+    ctypes = None
+
+# data structures and hashing
+import array
+import struct
+import bisect
+import hashlib
 
 # string manipulation
 import re
@@ -90,10 +131,8 @@ try:
     import cStringIO as StringIO
 except ImportError:
     import StringIO
-try:
-    import BeautifulSoup
-except ImportError:
-    pass
+import HTMLParser
+import htmlentitydefs
 
 # time and date manipulation
 import time
@@ -101,13 +140,29 @@ import rfc822
 import calendar
 
 # HTTP protocol support
+import socket
+import asyncore
 import httplib
 import urllib2
 import urlparse
 import cookielib
 
+# HTTP compression support
+import zlib
+try:
+    import brotli
+    
+    # Only if the output can be capped, see Downloader._ContentDecoder
+    if not hasattr(getattr(brotli, 'Decompressor', None),
+                   'can_accept_more_data'):
+        brotli = None
+except ImportError:
+    brotli = None
+
 # persistency
+import json
 import anydbm
+import sqlite3
 try:
     import cPickle as pickle
 except ImportError:
@@ -147,9 +202,49 @@ class Resource(object):
     
     @type headers: str
     @ivar headers: HTTP headers received from the server (see L{parse_headers})
+    
+    @type digest: str
+    @ivar digest: SHA-1 hash of the resource data in hexadecimal,
+        or C{None} if unknown
+    
+    @type size: int
+    @ivar size: Size of the local file, or C{None} if unknown
+    
+    @type encoded_size: int
+    @ivar encoded_size: Size of the response body as sent by the server,
+        before removing any C{Content-Encoding}, or C{None} if unknown
+    
+    @type encoding: str
+    @ivar encoding: C{Content-Encoding} of the data in the local file,
+        or C{None} if the data was decoded before saving it
+    
+    @type timings: L{Timings}
+    @ivar timings: Time spent on each stage of the download, or C{None}.
+        It's not saved in the history file, nor pickled.
+    
+    Resources are pickled in the compact binary format of L{pack}.
+    Pickles made by older versions can still be loaded.
     """
     
-    def __init__(self, timestamp, url, location, datafile, referer, headers):
+    __slots__ = ('timestamp', 'url', 'location', 'datafile', 'referer',
+                 '_headers', '_parsed', 'digest', 'size', 'encoded_size',
+                 'encoding', 'timings')
+    
+    # Attributes saved by pack() and unpickled from older versions,
+    # the ones not known by older versions come last
+    _fields = ('timestamp', 'url', 'location', 'datafile', 'referer',
+               'headers', 'digest', 'size', 'encoded_size', 'encoding')
+    
+    # Binary format used by pack(): a bitmask of the fields that are not
+    # None, the numbers (with a bit telling if the timestamp is a float),
+    # and then the lengths of the strings, which follow in order
+    _pack_header  = struct.Struct('!HdqqIIIIIII')
+    _pack_strings = ('url', 'location', 'datafile', 'referer', 'headers',
+                     'digest', 'encoding')
+    _float_timestamp = 0x8000
+    
+    def __init__(self, timestamp, url, location, datafile, referer, headers,
+                 size=None, encoded_size=None, encoding=None, digest=None):
         """
         @type timestamp: int
         @ivar timestamp: Last modification timestamp, as a UNIX epoch
@@ -168,26 +263,327 @@ class Resource(object):
         
         @type headers: str
         @ivar headers: HTTP headers received from the server (see L{parse_headers})
+        
+        @type size: int
+        @ivar size: Optional, size of the local file
+        
+        @type encoded_size: int
+        @ivar encoded_size: Optional, size of the response body as sent by the
+            server, before removing any C{Content-Encoding}
+        
+        @type encoding: str
+        @ivar encoding: Optional, C{Content-Encoding} of the data in the local
+            file, if it was saved without decoding it
+        
+        @type digest: str
+        @ivar digest: Optional, SHA-1 hash of the resource data in hexadecimal
         """
-        self.timestamp  = timestamp
-        self.url        = url
-        self.location   = location
-        self.datafile   = datafile
-        self.referer    = referer
-        self.headers    = headers
-
+        self.timestamp    = timestamp
+        self.url          = url
+        self.location     = location
+        self.datafile     = datafile
+        self.referer      = referer
+        self.headers      = headers
+        self.digest       = digest
+        self.size         = size
+        self.encoded_size = encoded_size
+        self.encoding     = encoding
+        self.timings      = None
+    
+    @property
+    def headers(self):
+        return self._headers
+    
+    @headers.setter
+    def headers(self, headers):
+        self._headers = headers
+        self._parsed  = None
+    
     def parse_headers(self):
         """
+        @see: L{get_header}
+        
         @rtype: httplib.HTTPMessage
         @return: An HTTPMessage with the request headers.
         """
-        return httplib.HTTPMessage(StringIO.StringIO(self.headers))
+        return httplib.HTTPMessage(StringIO.StringIO(self._headers))
+    
+    def get_header(self, name, default=None):
+        """
+        Get the value of a header. The headers are parsed the first time this
+        method is called and kept in a dictionary, which is much faster and
+        smaller than calling L{parse_headers} every time.
+        
+        @type  name: str
+        @param name: Header name, case insensitive.
+        
+        @type  default: str
+        @param default: Value to return if the header is missing.
+        
+        @rtype:  str
+        @return: Header value, or C{default} if the header is missing.
+            Repeated headers are joined with commas.
+        """
+        parsed = self._parsed
+        if parsed is None:
+            parsed = self._parse_headers(self._headers)
+            self._parsed = parsed
+        return parsed.get(name.lower(), default)
+    
+    # Parse the headers into a dictionary of lowercase names, interned since
+    # they repeat across all resources. Same results as HTTPMessage.
+    @staticmethod
+    def _parse_headers(headers):
+        parsed = {}
+        last = None
+        for line in headers.splitlines():
+            if line[:1] in (' ', '\t'):
+                if last is not None:
+                    parsed[last] = '%s\n %s' % (parsed[last], line.strip())
+                continue
+            if not line:
+                break
+            name, sep, value = line.partition(':')
+            if not sep:
+                last = None
+                continue
+            last = intern(name.lower())
+            value = value.strip()
+            if last in parsed:
+                value = '%s, %s' % (parsed[last], value)
+            parsed[last] = value
+        return parsed
+    
+    def pack(self):
+        """
+        @rtype:  str
+        @return: The resource in a compact binary format, see L{unpack}.
+            The L{timings} are not included.
+        """
+        mask = 0
+        bit = 1
+        for name in self._fields:
+            if getattr(self, name) is not None:
+                mask |= bit
+            bit <<= 1
+        timestamp = self.timestamp
+        if isinstance(timestamp, float):
+            mask |= self._float_timestamp
+        strings = []
+        for name in self._pack_strings:
+            value = getattr(self, name)
+            if value is None:
+                value = ''
+            elif isinstance(value, unicode):
+                value = value.encode('utf-8')
+            strings.append(value)
+        header = self._pack_header.pack(mask, timestamp or 0,
+                                        self.size or 0,
+                                        self.encoded_size or 0,
+                                        *[len(value) for value in strings])
+        strings.insert(0, header)
+        return ''.join(strings)
+    
+    @classmethod
+    def unpack(cls, data):
+        """
+        @type  data: str
+        @param data: Resource in the binary format returned by L{pack}.
+        
+        @rtype:  L{Resource}
+        @return: The resource.
+        
+        @raise ValueError: The data is not a packed resource.
+        """
+        self = cls.__new__(cls)
+        self._unpack(data)
+        return self
+    
+    # Load the attributes from the output of pack()
+    def _unpack(self, data):
+        header = self._pack_header
+        try:
+            values = header.unpack_from(data)
+        except struct.error, e:
+            raise ValueError("Bad packed resource: %s" % e)
+        strings = []
+        offset = header.size
+        for length in values[4:]:
+            end = offset + length
+            strings.append(data[offset:end])
+            offset = end
+        if offset != len(data):
+            raise ValueError("Bad packed resource: wrong length")
+        url, location, datafile, referer, headers, digest, encoding = strings
+        mask, timestamp, size, encoded_size = values[:4]
+        if not mask & self._float_timestamp:
+            timestamp = int(timestamp)
+        self.timestamp    = timestamp    if mask & 0x001 else None
+        self.url          = url          if mask & 0x002 else None
+        self.location     = location     if mask & 0x004 else None
+        self.datafile     = datafile     if mask & 0x008 else None
+        self.referer      = referer      if mask & 0x010 else None
+        self._headers     = headers      if mask & 0x020 else None
+        self._parsed      = None
+        self.digest       = digest       if mask & 0x040 else None
+        self.size         = size         if mask & 0x080 else None
+        self.encoded_size = encoded_size if mask & 0x100 else None
+        self.encoding     = intern(encoding) if mask & 0x200 else None
+        self.timings      = None
+    
+    def __reduce__(self):
+        return (self.__class__, (None,) * 6, self.pack())
+    
+    def __setstate__(self, state):
+        
+        # Pickled by this version
+        if isinstance(state, str):
+            self._unpack(state)
+            return
+        
+        # Pickled by older versions, where the attributes were in __dict__
+        # and the newer ones may be missing
+        for name in self._fields:
+            setattr(self, name, state.get(name))
+        self.timings = None
     
     def __repr__(self):
         ts = time.asctime(time.gmtime(self.timestamp))
         return '[%s] %s\r\n%s' % (ts, self.location, self.headers)
 
 #-----------------------------------------------------------------------------#
+
+class Validators(collections.namedtuple('Validators', (
+        'url', 'location', 'datafile', 'etag', 'last_modified', 'length',
+        'digest', 'content_type', 'encoding'))):
+    """
+    Cache validators of the last download of a URL, used to make
+    conditional requests.
+    
+    @type url: str
+    @ivar url: Canonical URL originally requested
+    
+    @type location: str
+    @ivar location: URL of the resource (after following redirections)
+    
+    @type datafile: str
+    @ivar datafile: Full pathname to the local file with the resource data
+    
+    @type etag: str
+    @ivar etag: Value of the C{ETag} header, or C{None}
+    
+    @type last_modified: str
+    @ivar last_modified: Value of the C{Last-Modified} header, or C{None}
+    
+    @type length: int
+    @ivar length: Value of the C{Content-Length} header, or C{None}
+    
+    @type digest: str
+    @ivar digest: SHA-1 hash of the data in hexadecimal, or C{None}
+    
+    @type content_type: str
+    @ivar content_type: Value of the C{Content-Type} header, or C{None}
+    
+    @type encoding: str
+    @ivar encoding: C{Content-Encoding} of the data in the local file,
+        or C{None} if it was decoded
+    """
+    
+    __slots__ = ()
+    
+    @classmethod
+    def from_resource(cls, resource):
+        """
+        @type  resource: L{Resource}
+        @param resource: Downloaded resource.
+        
+        @rtype:  L{Validators}
+        @return: Validators taken from the resource headers.
+        """
+        get_header = resource.get_header
+        try:
+            length = int(get_header('Content-Length'))
+        except (TypeError, ValueError):
+            length = None
+        return cls(resource.url, resource.location, resource.datafile,
+                   get_header('ETag'), get_header('Last-Modified'), length,
+                   resource.digest, get_header('Content-Type'),
+                   resource.encoding)
+
+#-----------------------------------------------------------------------------#
+
+class Timings(object):
+    """
+    Time spent on each stage of a download, in seconds.
+    
+    The downloader keeps it in the C{timings} attribute of the request given
+    to the hooks, and of the L{Resource} it returns. Stages that didn't take
+    place are C{None}, for example the name lookup and the connection when a
+    persistent connection was reused. When the download was redirected, the
+    stages of every request are added up.
+    
+    @type start: float
+    @ivar start: Time the request was sent, as a UNIX epoch.
+    
+    @type dns: float
+    @ivar dns: Host name lookup.
+    
+    @type connect: float
+    @ivar connect: TCP connection.
+    
+    @type ttfb: float
+    @ivar ttfb: Time to first byte: from sending the request until the
+        response headers arrive, without the lookup and connection.
+        For HTTPS it includes the TLS handshake.
+    
+    @type body: float
+    @ivar body: Reading the response body and writing it to disk.
+    """
+    
+    __slots__ = ('start', 'dns', 'connect', 'ttfb', 'body', '_mark')
+    
+    def __init__(self):
+        self.start   = None
+        self.dns     = None
+        self.connect = None
+        self.ttfb    = None
+        self.body    = None
+        self._mark   = None
+    
+    def add(self, stage, elapsed):
+        """
+        Add time to a stage.
+        
+        @type  stage: str
+        @param stage: Name of the stage: C{"dns"} or C{"connect"}.
+        
+        @type  elapsed: float
+        @param elapsed: Time in seconds.
+        """
+        setattr(self, stage, (getattr(self, stage) or 0.0) + elapsed)
+    
+    def begin(self):
+        """
+        Called when the request is about to be sent.
+        """
+        self.start = self._mark = time.time()
+    
+    def end_headers(self):
+        """
+        Called when the response headers arrive.
+        """
+        now = time.time()
+        self.ttfb = now - self.start - (self.dns or 0.0) - \
+                                       (self.connect or 0.0)
+        self._mark = now
+    
+    def end_body(self):
+        """
+        Called when the response body was saved.
+        """
+        self.body = time.time() - self._mark
+
+#-----------------------------------------------------------------------------#
     
 class Hook(object):
     """
@@ -282,15 +678,59 @@ class Hook(object):
         """
         return True
     
+    def handle_not_modified(self, dwn, req, url):
+        """
+        Called when the server answers C{"304 Not Modified"}.
+        
+        @type  dwn: L{Downloader}
+        @param dwn: Downloader that invoked this method.
+        
+        @type  req: urllib2.HTTPRequest
+        @param req: The HTTP request already sent.
+        
+        @type  url: str
+        @param url: The URL requested.
+        """
+    
+    def handle_error(self, dwn, url, error):
+        """
+        Called when a download fails. The exception is raised anyway
+        once all the hooks were called.
+        
+        @type  dwn: L{Downloader}
+        @param dwn: Downloader that invoked this method.
+        
+        @type  url: str
+        @param url: The URL requested.
+        
+        @type  error: Exception
+        @param error: The exception that made the download fail.
+        """
+    
+    def handle_targets(self, dwn, urls):
+        """
+        Called with a batch of URLs the crawler will download later, so the
+        hook can prepare for all of them at once. The hook may still be
+        called for each URL in any order, or not at all.
+        
+        @type  dwn: L{Downloader}
+        @param dwn: Downloader that invoked this method.
+        
+        @type  urls: list(str)
+        @param urls: URLs queued for download.
+        """
+    
     # Do not override!
     def __add__(self, other):
         chain = [self]
         if other is not None:
-            if not isinstance(other, Hook):
-                msg = "Can't chain a Hook with an object of type %r"
-                raise ValueError(msg % type(other))
             if isinstance(other, HookChain):
                 chain.extend(other._chain)
+            elif isinstance(other, Hook):
+                chain.append(other)
+            else:
+                msg = "Can't chain a Hook with an object of type %r"
+                raise ValueError(msg % type(other))
         return HookChain(chain)
     
     # Do not override!
@@ -333,18 +773,239 @@ class PrintHook(Hook):
 #-----------------------------------------------------------------------------#
 
 class DomainFilterHook(Hook):
+    """
+    Hook to filter URLs by domain name.
     
-    # TODO
+    Each domain in the lists matches itself and all of its subdomains, so
+    C{"example.com"} matches both C{"example.com"} and C{"www.example.com"}.
+    Domains in the deny list are always blocked. If the allow list is not
+    empty, only domains in it are let through.
     
-    pass
+    Domains are kept in hash sets, so looking up a host name costs one set
+    lookup per label regardless of how many domains are in the lists.
+    """
+    
+    def __init__(self, allow=None, deny=None):
+        """
+        @type  allow: list(str)
+        @param allow: Optional, domains to allow.
+        
+        @type  deny: list(str)
+        @param deny: Optional, domains to block.
+        """
+        self._allow = set()
+        self._deny  = set()
+        for domain in allow or ():
+            self.allow(domain)
+        for domain in deny or ():
+            self.deny(domain)
+    
+    # Normalize a domain name
+    @staticmethod
+    def _normalize(domain):
+        return domain.strip().strip('.').lower()
+    
+    def allow(self, domain):
+        """
+        Add a domain to the allow list.
+        
+        @type  domain: str
+        @param domain: Domain name.
+        """
+        self._allow.add( self._normalize(domain) )
+    
+    def deny(self, domain):
+        """
+        Add a domain to the deny list.
+        
+        @type  domain: str
+        @param domain: Domain name.
+        """
+        self._deny.add( self._normalize(domain) )
+    
+    # Find out if the host name or any of its parent domains is in the set
+    @staticmethod
+    def _lookup(domains, hostname):
+        if hostname in domains:
+            return True
+        index = hostname.find('.')
+        while index >= 0:
+            index = index + 1
+            if hostname[index:] in domains:
+                return True
+            index = hostname.find('.', index)
+        return False
+    
+    def is_allowed(self, url):
+        """
+        @type  url: str
+        @param url: URL to check.
+        
+        @rtype:  bool
+        @return: C{True} if the URL is allowed, C{False} otherwise.
+        """
+        hostname = (urlparse.urlsplit(url).hostname or '').rstrip('.')
+        if self._deny and self._lookup(self._deny, hostname):
+            return False
+        if self._allow:
+            return self._lookup(self._allow, hostname)
+        return True
+    
+    def filter_request(self, dwn, req, url):
+        return self.is_allowed(url)
+    
+    def filter_redirect(self, dwn, req, newurl):
+        return self.is_allowed(newurl)
 
 #-----------------------------------------------------------------------------#
 
 class RegexpFilterHook(Hook):
+    """
+    Hook to filter URLs using regular expressions.
     
-    # TODO
+    URLs matching any of the expressions in the deny list are always
+    blocked. If the allow list is not empty, only URLs matching at least one
+    of the expressions in it are let through. Expressions are searched
+    anywhere in the URL, use C{^} to anchor them to the beginning.
     
-    pass
+    Each list is compiled into as few alternations as possible the first
+    time it's used, so every URL is checked with a handful of calls to the
+    regular expression engine instead of one call per expression. Python
+    can't compile expressions with more than 99 groups, so a new
+    alternation is started whenever the groups of the expressions would go
+    over that limit, or when two of them define groups with the same name.
+    Expressions with inline flags such as C{(?i)} get an alternation of
+    their own, since the flags would apply to the whole alternation.
+    Expressions should not use numbered backreferences, since groups are
+    renumbered when combined.
+    """
+    
+    # Maximum number of groups in a single regular expression
+    _max_groups = 99
+    
+    def __init__(self, allow=None, deny=None, flags=0):
+        """
+        @type  allow: list(str)
+        @param allow: Optional, regular expressions of URLs to allow.
+        
+        @type  deny: list(str)
+        @param deny: Optional, regular expressions of URLs to block.
+        
+        @type  flags: int
+        @param flags: Optional, flags for C{re.compile}.
+        
+        @raise re.error: An expression is invalid or has too many groups.
+        """
+        self._flags = flags
+        self._lock  = threading.Lock()
+        self._allow = [self._check(x) for x in allow or ()]
+        self._deny  = [self._check(x) for x in deny or ()]
+        self._allow_re = None
+        self._deny_re  = None
+    
+    # Compile an expression on its own to fail early if it's not valid.
+    # Returns the expression with the number and names of its groups, and
+    # whether it sets inline flags.
+    def _check(self, pattern):
+        try:
+            compiled = re.compile(pattern, self._flags)
+        except AssertionError:      # raised by sre for too many groups
+            compiled = None
+        if compiled is None or compiled.groups > self._max_groups:
+            msg = "Too many groups in regular expression: %r"
+            raise re.error(msg % pattern)
+        inline = compiled.flags != re.compile('', self._flags).flags
+        return (pattern, compiled.groups, tuple(compiled.groupindex), inline)
+    
+    def allow(self, pattern):
+        """
+        Add a regular expression to the allow list.
+        
+        @type  pattern: str
+        @param pattern: Regular expression.
+        
+        @raise re.error: The expression is invalid or has too many groups.
+        """
+        checked = self._check(pattern)
+        with self._lock:
+            self._allow.append(checked)
+            self._allow_re = None
+    
+    def deny(self, pattern):
+        """
+        Add a regular expression to the deny list.
+        
+        @type  pattern: str
+        @param pattern: Regular expression.
+        
+        @raise re.error: The expression is invalid or has too many groups.
+        """
+        checked = self._check(pattern)
+        with self._lock:
+            self._deny.append(checked)
+            self._deny_re = None
+    
+    # Combine a list of checked regular expressions into as few as possible
+    def _combine(self, checked):
+        combined = []
+        chunk  = []
+        groups = 0
+        names  = set()
+        for pattern, count, group_names, inline in checked:
+            if inline:
+                combined.append(self._compile_chunk([pattern]))
+                continue
+            if chunk and (groups + count > self._max_groups or
+                          names.intersection(group_names)):
+                combined.append(self._compile_chunk(chunk))
+                chunk  = []
+                groups = 0
+                names  = set()
+            chunk.append(pattern)
+            groups = groups + count
+            names.update(group_names)
+        if chunk:
+            combined.append(self._compile_chunk(chunk))
+        return tuple(combined)
+    
+    # Compile a list of expressions into a single alternation
+    def _compile_chunk(self, patterns):
+        return re.compile('|'.join('(?:%s)' % x for x in patterns),
+                          self._flags)
+    
+    def is_allowed(self, url):
+        """
+        @type  url: str
+        @param url: URL to check.
+        
+        @rtype:  bool
+        @return: C{True} if the URL is allowed, C{False} otherwise.
+        """
+        allow_re = self._allow_re
+        deny_re  = self._deny_re
+        if allow_re is None or deny_re is None:
+            with self._lock:
+                if self._allow_re is None:
+                    self._allow_re = self._combine(self._allow)
+                if self._deny_re is None:
+                    self._deny_re = self._combine(self._deny)
+                allow_re = self._allow_re
+                deny_re  = self._deny_re
+        for compiled in deny_re:
+            if compiled.search(url) is not None:
+                return False
+        if allow_re:
+            for compiled in allow_re:
+                if compiled.search(url) is not None:
+                    return True
+            return False
+        return True
+    
+    def filter_request(self, dwn, req, url):
+        return self.is_allowed(url)
+    
+    def filter_redirect(self, dwn, req, newurl):
+        return self.is_allowed(newurl)
 
 #-----------------------------------------------------------------------------#
 
@@ -353,18 +1014,46 @@ class HookChain(object):
     Chain of L{Hook}s to be executed in order. Each callback method returns
     C{True} if and only if the equivalent method from each hook in the chain
     also returns C{True}.
+    
+    The callbacks for each phase are collected into tuples whenever the
+    chain changes, leaving out the hooks that don't override the L{Hook}
+    method for that phase, so running the chain doesn't allocate anything.
     """
     
+    # Callback method names, and the attributes to store their tuples in
+    _phases = (
+        ('filter_request',  '_on_request'),
+        ('filter_redirect', '_on_redirect'),
+        ('filter_response', '_on_response'),
+        ('filter_resource', '_on_resource'),
+        ('handle_not_modified', '_on_not_modified'),
+        ('handle_error',    '_on_error'),
+        ('handle_targets',  '_on_targets'),
+    )
+    
     def __init__(self, chain=None):
         """
         @type  chain: list(L{Hook})
-        @param chain: Hook chain.
+        @param chain: Hook chain. The list is copied.
             Defaults to an empty list, use L{append_hook} to add hooks to it.
         """
         if chain is None:
             chain = []
-        self._chain = chain
+        elif isinstance(chain, HookChain):
+            chain = chain._chain
+        self._chain = list(chain)
         self._validate_chain()
+        self._compile_chain()
+    
+    def __add__(self, other):
+        chain = HookChain(self._chain)
+        if other is not None:
+            if isinstance(other, HookChain):
+                for hook in other._chain:
+                    chain.append_hook(hook)
+            else:
+                chain.append_hook(other)
+        return chain
     
     # Make sure the hook derives from the Hook class
     def _validate_hook(self, hook):
@@ -372,7 +1061,10 @@ class HookChain(object):
                 hasattr(hook, 'filter_request') and
                 hasattr(hook, 'filter_redirect') and
                 hasattr(hook, 'filter_response') and
-                hasattr(hook, 'filter_resource')
+                hasattr(hook, 'filter_resource') and
+                hasattr(hook, 'handle_not_modified') and
+                hasattr(hook, 'handle_error') and
+                hasattr(hook, 'handle_targets')
             ):
             
             msg = "Expected a subclass of %r, got %r instead"
@@ -383,6 +1075,24 @@ class HookChain(object):
         for hook in self._chain:
             self._validate_hook(hook)
     
+    # Find out if the hook does something in the given phase
+    @staticmethod
+    def _is_overridden(hook, name):
+        if name in getattr(hook, '__dict__', ()):
+            return True
+        method = getattr(getattr(type(hook), name), 'im_func', None)
+        return method is not getattr(Hook, name).im_func
+    
+    # Build the tuples of callbacks for each phase
+    def _compile_chain(self):
+        for name, attr in self._phases:
+            callbacks = tuple(
+                getattr(hook, name)
+                for hook in self._chain
+                if self._is_overridden(hook, name)
+            )
+            setattr(self, attr, callbacks)
+    
     def append_hook(self, hook):
         """
         Add a hook to the end of the hook chain.
@@ -394,6 +1104,7 @@ class HookChain(object):
         """
         self._validate_hook(hook)
         self._chain.append(hook)
+        self._compile_chain()
     
     def prepend_hook(self, hook):
         """
@@ -405,7 +1116,8 @@ class HookChain(object):
         @param hook: Hook to add.
         """
         self._validate_hook(hook)
-        self._chain.append(hook)
+        self._chain.insert(0, hook)
+        self._compile_chain()
     
     def remove_hook(self, hook):
         """
@@ -419,33 +1131,43 @@ class HookChain(object):
         """
 ##        self._validate_hook(hook)
         self._chain.remove(hook)
-    
-    # not sure if the following code would ever work outside cPython...
-    # but it'd be easy to "fix" with some copy&paste from _run_callbacks()
-    
-    def _run_callbacks(self, callbacks, arguments):
-        allowed = True
-        for method in callbacks:
-            allowed = allowed and method(*arguments)
-            if not allowed:
-                break
-        return allowed
+        self._compile_chain()
     
     def _filter_request(self, dwn, req, url):
-        callbacks = [hook.filter_request for hook in self._chain]
-        return self._run_callbacks(callbacks, (dwn, req, url))
+        for method in self._on_request:
+            if not method(dwn, req, url):
+                return False
+        return True
     
     def _filter_redirect(self, dwn, req, newurl):
-        callbacks = [hook.filter_redirect for hook in self._chain]
-        return self._run_callbacks(callbacks, (dwn, req, newurl))
+        for method in self._on_redirect:
+            if not method(dwn, req, newurl):
+                return False
+        return True
     
     def _filter_response(self, dwn, fsrc, filename):
-        callbacks = [hook.filter_response for hook in self._chain]
-        return self._run_callbacks(callbacks, (dwn, fsrc, filename))
+        for method in self._on_response:
+            if not method(dwn, fsrc, filename):
+                return False
+        return True
     
     def _filter_resource(self, dwn, resource):
-        callbacks = [hook.filter_resource for hook in self._chain]
-        return self._run_callbacks(callbacks, (dwn, resource))
+        for method in self._on_resource:
+            if not method(dwn, resource):
+                return False
+        return True
+    
+    def _handle_not_modified(self, dwn, req, url):
+        for method in self._on_not_modified:
+            method(dwn, req, url)
+    
+    def _handle_error(self, dwn, url, error):
+        for method in self._on_error:
+            method(dwn, url, error)
+    
+    def _handle_targets(self, dwn, urls):
+        for method in self._on_targets:
+            method(dwn, urls)
 
 #-----------------------------------------------------------------------------#
 
@@ -507,14 +1229,30 @@ class FileUtils(object):
             if e.errno != errno.EEXIST:
                 raise
     
-    # Download method for ON_DUPLICATE_OVERWRITE
+    # Copy data between file objects, with a FileCopier if given
     @staticmethod
-    def copy_overwriting(fsrc, filename):
+    def copy_data(fsrc, fdst, copier=None, length=None):
+        if copier is None:
+            shutil.copyfileobj(fsrc, fdst)
+        else:
+            copier.copy(fsrc, fdst, length)
+    
+    # Download method for ON_DUPLICATE_OVERWRITE.
+    # Files with more than one hard link are unlinked first instead of being
+    # written in place, since the data is shared with the other links.
+    @classmethod
+    def copy_overwriting(self, fsrc, filename, copier=None, length=None):
+        try:
+            if os.lstat(filename).st_nlink > 1:
+                os.unlink(filename)
+        except OSError, e:
+            if e.errno != errno.ENOENT:
+                raise
         must_delete = False
         try:
             with open(filename, 'w+b') as fdst:
                 must_delete = True
-                shutil.copyfileobj(fsrc, fdst)
+                self.copy_data(fsrc, fdst, copier, length)
                 must_delete = False
         finally:
             if must_delete:
@@ -522,12 +1260,12 @@ class FileUtils(object):
     
     # Download method for ON_DUPLICATE_FAIL
     @classmethod
-    def copy_exclusive(self, fsrc, filename):
+    def copy_exclusive(self, fsrc, filename, copier=None, length=None):
         must_delete = False
         try:
             with self.create_file_exclusive(filename, silent=False) as fdst:
                 must_delete = True
-                shutil.copyfileobj(fsrc, fdst)
+                self.copy_data(fsrc, fdst, copier, length)
                 must_delete = False
         finally:
             if must_delete:
@@ -535,7 +1273,7 @@ class FileUtils(object):
     
     # Download method for ON_DUPLICATE_RENAME
     @classmethod
-    def copy_renaming(self, fsrc, path, name):
+    def copy_renaming(self, fsrc, path, name, copier=None, length=None):
         index = 0
         filename = os.path.join(path, name)
         name, ext = os.path.splitext(name)
@@ -549,7 +1287,7 @@ class FileUtils(object):
                 filename = os.path.join(path, new_name)
                 fdst = self.create_file_exclusive(filename, silent=True)
             must_delete = True
-            shutil.copyfileobj(fsrc, fdst)
+            self.copy_data(fsrc, fdst, copier, length)
             must_delete = False
         finally:
             if fdst:
@@ -558,15 +1296,133 @@ class FileUtils(object):
                 os.unlink(filename)
         return filename
     
-    # Create a file if and only if it didn't exist previously
-    @classmethod
-    def create_file_exclusive(self, filename, silent=True):
-        flags = os.O_WRONLY | os.O_CREAT | os.O_EXCL
+    # Move method for ON_DUPLICATE_OVERWRITE
+    @staticmethod
+    def move_overwriting(source, filename):
+        if os.name == 'nt' and os.path.exists(filename):
+            os.unlink(filename)
+        os.rename(source, filename)
+    
+    # Move method for ON_DUPLICATE_FAIL
+    @staticmethod
+    def move_exclusive(source, filename):
         try:
-            flags = flags | os.O_BINARY
+            os.link(source, filename)   # fails if the target exists
         except AttributeError:
             pass
-        fd = None
+        except OSError, e:
+            if e.errno == errno.EEXIST:
+                raise
+        else:
+            os.unlink(source)
+            return
+        
+        # No hard links on this platform or filesystem
+        if os.path.exists(filename):
+            raise OSError(errno.EEXIST, os.strerror(errno.EEXIST), filename)
+        os.rename(source, filename)
+    
+    # Move method for ON_DUPLICATE_RENAME
+    @classmethod
+    def move_renaming(self, source, path, name):
+        index = 0
+        filename = os.path.join(path, name)
+        name, ext = os.path.splitext(name)
+        while True:
+            try:
+                self.move_exclusive(source, filename)
+                return filename
+            except OSError, e:
+                if e.errno != errno.EEXIST:
+                    raise
+            index = index + 1
+            new_name = '%s (%d)%s' % (name, index, ext)
+            filename = os.path.join(path, new_name)
+    
+    # Take an advisory lock on a lock file next to the given file, held until
+    # the returned file object is closed. Shared locks allow other shared
+    # locks, exclusive ones don't. Does nothing without fcntl.
+    @staticmethod
+    def lock_file(filename, exclusive=True):
+        fd = open(filename + '.lock', 'a')
+        try:
+            if fcntl is not None:
+                if exclusive:
+                    fcntl.flock(fd.fileno(), fcntl.LOCK_EX)
+                else:
+                    fcntl.flock(fd.fileno(), fcntl.LOCK_SH)
+        except:
+            fd.close()
+            raise
+        return fd
+    
+    # Remove a file if it exists
+    @staticmethod
+    def remove_silently(filename):
+        try:
+            os.unlink(filename)
+        except OSError, e:
+            if e.errno != errno.ENOENT:
+                raise
+    
+    # ioctl request to clone the extents of a file (FICLONE on Linux)
+    _FICLONE = 0x40049409
+    
+    # Make a copy-on-write clone of a file, if the filesystem supports it.
+    # The target file must not exist. Returns False if it can't be done.
+    @classmethod
+    def clone_file(self, source, filename):
+        if fcntl is None or not sys.platform.startswith('linux'):
+            return False
+        with open(source, 'rb') as fsrc:
+            with self.create_file_exclusive(filename, silent=False) as fdst:
+                try:
+                    fcntl.ioctl(fdst.fileno(), self._FICLONE, fsrc.fileno())
+                    return True
+                except (IOError, OSError):
+                    pass
+        os.unlink(filename)
+        return False
+    
+    # Make the target file share the data of the source file, trying a
+    # copy-on-write clone first, then a hard link, then a plain copy.
+    # The target file must not exist.
+    @classmethod
+    def link_file(self, source, filename):
+        if self.clone_file(source, filename):
+            return
+        try:
+            os.link(source, filename)
+            return
+        except AttributeError:
+            pass
+        except OSError, e:
+            if e.errno not in (errno.EPERM, errno.EXDEV, errno.EMLINK,
+                               getattr(errno, 'ENOTSUP', errno.EPERM)):
+                raise
+        with open(source, 'rb') as fsrc:
+            self.copy_exclusive(fsrc, filename)
+    
+    # Calculate the SHA-1 hash of a file in hexadecimal
+    @staticmethod
+    def hash_file(filename, bufsize=1024*1024):
+        digest = hashlib.sha1()
+        with open(filename, 'rb') as fd:
+            data = fd.read(bufsize)
+            while data:
+                digest.update(data)
+                data = fd.read(bufsize)
+        return digest.hexdigest()
+    
+    # Create a file if and only if it didn't exist previously
+    @classmethod
+    def create_file_exclusive(self, filename, silent=True):
+        flags = os.O_WRONLY | os.O_CREAT | os.O_EXCL
+        try:
+            flags = flags | os.O_BINARY
+        except AttributeError:
+            pass
+        fd = None
         try:
             try:
                 fd = os.open(filename, flags, 0666)
@@ -659,6 +1515,279 @@ class FileUtils(object):
 
 #-----------------------------------------------------------------------------#
 
+class FileCopier(object):
+    """
+    Copies data from a file-like object into a file through a large buffer
+    that is allocated once per thread and reused.
+    
+    When the source supports C{readinto} the data is read straight into the
+    buffer, otherwise it's read in blocks of the buffer size. Writes go
+    directly to the file descriptor, bypassing the C{stdio} buffers.
+    
+    On Linux it can also:
+     - preallocate the disk space when the size is known, to reduce
+       fragmentation (using C{fallocate}, which unlike C{posix_fallocate}
+       fails instead of writing zeros on filesystems that don't support it),
+     - write with C{O_DIRECT} so the data doesn't go through the page cache
+       at all (aligned blocks only, the unaligned tail is written normally),
+     - start the writeback of each block as soon as it's written and then
+       drop it from the page cache (C{sync_file_range} and
+       C{posix_fadvise(POSIX_FADV_DONTNEED)}), so bulk mirroring doesn't
+       evict more useful data.
+    These are silently skipped where not supported.
+    """
+    
+    # O_DIRECT requires the buffer, file offset and size to be aligned
+    _alignment = 4096
+    
+    # Constants from the Linux headers
+    _POSIX_FADV_DONTNEED          = 4
+    _SYNC_FILE_RANGE_WAIT_BEFORE  = 1
+    _SYNC_FILE_RANGE_WRITE        = 2
+    _SYNC_FILE_RANGE_WAIT_AFTER   = 4
+    
+    # C library, loaded on first use
+    _libc = None
+    
+    def __init__(self, bufsize=1024*1024, preallocate=True, direct=False,
+                 dontneed=False):
+        """
+        @type  bufsize: int
+        @param bufsize: Buffer size in bytes.
+        
+        @type  preallocate: bool
+        @param preallocate: C{True} to preallocate disk space when the size
+            of the data is known.
+        
+        @type  direct: bool
+        @param direct: C{True} to use C{O_DIRECT} when possible.
+        
+        @type  dontneed: bool
+        @param dontneed: C{True} to drop written data from the page cache.
+        """
+        alignment = self._alignment
+        self.bufsize     = max(-(-bufsize // alignment), 1) * alignment
+        self.preallocate = preallocate
+        self.direct      = direct and fcntl is not None and \
+                                      hasattr(os, 'O_DIRECT')
+        self.dontneed    = dontneed
+        self._local      = threading.local()
+    
+    # Load the C library functions we need, if available
+    @classmethod
+    def _get_libc(cls):
+        if cls._libc is None:
+            libc = False
+            if ctypes is not None and sys.platform.startswith('linux'):
+                try:
+                    libc = ctypes.CDLL(ctypes.util.find_library('c'),
+                                       use_errno=True)
+                except OSError:
+                    libc = False
+            cls._libc = libc
+        return cls._libc
+    
+    # Call a C library function, returning False if it's not available.
+    # The arguments are given as (ctypes type, value) pairs.
+    @classmethod
+    def _call(cls, name, *argv):
+        libc = cls._get_libc()
+        if not libc:
+            return False
+        function = getattr(libc, name, None)
+        if function is None:
+            return False
+        return function(*[t(v) for t, v in argv]) == 0
+    
+    # Reserve disk space without changing the file contents
+    def _fallocate(self, fd, offset, size):
+        return self._call('fallocate64', (ctypes.c_int, fd), (ctypes.c_int, 0),
+                          (ctypes.c_int64, offset), (ctypes.c_int64, size))
+    
+    # Start or wait for the writeback of a range of the file
+    def _sync_range(self, fd, offset, size, flags):
+        return self._call('sync_file_range', (ctypes.c_int, fd),
+                          (ctypes.c_int64, offset), (ctypes.c_int64, size),
+                          (ctypes.c_uint, flags))
+    
+    # Give the kernel advice on how a range of the file will be used
+    def _fadvise(self, fd, offset, size, advice):
+        return self._call('posix_fadvise64', (ctypes.c_int, fd),
+                          (ctypes.c_int64, offset), (ctypes.c_int64, size),
+                          (ctypes.c_int, advice))
+    
+    # Get the buffer for this thread
+    def _get_buffer(self, direct):
+        local = self._local
+        if direct:
+            buf = getattr(local, 'mmap', None)
+            if buf is None:
+                buf = local.mmap = mmap.mmap(-1, self.bufsize) # page aligned
+        else:
+            buf = getattr(local, 'buffer', None)
+            if buf is None:
+                buf = local.buffer = bytearray(self.bufsize)
+        return buf
+    
+    # Turn O_DIRECT on or off for a file descriptor
+    @staticmethod
+    def _set_direct(fd, enable):
+        try:
+            flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+            if enable:
+                flags = flags | os.O_DIRECT
+            else:
+                flags = flags & ~os.O_DIRECT
+            fcntl.fcntl(fd, fcntl.F_SETFL, flags)
+        except (IOError, OSError):
+            return False
+        return True
+    
+    # Write the whole buffer, even if the OS takes it in several pieces
+    @staticmethod
+    def _write(fd, data, size):
+        written = os.write(fd, data)
+        while written < size:
+            written = written + os.write(fd, buffer(data, written))
+    
+    # Drop the given range of the file from the page cache, waiting for
+    # it to be written to disk first
+    def _drop(self, fd, offset, size):
+        if size > 0:
+            flags = self._SYNC_FILE_RANGE_WAIT_BEFORE | \
+                    self._SYNC_FILE_RANGE_WRITE       | \
+                    self._SYNC_FILE_RANGE_WAIT_AFTER
+            self._sync_range(fd, offset, size, flags)
+            self._fadvise(fd, offset, size, self._POSIX_FADV_DONTNEED)
+    
+    def copy(self, fsrc, fdst, length=None, exact=False, progress=None):
+        """
+        Copy data from the current position of the destination file.
+        
+        @type  fsrc: file
+        @param fsrc: File-like object to read from.
+        
+        @type  fdst: file
+        @param fdst: File object to write to.
+        
+        @type  length: int
+        @param length: Optional, expected number of bytes.
+            Used to preallocate disk space.
+        
+        @type  exact: bool
+        @param exact: C{True} to copy exactly C{length} bytes, raising an
+            exception if the data ends sooner. C{False} to copy until the
+            end of the data.
+        
+        @type  progress: callable
+        @param progress: Optional, called with the number of bytes written
+            after each write.
+        
+        @rtype:  int
+        @return: Number of bytes copied.
+        
+        @raise IOError: The data ended before C{length} bytes were read
+            (only when C{exact} is C{True}).
+        """
+        bufsize = self.bufsize
+        fdst.flush()
+        fd = fdst.fileno()
+        offset = fdst.tell()
+        
+        # Preallocate the disk space. If this makes the file grow, it's
+        # truncated back to the data actually written when done, even on
+        # error, so the file size still tells how much data is there.
+        extended = None
+        if self.preallocate and length and length >= bufsize:
+            filesize = os.fstat(fd).st_size
+            if self._fallocate(fd, offset, length) and \
+                    offset + length > filesize:
+                extended = filesize
+        
+        # Use O_DIRECT only if the file offset is aligned
+        direct = self.direct and offset % self._alignment == 0 and \
+                 self._set_direct(fd, True)
+        buf = self._get_buffer(direct)
+        if not direct:
+            view = memoryview(buf)
+        readinto = getattr(fsrc, 'readinto', None)
+        
+        written = 0     # bytes written to the file
+        fill = 0        # bytes in the buffer (O_DIRECT only)
+        synced = offset # start of the data not dropped from the cache yet
+        try:
+            while True:
+                
+                # Read the next block
+                size = bufsize - fill
+                if exact and length is not None:
+                    size = min(size, length - written - fill)
+                    if size <= 0:
+                        break
+                if direct:
+                    if readinto is not None and fill == 0 and size == bufsize:
+                        count = readinto(buf)
+                    else:
+                        data = fsrc.read(size)
+                        count = len(data)
+                        buf[fill:fill + count] = data
+                    if not count:
+                        break
+                    fill = fill + count
+                    if fill < bufsize:
+                        continue
+                    data, count, fill = buffer(buf, 0, bufsize), bufsize, 0
+                elif readinto is not None:
+                    count = readinto(view[:size])
+                    if not count:
+                        break
+                    data = view[:count]
+                else:
+                    data = fsrc.read(size)
+                    count = len(data)
+                    if not count:
+                        break
+                
+                # Write it
+                self._write(fd, data, count)
+                written = written + count
+                if progress is not None:
+                    progress(count)
+                
+                # Start writing it to disk and drop the previous block
+                if self.dontneed:
+                    self._sync_range(fd, offset + written - count, count,
+                                     self._SYNC_FILE_RANGE_WRITE)
+                    self._drop(fd, synced, offset + written - count - synced)
+                    synced = offset + written - count
+            
+            # Write whatever is left in the O_DIRECT buffer without it
+            if fill:
+                self._set_direct(fd, False)
+                direct = False
+                self._write(fd, buffer(buf, 0, fill), fill)
+                written = written + fill
+                if progress is not None:
+                    progress(fill)
+        
+        finally:
+            if direct:
+                self._set_direct(fd, False)
+            if extended is not None:
+                os.ftruncate(fd, max(extended, offset + written))
+            fdst.seek(offset + written)
+        
+        # Drop the rest of the data from the cache
+        if self.dontneed:
+            self._drop(fd, synced, offset + written - synced)
+        
+        # Check the size
+        if exact and length is not None and written < length:
+            raise IOError("Data ended after %d bytes" % written)
+        return written
+
+#-----------------------------------------------------------------------------#
+
 class HttpUtils(object):
     """
     Static methods with HTTP utilities.
@@ -713,9 +1842,38 @@ class HttpUtils(object):
         # Correct the file time to the local clock and return it
         return file_date - server_date + local_date
     
-    # Check if the local file has the same size as the remote file
+    # Content encodings we can decode, in order of preference
+    if brotli is not None:
+        content_encodings = ('br', 'gzip', 'deflate')
+    else:
+        content_encodings = ('gzip', 'deflate')
+    
     @staticmethod
-    def same_size(filename, headers):
+    def get_content_encoding(headers):
+        """
+        Retrieve the content encoding from the HTTP headers.
+        
+        @type  headers: httplib.HTTPHeaders
+        @param headers: HTTP headers returned by the server.
+        
+        @rtype: str
+        @return: Content encoding in lowercase (for example C{"gzip"}),
+            or C{None} if the data is not encoded.
+        """
+        encoding = headers.get('Content-Encoding')
+        if encoding:
+            encoding = encoding.strip().lower()
+            if encoding == 'x-gzip':
+                encoding = 'gzip'
+            if encoding and encoding != 'identity':
+                return encoding
+        return None
+    
+    # Check if the local file has the same size as the remote file.
+    # If the server compressed the response, the Content-Length is compared
+    # to the encoded size of the local copy instead, when known.
+    @classmethod
+    def same_size(self, filename, headers, encoded_size=None):
         try:
             hsize = int(headers['Content-Length'])
             fsize = os.stat(filename).st_size
@@ -725,6 +1883,8 @@ class HttpUtils(object):
             return False
         except OSError:
             return False
+        if self.get_content_encoding(headers):
+            return hsize == encoded_size
         return hsize == fsize
     
     @classmethod
@@ -768,12 +1928,201 @@ class HttpUtils(object):
                     return FileUtils.sanitize_local_name(new_name)
         return None
     
+    # Default ports for each URL scheme
+    _default_ports = {'http' : '80', 'https' : '443', 'ftp' : '21'}
+    
+    # Characters allowed unescaped in the path and query of a URL
+    _safe_path_chars  = "/:@!$&'()*+,;=-._~%"
+    _safe_query_chars = "/?:@!$&'()*+,;=-._~%"
+    
+    # Unreserved characters, escaping them makes no difference
+    _unreserved_chars = frozenset(
+        'abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789-._~')
+    
+    # Regexps to find escape sequences, and % signs that aren't escapes
+    _reEscape      = re.compile('%([0-9A-Fa-f]{2})')
+    _reStrayEscape = re.compile('%(?![0-9A-Fa-f]{2})')
+    
+    @classmethod
+    def _normalize_escapes(self, text, safe):
+        text = urllib2.quote(text, safe)
+        text = self._reStrayEscape.sub('%25', text)
+        return self._reEscape.sub(self._normalize_escape, text)
+    
+    @classmethod
+    def _normalize_escape(self, match):
+        char = chr(int(match.group(1), 16))
+        if char in self._unreserved_chars:
+            return char
+        return '%' + match.group(1).upper()
+    
     @staticmethod
-    def normalize_url(url):
+    def remove_dot_segments(path):
+        """
+        Remove the "." and ".." segments from a URL path, as described in
+        RFC 3986 section 5.2.4.
         
-        # TODO
+        @type  path: str
+        @param path: URL path.
         
-        return url
+        @rtype:  str
+        @return: Path without dot segments.
+        """
+        if '.' not in path:
+            return path
+        output = []
+        for segment in path.split('/'):
+            if segment == '..':
+                if len(output) > 1:
+                    output.pop()
+            elif segment != '.':
+                output.append(segment)
+        if path.startswith('/') and (not output or output[0]):
+            output.insert(0, '')
+        if path.endswith(('/.', '/..')):
+            output.append('')
+        return '/'.join(output)
+    
+    @classmethod
+    def normalize_url(self, url, sort_query=False):
+        """
+        Convert a URL to its canonical form, so the same resource is always
+        reached through the same URL.
+        
+         - The scheme and host name are converted to lowercase.
+         - The default port for the scheme is removed.
+         - "." and ".." path segments are removed.
+         - Escape sequences are converted to uppercase, unreserved
+           characters are unescaped, and characters that aren't allowed
+           in a URL are escaped.
+         - The fragment is removed.
+         - Optionally, the query parameters are sorted.
+        
+        URLs with schemes other than HTTP, HTTPS and FTP are returned
+        unchanged except for the fragment.
+        
+        @type  url: str or unicode
+        @param url: URL to normalize. Unicode URLs are encoded as UTF-8.
+        
+        @type  sort_query: bool
+        @param sort_query: C{True} to sort the query parameters.
+            Most servers don't care about their order, but some do.
+        
+        @rtype:  str
+        @return: Normalized URL.
+        """
+        if isinstance(url, unicode):
+            url = url.encode('utf-8')
+        scheme, netloc, path, query, fragment = urlparse.urlsplit(url)
+        scheme = scheme.lower()
+        if scheme not in self._default_ports:
+            return urlparse.urldefrag(url)[0]
+        
+        # Lowercase the host name and remove the default port
+        userinfo, at, hostport = netloc.rpartition('@')
+        host, colon, port = hostport.rpartition(':')
+        if not colon or ']' in port:    # no port, or IPv6 address
+            host, port = hostport, ''
+        host = host.lower()
+        if port == self._default_ports[scheme]:
+            port = ''
+        netloc = userinfo + at + host
+        if port:
+            netloc = netloc + ':' + port
+        
+        # Normalize the escape sequences and remove the dot segments
+        path = self._normalize_escapes(path, self._safe_path_chars)
+        path = self.remove_dot_segments(path)
+        if not path:
+            path = '/'
+        if query:
+            query = self._normalize_escapes(query, self._safe_query_chars)
+            if sort_query:
+                query = '&'.join(sorted(query.split('&')))
+        
+        # Put the URL back together, without the fragment
+        return urlparse.urlunsplit((scheme, netloc, path, query, ''))
+
+#-----------------------------------------------------------------------------#
+
+class ConnectionPool(object):
+    """
+    Thread safe pool of idle persistent HTTP connections, grouped by host.
+    
+    Connections are borrowed with L{get} and returned with L{put} once the
+    response has been read completely. Connections that stay idle for too
+    long are closed, since the server has most likely dropped them already.
+    """
+    
+    def __init__(self, maxidle=4, idletimeout=15.0):
+        """
+        @type  maxidle: int
+        @param maxidle: Maximum number of idle connections kept per host.
+        
+        @type  idletimeout: float
+        @param idletimeout: Time in seconds after which idle connections
+            are discarded.
+        """
+        self.maxidle     = maxidle
+        self.idletimeout = idletimeout
+        self._lock = threading.Lock()
+        self._idle = {}     # key -> list of (timestamp, connection)
+    
+    def get(self, key):
+        """
+        Borrow an idle connection.
+        
+        @type  key: tuple(str, str)
+        @param key: Scheme and host (with optional port) of the connection.
+        
+        @rtype:  httplib.HTTPConnection
+        @return: Idle connection, or C{None} if none is available.
+        """
+        expired = []
+        conn = None
+        with self._lock:
+            idle = self._idle.get(key)
+            if idle:
+                oldest = time.time() - self.idletimeout
+                while idle:
+                    timestamp, conn = idle.pop()
+                    if timestamp >= oldest:
+                        break
+                    expired.append(conn)
+                    conn = None
+                if not idle:
+                    del self._idle[key]
+        for old in expired:
+            old.close()
+        return conn
+    
+    def put(self, key, conn):
+        """
+        Return a connection to the pool. The previous response must have
+        been read completely.
+        
+        @type  key: tuple(str, str)
+        @param key: Scheme and host (with optional port) of the connection.
+        
+        @type  conn: httplib.HTTPConnection
+        @param conn: Connection to return.
+        """
+        with self._lock:
+            idle = self._idle.setdefault(key, [])
+            if len(idle) < self.maxidle:
+                idle.append( (time.time(), conn) )
+                return
+        conn.close()
+    
+    def close(self):
+        """
+        Close all idle connections.
+        """
+        with self._lock:
+            idle, self._idle = self._idle, {}
+        for conns in idle.itervalues():
+            for _, conn in conns:
+                conn.close()
 
 #-----------------------------------------------------------------------------#
 
@@ -815,6 +2164,15 @@ class Downloader(Configurable, HookChain):
     # Default hook that returns True to everything
     _default_hook = Hook()
     
+    # Maximum size in bytes of a response to be hashed in memory before
+    # writing it, in dedup mode. Smaller copies of a stored object are
+    # linked to it without writing their data at all.
+    _max_in_mem_dedup = 1024 * 1024
+    
+    # Maximum size in bytes of an error page kept for the caller of
+    # download(). Longer ones are truncated.
+    _max_error_body = 1024 * 1024
+    
     class _OptionsSiteMirrorMode(object):
         """
         Set of options for L{Downloader} to work in site mirror mode.
@@ -826,6 +2184,21 @@ class Downloader(Configurable, HookChain):
             self.obeycontentdisposition = True
             self.usefstimes = True
             self.onduplicate = Downloader.ON_DUPLICATE_OVERWRITE
+            self.poolsize = 4
+            self.poolidletimeout = 15.0
+            self.sortquery = False
+            self.partial = True
+            self.partialsize = 1024 * 1024
+            self.segments = 1
+            self.segmentsize = 8 * 1024 * 1024
+            self.compression = True
+            self.storecompressed = False
+            self.copybuffer = 1024 * 1024
+            self.preallocate = True
+            self.directio = False
+            self.dontneed = False
+            self.dedup = False
+            self.namecache = 10000
     
     class _OptionsDownloadManagerMode(object):
         """
@@ -838,6 +2211,21 @@ class Downloader(Configurable, HookChain):
             self.obeycontentdisposition = True
             self.usefstimes = False
             self.onduplicate = Downloader.ON_DUPLICATE_RENAME
+            self.poolsize = 2
+            self.poolidletimeout = 15.0
+            self.sortquery = False
+            self.partial = True
+            self.partialsize = 1024 * 1024
+            self.segments = 1
+            self.segmentsize = 8 * 1024 * 1024
+            self.compression = True
+            self.storecompressed = False
+            self.copybuffer = 1024 * 1024
+            self.preallocate = True
+            self.directio = False
+            self.dontneed = False
+            self.dedup = False
+            self.namecache = 10000
     
     class _DefaultOptions(_OptionsDownloadManagerMode):
         """
@@ -884,155 +2272,851 @@ class Downloader(Configurable, HookChain):
                                             self, req, fp, code, msg, headers)
         
         http_error_301 = http_error_303 = http_error_307 = http_error_302
+        
+        # Keep timing the download on the new request
+        def redirect_request(self, req, fp, code, msg, headers, newurl):
+            newreq = urllib2.HTTPRedirectHandler.redirect_request(
+                            self, req, fp, code, msg, headers, newurl)
+            if newreq is not None and hasattr(req, 'timings'):
+                newreq.timings = req.timings
+            return newreq
     
-    def __init__(self, options=None, cookiejar=None, hooks=None):
+    class _ContentDecoder(object):
         """
-        @type  options: Options
-        @param options: Optional, configuration.
+        Incremental decoder for a C{Content-Encoding}. Compressed data is
+        given to L{feed} and decoded with L{decode}, which caps the output
+        at the requested size.
         
-        @type  cookiejar: cookielib.CookieJar
-        @param cookiejar: Optional, HTTP cookie jar.
+        Brotli is only supported when the C{brotli} module can cap its
+        output too (version 1.2 or later). Older versions and C{brotlicffi}
+        decode everything they're given at once, so a small response could
+        take gigabytes of memory, and C{br} isn't accepted with them.
         
-        @type  hooks: list(L{Hook})
-        @param hooks: Hook chain in order of execution.
-            All requests and responses will be filtered by these hooks in the
-            given order.
+        @type pending: str
+        @ivar pending: Compressed data given to L{feed} not yet decoded.
+        
+        @type held: bool
+        @ivar held: C{True} if the decoder still has output for the data it
+            was given, so L{decode} can return more without calling L{feed}.
         """
         
-        # Configuration
-        Configurable.__init__(self, options)
+        def __init__(self, encoding):
+            """
+            @type  encoding: str
+            @param encoding: Content encoding, as returned by
+                L{HttpUtils.get_content_encoding}. It must be one of
+                L{HttpUtils.content_encodings}.
+            """
+            self._encoding = encoding
+            self._started  = False      # True once some data was decoded
+            self.pending   = ''
+            self.held      = False
+            if encoding == 'gzip':
+                self._decoder = zlib.decompressobj(16 + zlib.MAX_WBITS)
+            elif encoding == 'deflate':
+                self._decoder = zlib.decompressobj()
+            elif encoding == 'br' and brotli is not None:
+                self._decoder = brotli.Decompressor()
+            else:
+                raise ValueError("Unsupported content encoding: %r" %
+                                 encoding)
         
-        # Hook chain
-        HookChain.__init__(self, hooks)
+        def feed(self, data):
+            """
+            @type  data: str
+            @param data: Compressed data.
+            """
+            self.pending = self.pending + data
         
-        # Target directory
-        self._targetdir = os.path.realpath(options.targetdir)
-        if not self._targetdir.endswith(os.path.sep):
-            self._targetdir = self._targetdir + os.path.sep
+        def decode(self, size):
+            """
+            @type  size: int
+            @param size: Maximum number of bytes to return, if possible.
+            
+            @rtype: str
+            @return: Decoded data. May be empty even if there was data
+                pending, if it wasn't enough to decode anything yet.
+            """
+            decoder = self._decoder
+            data = self.pending
+            if self._encoding == 'br':
+                if decoder.can_accept_more_data():
+                    self.pending = ''
+                else:
+                    data = ''   # the output for the last data comes first
+                decoded = decoder.process(data, output_buffer_limit=size)
+                self.held = not decoder.can_accept_more_data()
+                return decoded
+            try:
+                decoded = decoder.decompress(data, size)
+            except zlib.error:
+                
+                # Some servers send raw deflate data without the zlib header
+                if self._encoding != 'deflate' or self._started:
+                    raise
+                self._decoder = decoder = zlib.decompressobj(-zlib.MAX_WBITS)
+                decoded = decoder.decompress(data, size)
+            self._started = True
+            self.pending = decoder.unconsumed_tail
+            return decoded
         
-        # List of urllib2 handlers
-        handlers = []
+        def flush(self):
+            """
+            @rtype: str
+            @return: Decoded data left once all the compressed data was fed.
+            """
+            if self._encoding != 'br':
+                return self._decoder.flush()
+            return ''
+    
+    class _DecodingReader(object):
+        """
+        Wraps a file-like object to remove the C{Content-Encoding} of the
+        data while it's being read. Compressed data is fed to the decoder a
+        block at a time, and zlib output is capped at the requested size, so
+        memory use stays constant no matter how large the file is.
+        """
         
-        # Cookie handler to use our cookie jar
-        cookie_handler = urllib2.HTTPCookieProcessor(cookiejar)
-        handlers.append(cookie_handler)
+        # Compressed block size
+        bufsize = 64 * 1024
         
-        # Redirect handler to pass redirections through the hook
-        callback = self._filter_redirect
-        redir_handler = self.__class__._RedirectHandler(callback, self)
-        handlers.append(redir_handler)
+        def __init__(self, fsrc, encoding):
+            """
+            @type  fsrc: file
+            @param fsrc: File-like object with the encoded data.
+            
+            @type  encoding: str
+            @param encoding: Content encoding, as returned by
+                L{HttpUtils.get_content_encoding}. It must be one of
+                L{HttpUtils.content_encodings}.
+            """
+            self._fsrc      = fsrc
+            self._decoder   = Downloader._ContentDecoder(encoding)
+            self._eof       = False
+            self.encoded_size = 0       # compressed bytes read so far
         
-        # Create the urllib2 opener using our handlers
-        self._urlopener = urllib2.build_opener(*(tuple(handlers)))
+        def read(self, size=-1):
+            if size is None or size < 0:
+                chunks = []
+                data = self.read(self.bufsize)
+                while data:
+                    chunks.append(data)
+                    data = self.read(self.bufsize)
+                return ''.join(chunks)
+            decoder = self._decoder
+            while not self._eof:
+                if not decoder.pending and not decoder.held:
+                    data = self._fsrc.read(self.bufsize)
+                    if not data:
+                        self._eof = True
+                        return decoder.flush()
+                    self.encoded_size = self.encoded_size + len(data)
+                    decoder.feed(data)
+                data = decoder.decode(max(size, 1))
+                if data:
+                    return data
+            return ''
+        
+        def close(self):
+            self._fsrc.close()
+        
+        def __enter__(self):
+            return self
+        
+        def __exit__(self, type, value, traceback):
+            self.close()
     
-    def download(self, url, referer=None):
+    class _DigestReader(object):
+        """
+        Wraps a file-like object to calculate the hash of the data while
+        it's being read.
         """
-        Download the resource pointed to by the given URL.
         
-        @type  url: str
-        @param url: Resource URL. Only "http://" and "https://" are supported.
+        def __init__(self, fsrc):
+            self._fsrc = fsrc
+            self._hash = hashlib.sha1()
+            self.size  = 0      # bytes read so far
+            if hasattr(fsrc, 'readinto'):
+                self.readinto = self._readinto
         
-        @type  referer: str
-        @param referer: Referer URL, as in the C{Referer} HTTP header.
+        def read(self, *argv):
+            data = self._fsrc.read(*argv)
+            self._hash.update(data)
+            self.size = self.size + len(data)
+            return data
         
-        @rtype: Resource or None
-        @return:
-            If the download is successful, this method returns a L{Resource}
-            instance describing it. If the download is skipped due to hooks or
-            configuration settings, C{None} is returned instead.
+        def _readinto(self, b):
+            count = self._fsrc.readinto(b)
+            if isinstance(b, memoryview):
+                self._hash.update(b[:count])
+            else:
+                self._hash.update(buffer(b, 0, count))
+            self.size = self.size + count
+            return count
         
-        @raise urllib2.HTTPError: Protocol or network error.
-        @raise os.OSError: System error while writing the downloaded data.
+        def hexdigest(self):
+            return self._hash.hexdigest()
+    
+    class _PartFile(object):
+        """
+        Partially downloaded file. The data is kept next to the target file
+        with a C{.part} extension, and a C{.part.info} sidecar file records
+        the cache validator to send in C{If-Range} and, for segmented
+        downloads, the byte ranges still missing. For sequential downloads
+        the size of the C{.part} file tells where to resume.
         """
         
-        onduplicate = self.options.onduplicate
-        usefstimes  = self.options.usefstimes
-        lastupdated = None
+        def __init__(self, filename):
+            self.filename  = filename + '.part'
+            self.infofile  = filename + '.part.info'
+            self.location  = None
+            self.validator = None       # strong ETag or Last-Modified
+            self.length    = None       # total size of the file, if known
+            self.ranges    = None       # list of [start, end] still missing
+            self.segmented = False      # True if ranges come from the sidecar
+            self.resumable = False      # True if load() found a usable file
+            self.resumed   = False      # True if the server agreed to resume
         
-        # Normalize the URL
-        url = HttpUtils.normalize_url(url)
+        # Parse a "start-end" range
+        @staticmethod
+        def _parse_range(text):
+            start, end = text.strip().split('-')
+            return [int(start), int(end)]
         
-        # Calculate the local file name from the URL
-        path, name = self.calc_local_name(url)
+        # Format a range for the Range header
+        @staticmethod
+        def _format_range(start, end):
+            if end is None:
+                return 'bytes=%d-' % start
+            return 'bytes=%d-%d' % (start, end)
         
-        # If a local file of the same name exists, skip it
-        # (only if ON_DUPLICATE_SKIP is specified)
-        if onduplicate == Downloader.ON_DUPLICATE_SKIP \
-            and os.path.exists(os.path.join(path, name)):
-                return None
+        def load(self):
+            """
+            Read the sidecar file left by a previous download, if any.
+            
+            @rtype:  bool
+            @return: C{True} if the download can be resumed.
+            """
+            try:
+                with open(self.infofile, 'rb') as fd:
+                    info = httplib.HTTPMessage(StringIO.StringIO(fd.read()))
+                size = FileUtils.get_file_size(self.filename)
+            except (IOError, OSError):
+                return False
+            try:
+                self.location  = info.get('URL')
+                self.validator = info.get('If-Range')
+                length = info.get('Content-Length')
+                if length is not None:
+                    length = int(length)
+                self.length = length
+                ranges = [self._parse_range(x)
+                          for x in info.getheaders('Range')]
+            except ValueError:
+                return False
+            if ranges:
+                self.segmented = True
+            else:
+                end = None
+                if length is not None:
+                    end = length - 1
+                ranges = [[size, end]]
+            self.ranges = [x for x in ranges if x[1] is None or x[0] <= x[1]]
+            self.resumable = bool(self.validator and self.ranges and size)
+            return self.resumable
         
-        # Build the request
-        headers = {'User-Agent':self.USER_AGENT}
-        if referer:
-            headers['Referer'] = referer
-        if usefstimes:
-            lastupdated = FileUtils.get_file_time(os.path.join(path, name))
-            if lastupdated:
-                headers['If-Modified-Since'] = rfc822.formatdate(lastupdated)
-        req = urllib2.Request(url, headers=headers)
+        def save(self):
+            """
+            Write the sidecar file.
+            """
+            lines = []
+            if self.location:
+                lines.append('URL: %s\r\n' % self.location)
+            lines.append('If-Range: %s\r\n' % self.validator)
+            if self.length is not None:
+                lines.append('Content-Length: %d\r\n' % self.length)
+            if self.segmented:
+                for start, end in self.ranges:
+                    if start <= end:
+                        lines.append('Range: %d-%d\r\n' % (start, end))
+            with open(self.infofile, 'wb') as fd:
+                fd.write(''.join(lines))
         
-        # Pass the request through the hook filters
-        if not self._filter_request(self, req, url):
+        def discard(self):
+            """
+            Delete the partial file and its sidecar.
+            """
+            FileUtils.remove_silently(self.filename)
+            FileUtils.remove_silently(self.infofile)
+        
+        def prepare_request(self, req):
+            """
+            Ask for the first missing range, only if the resource didn't
+            change. Other conditional headers are dropped, since the
+            complete file is not there to fall back to.
+            
+            @type  req: urllib2.Request
+            @param req: Request to modify.
+            """
+            for header in ('If-modified-since', 'If-none-match'):
+                req.headers.pop(header, None)
+                req.unredirected_hdrs.pop(header, None)
+            req.add_header('Range', self._format_range(*self.ranges[0]))
+            req.add_header('If-Range', self.validator)
+        
+        def accept(self, headers):
+            """
+            Check the C{Content-Range} of a C{"206 Partial Content"} reply
+            to a request made with L{prepare_request}, and fix the headers
+            to describe the complete file.
+            
+            @type  headers: httplib.HTTPMessage
+            @param headers: Response headers.
+            
+            @raise IOError: The server sent a different range.
+            """
+            content_range = headers.get('Content-Range', '')
+            match = re.match(r'^\s*bytes\s+(\d+)-(\d+)/(\d+|\*)\s*$',
+                             content_range)
+            start, end = self.ranges[0]
+            if not match or int(match.group(1)) != start or \
+                    (end is not None and int(match.group(2)) != end):
+                raise IOError("Unexpected Content-Range: %r" % content_range)
+            if match.group(3) != '*':
+                length = int(match.group(3))
+                if self.length is not None and self.length != length:
+                    raise IOError("Unexpected Content-Range: %r" %
+                                  content_range)
+                self.length = length
+            if end is None and self.length is not None:
+                self.ranges[0][1] = self.length - 1
+            del headers['Content-Range']
+            if self.length is not None:
+                headers['Content-Length'] = str(self.length)
+            self.resumed = True
+        
+        def reset(self, location, headers, segments=1, segmentsize=0):
+            """
+            Start over with a complete C{"200 OK"} response, splitting the
+            file in segments if possible.
+            
+            @type  location: str
+            @param location: URL of the resource.
+            
+            @type  headers: httplib.HTTPMessage
+            @param headers: Response headers.
+            
+            @type  segments: int
+            @param segments: Maximum number of segments.
+            
+            @type  segmentsize: int
+            @param segmentsize: Minimum size of each segment.
+            """
+            self.location  = location
+            self.resumed   = False
+            self.validator = headers.get('ETag')
+            if not self.validator or self.validator.startswith('W/'):
+                self.validator = headers.get('Last-Modified')
+            try:
+                self.length = int(headers['Content-Length'])
+            except (KeyError, ValueError):
+                self.length = None
+            if self.length is None:
+                self.ranges = [[0, None]]
+                self.segmented = False
+                return
+            count = 1
+            if self.validator and segments > 1 and \
+                    headers.get('Accept-Ranges', '').strip() == 'bytes':
+                count = min(segments, self.length // max(segmentsize, 1))
+                count = max(count, 1)
+            size = -(-self.length // count)
+            self.ranges = [[x, min(x + size, self.length) - 1]
+                           for x in xrange(0, self.length, size)]
+            self.segmented = count > 1
+        
+        def copy_range(self, fsrc, fdst, rng, copier):
+            """
+            Copy a range of the file from a response, updating the range
+            as data is written so it always holds what's still missing.
+            
+            @type  fsrc: file
+            @param fsrc: Response to read from.
+            
+            @type  fdst: file
+            @param fdst: Partial file to write to.
+            
+            @type  rng: list(int)
+            @param rng: Range to copy, as a C{[start, end]} list.
+                The end may be C{None} to copy until the end of the data.
+            
+            @type  copier: L{FileCopier}
+            @param copier: Copy engine to use.
+            
+            @raise IOError: The connection was closed early.
+            """
+            def progress(count):
+                rng[0] = rng[0] + count
+            fdst.seek(rng[0])
+            if rng[1] is None:
+                copier.copy(fsrc, fdst, progress=progress)
+            else:
+                copier.copy(fsrc, fdst, rng[1] - rng[0] + 1, exact=True,
+                            progress=progress)
+    
+    class _PooledResponse(object):
+        """
+        Sits between C{socket._fileobject} and the C{httplib.HTTPResponse},
+        returning the connection to the L{ConnectionPool} when the response
+        is closed after being read completely.
+        """
+        
+        # Leftover bodies up to this size are drained on close,
+        # so the connection can still be reused.
+        _max_drain = 64 * 1024
+        
+        def __init__(self, response, conn, key, pool):
+            self._response = response
+            self._conn     = conn
+            self._key      = key
+            self._pool     = pool
+        
+        def recv(self, amt):
+            return self._response.read(amt)
+        
+        def readinto(self, b):
+            """
+            Read the response body into a writable buffer.
+            
+            When the body has a known length and nothing is left in the
+            C{httplib} buffers, it's received straight from the socket
+            into the buffer, with no intermediate strings.
+            
+            @type  b: bytearray or memoryview
+            @param b: Buffer to fill.
+            
+            @rtype:  int
+            @return: Number of bytes read, C{0} at the end of the body.
+            """
+            response = self._response
+            if response is None or response.fp is None:
+                return 0
+            length = response.length
+            buffered = Downloader._get_buffered(response.fp)
+            if buffered or response.chunked or length is None:
+                size = len(b)
+                if buffered:
+                    size = min(size, buffered)
+                data = response.read(size)
+                b[:len(data)] = data
+                return len(data)
+            count = response.fp._sock.recv_into(b, min(len(b), length))
+            response.length = length - count
+            if not response.length or not count:
+                response.close()
+            return count
+        
+        def close(self):
+            response, self._response = self._response, None
+            if response is None:
+                return
+            if not response.isclosed() and not response.will_close \
+                   and response.length is not None \
+                   and response.length <= self._max_drain:
+                try:
+                    response.read()
+                except (socket.error, httplib.HTTPException):
+                    pass
+            if response.isclosed() and not response.will_close:
+                self._pool.put(self._key, self._conn)
+            else:
+                response.close()
+                self._conn.close()
+    
+    # Read the body of an HTTP error and give back the connection, so the
+    # caller can still read the body after the connection is reused
+    @classmethod
+    def _detach_error_body(cls, e):
+        if e.fp is None:
+            return
+        try:
+            body = e.read(cls._max_error_body)
+        except (socket.error, httplib.HTTPException):
+            body = ''
+        e.close()
+        urllib2.HTTPError.__init__(e, e.filename, e.code, e.msg, e.hdrs,
+                                   StringIO.StringIO(body))
+    
+    # Number of bytes held in the read buffer of a socket._fileobject
+    @staticmethod
+    def _get_buffered(fileobj):
+        rbuf = fileobj._rbuf
+        rbuf.seek(0, 2)
+        return rbuf.tell()
+    
+    class _KeepAliveMixin(object):
+        """
+        Mixin for C{urllib2} HTTP handlers to send requests through
+        persistent connections borrowed from a L{ConnectionPool}.
+        
+        Cookies, redirections and the rest of the C{urllib2} machinery work
+        just the same, since only the connection handling is replaced.
+        Requests with methods that aren't idempotent always use a new
+        connection, so they're never sent twice.
+        """
+        
+        # Requests that can be sent again if a reused connection was dropped
+        _idempotent_methods = ('GET', 'HEAD', 'OPTIONS', 'TRACE', 'PUT',
+                               'DELETE')
+        
+        # Same as socket.create_connection, but timing the name lookup and
+        # the connection separately
+        @staticmethod
+        def _create_connection(timings, address, timeout, source_address):
+            host, port = address
+            start = time.time()
+            addresses = socket.getaddrinfo(host, port, 0, socket.SOCK_STREAM)
+            resolved = time.time()
+            timings.add('dns', resolved - start)
+            error = socket.error("getaddrinfo returns an empty list")
+            for family, socktype, proto, _, sockaddr in addresses:
+                sock = None
+                try:
+                    sock = socket.socket(family, socktype, proto)
+                    if timeout is not socket._GLOBAL_DEFAULT_TIMEOUT:
+                        sock.settimeout(timeout)
+                    if source_address:
+                        sock.bind(source_address)
+                    sock.connect(sockaddr)
+                    timings.add('connect', time.time() - resolved)
+                    return sock
+                except socket.error, e:
+                    error = e
+                    if sock is not None:
+                        sock.close()
+            raise error
+        
+        def _open_pooled(self, http_class, req, **http_conn_args):
+            host = req.get_host()
+            if not host:
+                raise urllib2.URLError('no host given')
+            
+            # Don't bother pooling tunnels through proxies
+            if req._tunnel_host:
+                return self.do_open(http_class, req, **http_conn_args)
+            
+            # Same as AbstractHTTPHandler.do_open, but keeping the connection
+            headers = dict(req.unredirected_hdrs)
+            headers.update(dict((k, v) for k, v in req.headers.items()
+                                if k not in headers))
+            headers['Connection'] = 'keep-alive'
+            headers = dict(
+                (name.title(), val) for name, val in headers.items())
+            
+            # Send the request. Reused connections may have been dropped by
+            # the server in the meantime, if so retry with a fresh one.
+            pool = self._pool
+            key  = (req.get_type(), host)
+            timings = getattr(req, 'timings', None)
+            method = req.get_method()
+            reuse = method in self._idempotent_methods
+            while True:
+                h = None
+                if reuse:
+                    h = pool.get(key)
+                reused = h is not None
+                if not reused:
+                    h = http_class(host, timeout=req.timeout,
+                                   **http_conn_args)
+                    h.set_debuglevel(self._debuglevel)
+                    if timings is not None:
+                        h._create_connection = (
+                            lambda address, timeout, source_address:
+                                self._create_connection(timings, address,
+                                                timeout, source_address))
+                try:
+                    h.request(method, req.get_selector(), req.data, headers)
+                    r = h.getresponse(buffering=True)
+                except (socket.error, httplib.HTTPException), err:
+                    h.close()
+                    if reused:
+                        continue
+                    raise urllib2.URLError(err)
+                break
+            
+            # Wrap the response the same way urllib2 does
+            r.recv = r.read
+            pooled = Downloader._PooledResponse(r, h, key, pool)
+            fp = socket._fileobject(pooled, close=True)
+            resp = urllib2.addinfourl(fp, r.msg, req.get_full_url())
+            resp.code = r.status
+            resp.msg  = r.reason
+            
+            # Let the copy engine read the body without the file object,
+            # once whatever it has buffered is consumed
+            def readinto(b):
+                buffered = Downloader._get_buffered(fp)
+                if buffered:
+                    data = fp.read(min(len(b), buffered))
+                    b[:len(data)] = data
+                    return len(data)
+                return pooled.readinto(b)
+            resp.readinto = readinto
+            return resp
+    
+    class _KeepAliveHTTPHandler(_KeepAliveMixin, urllib2.HTTPHandler):
+        """
+        HTTP handler for C{urllib2} using persistent connections.
+        """
+        
+        def __init__(self, pool):
+            urllib2.HTTPHandler.__init__(self)
+            self._pool = pool
+        
+        def http_open(self, req):
+            return self._open_pooled(httplib.HTTPConnection, req)
+    
+    if hasattr(httplib, 'HTTPS'):
+        class _KeepAliveHTTPSHandler(_KeepAliveMixin, urllib2.HTTPSHandler):
+            """
+            HTTPS handler for C{urllib2} using persistent connections.
+            """
+            
+            def __init__(self, pool):
+                urllib2.HTTPSHandler.__init__(self)
+                self._pool = pool
+            
+            def https_open(self, req):
+                return self._open_pooled(httplib.HTTPSConnection, req,
+                                         context=self._context)
+    
+    def __init__(self, options=None, cookiejar=None, hooks=None):
+        """
+        @type  options: Options
+        @param options: Optional, configuration.
+        
+        @type  cookiejar: cookielib.CookieJar
+        @param cookiejar: Optional, HTTP cookie jar.
+        
+        @type  hooks: list(L{Hook})
+        @param hooks: Hook chain in order of execution.
+            All requests and responses will be filtered by these hooks in the
+            given order.
+        """
+        
+        # Configuration
+        Configurable.__init__(self, options)
+        
+        # Hook chain
+        HookChain.__init__(self, hooks)
+        
+        # Target directory
+        self._targetdir = os.path.realpath(self.options.targetdir)
+        if not self._targetdir.endswith(os.path.sep):
+            self._targetdir = self._targetdir + os.path.sep
+        
+        # List of urllib2 handlers
+        handlers = []
+        
+        # Cookie handler to use our cookie jar
+        cookie_handler = urllib2.HTTPCookieProcessor(cookiejar)
+        handlers.append(cookie_handler)
+        self._cookiejar = cookie_handler.cookiejar
+        
+        # Redirect handler to pass redirections through the hook
+        callback = self._filter_redirect
+        redir_handler = self.__class__._RedirectHandler(callback, self)
+        handlers.append(redir_handler)
+        
+        # Persistent connection handlers, replacing the default ones
+        self._pool = None
+        if self.options.poolsize > 0:
+            self._pool = ConnectionPool(self.options.poolsize,
+                                        self.options.poolidletimeout)
+            handlers.append(self._KeepAliveHTTPHandler(self._pool))
+            if hasattr(self, '_KeepAliveHTTPSHandler'):
+                handlers.append(self._KeepAliveHTTPSHandler(self._pool))
+        
+        # Create the urllib2 opener using our handlers
+        self._urlopener = urllib2.build_opener(*(tuple(handlers)))
+        
+        # Copy engine to write the downloaded data to disk
+        self._copier = FileCopier(self.options.copybuffer,
+                                  self.options.preallocate,
+                                  self.options.directio,
+                                  self.options.dontneed)
+        
+        # Caches of local pathnames and of directories known to exist,
+        # to save filesystem calls on every download
+        self._name_cache   = None
+        self._path_cache   = None
+        self._created_dirs = None
+        if self.options.namecache > 0:
+            self._name_cache   = LRUCache(self.options.namecache)
+            self._path_cache   = LRUCache(self.options.namecache)
+            self._created_dirs = LRUCache(self.options.namecache)
+    
+    def close(self):
+        """
+        Close any persistent connections left open.
+        The downloader may still be used after calling this method.
+        """
+        if self._pool is not None:
+            self._pool.close()
+        self.clear_caches()
+    
+    def clear_caches(self):
+        """
+        Forget the cached local pathnames and created directories.
+        
+        Call this if the target directory was changed by someone else
+        while downloading, for example to remove folders or add symlinks.
+        """
+        if self._name_cache is not None:
+            self._name_cache.clear()
+            self._path_cache.clear()
+            self._created_dirs.clear()
+    
+    def download(self, url, referer=None):
+        """
+        Download the resource pointed to by the given URL.
+        
+        @type  url: str
+        @param url: Resource URL. Only "http://" and "https://" are supported.
+        
+        @type  referer: str
+        @param referer: Referer URL, as in the C{Referer} HTTP header.
+        
+        @rtype: Resource or None
+        @return:
+            If the download is successful, this method returns a L{Resource}
+            instance describing it. If the download is skipped due to hooks or
+            configuration settings, C{None} is returned instead.
+        
+        @raise urllib2.HTTPError: Protocol or network error.
+        @raise os.OSError: System error while writing the downloaded data.
+        """
+        try:
+            return self._download(url, referer)
+        except Exception, e:
+            exc_info = sys.exc_info()
+            self._handle_error(self, url, e)
+            raise exc_info[0], exc_info[1], exc_info[2]
+    
+    # Download a resource, for download(), which passes errors to the hooks
+    def _download(self, url, referer):
+        
+        # Build the request, unless it's skipped
+        prepared = self._prepare_request(url, referer)
+        if prepared is None:
             return None
+        url, req, path, name, lastupdated = prepared
+        timings = req.timings
+        
+        # If a previous attempt left a partial file, ask for the rest
+        part = None
+        if self.options.partial:
+            part = self._PartFile(os.path.join(path, name))
+            if part.load():
+                part.prepare_request(req)
+                if not self.options.storecompressed:
+                    req.add_header('Accept-Encoding', 'identity')
         
         # Make the request to the server
         fsrc = None
         try:
+            timings.begin()
             try:
                 fsrc = self._urlopener.open(req)
             except urllib2.HTTPError, e:
                 if int(e.code) == 304:  # if "304: Not Modified"
-                    return None             # we have it in the cache
+                    e.close()           # give back the connection
+                    timings.end_headers()
+                    self._handle_not_modified(self, req, url)
+                    return self._not_modified(req, url, referer)
+                self._detach_error_body(e)
                 raise                   # else an error occured
+            timings.end_headers()
             resp_time = time.time()
             
             # Update our info from the response headers
             headers = fsrc.info()
             location = fsrc.geturl()
-            path, name = self.calc_local_name(location)
-            filechanged = False
-            if location != url:
-                filechanged = True
-            if self.options.obeycontentdisposition:
-                new_name = HttpUtils.get_name_from_headers(headers)
-                if new_name and new_name != name:
-                    name = new_name
-                    filechanged = True
-            filename = os.path.join(path, name)
-            if filechanged:
-                lastupdated = FileUtils.get_file_time(filename)
-            timestamp = HttpUtils.get_last_modified(headers)
-            
-            # If a local file of the same name exists, skip it
-            # (only if ON_DUPLICATE_SKIP is specified)
-            if onduplicate == Downloader.ON_DUPLICATE_SKIP \
-                and os.path.exists(filename):
-                    return None
-            
-            # If we already have this file in the cache, skip it
-            # (only if we trust filesystem timestamps)
-            if usefstimes  and timestamp and lastupdated \
-                           and lastupdated >= timestamp \
-                           and HttpUtils.same_size(filename, headers):
-                return None
+            resumed = False
+            if part is not None and part.resumable:
+                if fsrc.getcode() == 206:
+                    part.accept(headers)
+                    resumed = True
+                else:
+                    part.discard()      # the server sent the whole file
             
-            # Pass the response through the hook filters
-            if not self._filter_response(self, fsrc, filename):
+            # Decide where to save the response, if at all
+            checked = self._check_response(req, fsrc, lastupdated)
+            if checked is None:
                 return None
+            path, name, timestamp = checked
             
-            # Download the file contents to disk
+            # Decode compressed responses, unless told to save them as-is
+            # or the encoding is unknown to us
+            encoding = HttpUtils.get_content_encoding(headers)
+            decoder = None
+            if encoding and not self.options.storecompressed and \
+                    encoding in HttpUtils.content_encodings:
+                decoder = self._DecodingReader(fsrc, encoding)
+                encoding = None
+            
+            # Download the file contents to disk,
+            # calculating the hash of the data on the way.
+            # Large files go through a partial file that survives errors,
+            # so the download can be resumed later.
             if not timestamp:
                 timestamp = resp_time
-            filename = self._download_to_file(fsrc, path, name, timestamp)
+            if part is not None and not resumed:
+                length = headers.get('Content-Length')
+                if decoder is not None:
+                    part = None     # ranges would refer to encoded data
+                elif length and length.isdigit() and \
+                        int(length) < self.options.partialsize:
+                    part = None
+                else:
+                    part.reset(location, headers, self.options.segments,
+                               self.options.segmentsize)
+                    if not part.validator:
+                        part = None     # can't be resumed anyway
+            if part is None:
+                length = None
+                if decoder is None:
+                    length = headers.get('Content-Length')
+                    if length and length.isdigit():
+                        length = int(length)
+                    else:
+                        length = None
+                reader = self._DigestReader(decoder or fsrc)
+                if self.options.dedup:
+                    filename = self._download_to_store(reader, path, name,
+                                                       timestamp, length)
+                else:
+                    filename = self._download_to_file(reader, path, name,
+                                                      timestamp, length)
+                digest = reader.hexdigest()
+                size = encoded_size = reader.size
+                if decoder is not None:
+                    encoded_size = decoder.encoded_size
+            else:
+                filename, digest = self._download_to_part(fsrc, part, path,
+                                                          name, timestamp)
+                size = encoded_size = part.length
+                if filename and size is None:
+                    size = encoded_size = FileUtils.get_file_size(filename)
             if not filename:
                 return None     # skipped
+            timings.end_body()
             
             # Build the Resource object to be returned
-            hdrs = ''.join(headers.headers)
-            res = Resource(timestamp, url, location, filename, referer, hdrs)
-            
-            # Pass the Resource object through the hook filters
-            if not self._filter_resource(self, res):
+            res = self._make_resource(timestamp, url, location, filename,
+                                      referer, headers, size, encoded_size,
+                                      encoding, digest, timings)
+            if res is None:
                 return None
         
         # Close the request object
@@ -1043,50 +3127,437 @@ class Downloader(Configurable, HookChain):
         # Return the Resource object
         return res
     
-    # Save an open URL into a local file
-    def _download_to_file(self, fsrc, path, name, timestamp=None):
+    # Normalize the URL and build the request for it, passing it through the
+    # hooks. Returns the URL, the request, the local path and name, and the
+    # time the local copy was last updated, or None to skip the download.
+    def _prepare_request(self, url, referer):
+        
+        onduplicate = self.options.onduplicate
+        usefstimes  = self.options.usefstimes
+        lastupdated = None
+        
+        # Normalize the URL
+        url = HttpUtils.normalize_url(url, self.options.sortquery)
+        
+        # Calculate the local file name from the URL
+        path, name = self.calc_local_name(url)
+        
+        # If a local file of the same name exists, skip it
+        # (only if ON_DUPLICATE_SKIP is specified)
+        if onduplicate == Downloader.ON_DUPLICATE_SKIP \
+            and os.path.exists(os.path.join(path, name)):
+                return None
         
-        # Make sure the directory structure exists
-        FileUtils.makedirs(path)
+        # Build the request
+        headers = {'User-Agent':self.USER_AGENT}
+        if referer:
+            headers['Referer'] = referer
+        if self.options.compression:
+            headers['Accept-Encoding'] = ', '.join(
+                                            HttpUtils.content_encodings)
+        if usefstimes:
+            lastupdated = FileUtils.get_file_time(os.path.join(path, name))
+            if lastupdated:
+                headers['If-Modified-Since'] = rfc822.formatdate(lastupdated)
+        req = urllib2.Request(url, headers=headers)
+        req.timings = Timings()
         
-        # Download the file using the appropriate method...
+        # Pass the request through the hook filters
+        if not self._filter_request(self, req, url):
+            return None
+        return url, req, path, name, lastupdated
+    
+    # Work out the local file name for a response, and decide whether to
+    # download it, passing it through the hooks. Returns the local path and
+    # name and the last modification time sent by the server, or None to
+    # skip the download.
+    def _check_response(self, req, fsrc, lastupdated):
         onduplicate = self.options.onduplicate
+        usefstimes  = self.options.usefstimes
+        headers = fsrc.info()
+        location = fsrc.geturl()
+        path, name = self.calc_local_name(location)
+        filechanged = False
+        if location != req.get_full_url():
+            filechanged = True
+        if self.options.obeycontentdisposition:
+            new_name = HttpUtils.get_name_from_headers(headers)
+            if new_name and new_name != name:
+                name = new_name
+                filechanged = True
+        filename = os.path.join(path, name)
+        if filechanged:
+            lastupdated = FileUtils.get_file_time(filename)
+        timestamp = HttpUtils.get_last_modified(headers)
         
-        # ON_DUPLICATE_RENAME: Rename the output file automatically
-        if onduplicate == Downloader.ON_DUPLICATE_RENAME:
-            filename = FileUtils.copy_renaming(fsrc, path, name)
+        # If a local file of the same name exists, skip it
+        # (only if ON_DUPLICATE_SKIP is specified)
+        if onduplicate == Downloader.ON_DUPLICATE_SKIP \
+            and os.path.exists(filename):
+                return None
+        
+        # If we already have this file in the cache, skip it
+        # (only if we trust filesystem timestamps)
+        if usefstimes  and timestamp and lastupdated \
+                       and lastupdated >= timestamp \
+                       and HttpUtils.same_size(filename, headers,
+                                self._get_encoded_size(req, filename)):
+            return None
+        
+        # Pass the response through the hook filters
+        if not self._filter_response(self, fsrc, filename):
+            return None
+        return path, name, timestamp
+    
+    # Build the Resource object for a finished download and pass it through
+    # the hooks. Returns None if a hook rejects it.
+    def _make_resource(self, timestamp, url, location, filename, referer,
+                       headers, size, encoded_size, encoding, digest,
+                       timings=None):
+        hdrs = ''.join(headers.headers)
+        res = Resource(timestamp, url, location, filename, referer, hdrs,
+                       size, encoded_size, encoding, digest)
+        res.timings = timings
+        if not self._filter_resource(self, res):
+            return None
+        return res
+    
+    # Get the size of the response body for the local copy of a resource,
+    # as it was sent by the server, if known
+    def _get_encoded_size(self, req, filename):
+        validators = getattr(req, 'validators', None)
+        if validators is not None and validators.datafile == filename:
+            return validators.length
+        return None
+    
+    # Called when the server answers "304 Not Modified".
+    # The request may have the validators of the cached copy set by a hook.
+    # Returns the value for download() to return.
+    def _not_modified(self, req, url, referer):
+        return None     # we have it in the cache
+    
+    # Save an open URL into a partial file, fetching the missing ranges of
+    # segmented downloads in parallel, then move it to its final name.
+    # Returns the filename and the hash of the data.
+    def _download_to_part(self, fsrc, part, path, name, timestamp=None):
+        
+        # Open the partial file, or create it if starting over.
+        # Segmented files are sized up front so segments can be written
+        # anywhere, and the sidecar file is written before the data.
+        reader = None
+        if part.resumed:
+            fdst = open(part.filename, 'r+b')
         else:
+            fdst = self._in_dir(os.path.dirname(part.filename),
+                                open, part.filename, 'wb')
+            if part.segmented:
+                fdst.truncate(part.length)
+            part.save()
+            if not part.segmented:
+                reader = fsrc = self._DigestReader(fsrc)
+        
+        # Get the first range from this response, and the rest from
+        # parallel requests
+        errors = []
+        threads = []
+        try:
+            try:
+                for rng in part.ranges[1:]:
+                    t = threading.Thread(target=self._download_range,
+                                         args=(part, rng, errors))
+                    t.daemon = True
+                    t.start()
+                    threads.append(t)
+                try:
+                    part.copy_range(fsrc, fdst, part.ranges[0], self._copier)
+                finally:
+                    for t in threads:
+                        t.join()
+                if errors:
+                    raise errors[0]
+            finally:
+                fdst.close()
+        except:
             
-            # Calculate the output filename
+            # Keep the partial file, and remember what's still missing
+            if part.segmented:
+                try:
+                    part.save()
+                except Exception:
+                    pass
+            raise
+        
+        # The hash can only be calculated on the way for complete
+        # sequential downloads, for anything else read the file back
+        if reader is not None:
+            digest = reader.hexdigest()
+        else:
+            digest = FileUtils.hash_file(part.filename)
+        
+        # Move the file to its final name
+        filename = self._move_into_place(part.filename, path, name,
+                                         timestamp, digest)
+        part.discard()
+        if not filename:
+            return None, None   # return None if skipping
+        
+        # Return the filename and hash on success
+        return filename, digest
+    
+    # Move a complete download to its final name, following the onduplicate
+    # option. In dedup mode the data goes to the object store first, so the
+    # file ends up sharing it with every other copy of the same content.
+    # Returns the filename, or None if skipping.
+    def _move_into_place(self, source, path, name, timestamp=None,
+                         digest=None):
+        
+        # Store the data only once, else fix the file last modification time
+        if self.options.dedup and digest:
+            self._store_object(source, digest, timestamp)
+        elif timestamp:
+            self._set_file_time(source, timestamp)
+        
+        # Move the file using the appropriate method...
+        onduplicate = self.options.onduplicate
+        if onduplicate == Downloader.ON_DUPLICATE_RENAME:
+            filename = self._in_dir(path, FileUtils.move_renaming,
+                                    source, path, name)
+        else:
             filename = os.path.join(path, name)
-            
-            # ON_DUPLICATE_OVERWRITE: Always overwrite the output file
             if onduplicate == Downloader.ON_DUPLICATE_OVERWRITE:
-                FileUtils.copy_overwriting(fsrc, filename)
-        
-            # ON_DUPLICATE_SKIP: Skip download if local file exists
+                self._in_dir(path, FileUtils.move_overwriting,
+                             source, filename)
             elif onduplicate == Downloader.ON_DUPLICATE_SKIP:
                 try:
-                    FileUtils.copy_exclusive(fsrc, filename)
-                except OSError:
+                    self._in_dir(path, FileUtils.move_exclusive,
+                                 source, filename)
+                except OSError, e:
+                    if e.errno == errno.ENOENT:
+                        raise
+                    FileUtils.remove_silently(source)
                     return None     # return None if skipping
-            
-            # ON_DUPLICATE_FAIL: Fail if output file doesn't exist
             elif onduplicate == Downloader.ON_DUPLICATE_FAIL:
-                FileUtils.copy_exclusive(fsrc, filename)
-            
-            # This should never happen...
+                self._in_dir(path, FileUtils.move_exclusive, source, filename)
             else:
                 msg = "Unknown ON_DUPLICATE flag: %d"
                 msg = msg % onduplicate
                 raise AssertionError(msg)
+        return filename
+    
+    def get_object_filename(self, digest):
+        """
+        Get the object store filename for the given content hash.
         
-        # Fix the file last modification time
-        if timestamp:
-            try:
-                FileUtils.set_file_time(filename, timestamp)
+        Only used when the C{dedup} option is set. Objects live in the
+        C{.objects} folder of the target directory, sharded by the first
+        two bytes of the hash.
+        
+        @type  digest: str
+        @param digest: SHA-1 hash of the content, in hexadecimal.
+        
+        @rtype: str
+        @return: Absolute pathname to the object file.
+        """
+        return os.path.join(self._targetdir, '.objects',
+                            digest[:2], digest[2:4], digest)
+    
+    # Make sure the directory structure exists, remembering the directories
+    # already created so they're not checked again for every file
+    def _makedirs(self, path):
+        created = self._created_dirs
+        if created is None:
+            FileUtils.makedirs(path)
+        elif created.get(path) is None:
+            FileUtils.makedirs(path)
+            created.put(path, True)
+    
+    # Call a function that creates a file in the given directory, making
+    # sure the directory exists first. If it was removed after we created
+    # it, the function fails with ENOENT, so the directory is created again
+    # and the function called once more. Only used for functions that
+    # create their file before reading any data, so they can be repeated.
+    def _in_dir(self, path, func, *args, **kwargs):
+        self._makedirs(path)
+        try:
+            return func(*args, **kwargs)
+        except (IOError, OSError), e:
+            if e.errno != errno.ENOENT or self._created_dirs is None:
+                raise
+        self._created_dirs.pop(path)
+        self._makedirs(path)
+        return func(*args, **kwargs)
+    
+    # Get a temporary filename next to the given one,
+    # unique to this process and thread
+    @staticmethod
+    def _get_temp_name(filename):
+        path, name = os.path.split(filename)
+        name = '.%s.%d.%d.tmp' % (name, os.getpid(),
+                                  threading.current_thread().ident)
+        return os.path.join(path, name)
+    
+    # Set the last modification time of a file, warning on errors
+    @staticmethod
+    def _set_file_time(filename, timestamp):
+        try:
+            FileUtils.set_file_time(filename, timestamp)
+        except OSError, e:
+            warnings.warn(str(e), RuntimeWarning)
+    
+    # Put a complete file into the object store. If the content was already
+    # there, the file is replaced with a link to the stored object, else the
+    # object becomes a link to the file.
+    #
+    # Hard linked copies share their modification time, so the object keeps
+    # the oldest timestamp of its copies. This way the usefstimes option may
+    # download a copy again when it didn't change, but never skips one that
+    # did change.
+    def _store_object(self, filename, digest, timestamp=None):
+        objname = self.get_object_filename(digest)
+        if os.path.exists(objname):
+            tmpname = self._get_temp_name(filename)
+            FileUtils.remove_silently(tmpname)
+            try:
+                FileUtils.link_file(objname, tmpname)
+                FileUtils.move_overwriting(tmpname, filename)
+            finally:
+                FileUtils.remove_silently(tmpname)
+            if timestamp:
+                current = FileUtils.get_file_time(objname)
+                if current is None or current > timestamp:
+                    self._set_file_time(objname, timestamp)
+        else:
+            if timestamp:
+                self._set_file_time(filename, timestamp)
+            tmpname = self._get_temp_name(objname)
+            FileUtils.remove_silently(tmpname)
+            try:
+                self._in_dir(os.path.dirname(objname), FileUtils.link_file,
+                             filename, tmpname)
+                FileUtils.move_overwriting(tmpname, objname)
+            finally:
+                FileUtils.remove_silently(tmpname)
+    
+    # Download one range of a segmented download in a separate connection.
+    # Errors are appended to the given list.
+    def _download_range(self, part, rng, errors):
+        try:
+            headers = {
+                'User-Agent' : self.USER_AGENT,
+                'Range'      : part._format_range(*rng),
+                'If-Range'   : part.validator,
+            }
+            req = urllib2.Request(part.location, headers=headers)
+            fsrc = self._urlopener.open(req)
+            try:
+                if fsrc.getcode() != 206:
+                    raise IOError("Server refused range request for %s" %
+                                  part.location)
+                content_range = fsrc.info().get('Content-Range', '')
+                if not re.match(r'^\s*bytes\s+%d-%d/' % tuple(rng),
+                                content_range):
+                    raise IOError("Unexpected Content-Range: %r" %
+                                  content_range)
+                with open(part.filename, 'r+b') as fdst:
+                    part.copy_range(fsrc, fdst, rng, self._copier)
+            finally:
+                fsrc.close()
+        except Exception, e:
+            errors.append(e)
+    
+    # Save an open URL into a temporary file and then into the object store,
+    # for the dedup mode. The target file is never written in place, since
+    # it may be a link to an object shared with other files. Small responses
+    # are hashed in memory first, and not written at all if the object
+    # store already has them. Returns the filename, or None if skipping.
+    def _download_to_store(self, reader, path, name, timestamp=None,
+                           length=None):
+        self._makedirs(path)
+        tmpname = self._get_temp_name(os.path.join(path, name))
+        try:
+            FileUtils.remove_silently(tmpname)
+            if length is not None and length <= self._max_in_mem_dedup:
+                data = []
+                remaining = length
+                while remaining > 0:
+                    chunk = reader.read(remaining)
+                    if not chunk:
+                        break
+                    data.append(chunk)
+                    remaining = remaining - len(chunk)
+                digest = reader.hexdigest()
+                objname = self.get_object_filename(digest)
+                linked = False
+                if os.path.exists(objname):
+                    try:
+                        FileUtils.link_file(objname, tmpname)
+                        linked = True
+                    except (IOError, OSError):
+                        FileUtils.remove_silently(tmpname)
+                if not linked:
+                    def write():
+                        with open(tmpname, 'wb') as fdst:
+                            fdst.write(''.join(data))
+                    self._in_dir(path, write)
+            else:
+                self._in_dir(path, FileUtils.copy_overwriting,
+                             reader, tmpname, self._copier, length)
+                digest = reader.hexdigest()
+            return self._move_into_place(tmpname, path, name, timestamp,
+                                         digest)
+        finally:
+            FileUtils.remove_silently(tmpname)
+    
+    # Save an open URL into a local file
+    def _download_to_file(self, fsrc, path, name, timestamp=None,
+                          length=None):
+        
+        # Download the file using the appropriate method, making sure the
+        # directory structure exists...
+        onduplicate = self.options.onduplicate
+        copier = self._copier
+        
+        # ON_DUPLICATE_RENAME: Rename the output file automatically
+        if onduplicate == Downloader.ON_DUPLICATE_RENAME:
+            filename = self._in_dir(path, FileUtils.copy_renaming,
+                                    fsrc, path, name, copier, length)
+        else:
+            
+            # Calculate the output filename
+            filename = os.path.join(path, name)
+            
+            # ON_DUPLICATE_OVERWRITE: Always overwrite the output file
+            if onduplicate == Downloader.ON_DUPLICATE_OVERWRITE:
+                self._in_dir(path, FileUtils.copy_overwriting,
+                             fsrc, filename, copier, length)
+        
+            # ON_DUPLICATE_SKIP: Skip download if local file exists
+            elif onduplicate == Downloader.ON_DUPLICATE_SKIP:
+                try:
+                    self._in_dir(path, FileUtils.copy_exclusive,
+                                 fsrc, filename, copier, length)
+                except OSError, e:
+                    if e.errno == errno.ENOENT:
+                        raise
+                    return None     # return None if skipping
+            
+            # ON_DUPLICATE_FAIL: Fail if output file doesn't exist
+            elif onduplicate == Downloader.ON_DUPLICATE_FAIL:
+                self._in_dir(path, FileUtils.copy_exclusive,
+                             fsrc, filename, copier, length)
+            
+            # This should never happen...
+            else:
+                msg = "Unknown ON_DUPLICATE flag: %d"
+                msg = msg % onduplicate
+                raise AssertionError(msg)
+        
+        # Fix the file last modification time
+        if timestamp:
+            try:
+                FileUtils.set_file_time(filename, timestamp)
             except OSError, e:
-                warning.warn(str(e), RuntimeWarning)
+                warnings.warn(str(e), RuntimeWarning)
         
         # Return the filename on success
         return filename
@@ -1106,6 +3577,13 @@ class Downloader(Configurable, HookChain):
             This is forbidden for security reasons.
         """
         
+        # Look it up in the cache first
+        cache = self._name_cache
+        if cache is not None:
+            result = cache.get(url)
+            if result is not None:
+                return result
+        
         # Parse the URL into its components
         parts = urlparse.urlparse(url)
         
@@ -1141,12 +3619,9 @@ class Downloader(Configurable, HookChain):
             # Prepend the target directory to the local path
             path = os.path.join(self._targetdir, host, path)
             
-            # Make it absolute, resolving symlinks
-            path = os.path.realpath(path)
-            
+            # Make it absolute, resolving symlinks.
             # I want it to end with a / always (just in case)
-            if not path.endswith(os.path.sep):
-                path = path + os.path.sep
+            path = self._resolve_path(path)
             
             # The resulting path can't be outside the target directory
             # TODO: an option to disable this security check?
@@ -1155,326 +3630,3462 @@ class Downloader(Configurable, HookChain):
                 msg = msg % (path, self._targetdir)
                 raise IOError(msg)
         
-        # Return the local path and filename
-        return path, name
+        # Return the local path and filename
+        result = (path, name)
+        if cache is not None:
+            cache.put(url, result)
+        return result
+    
+    # Make a local path absolute, resolving symlinks, and make it end with
+    # a path separator. Many files share the same directory, so the result
+    # is cached to avoid resolving the same symlinks over and over.
+    def _resolve_path(self, path):
+        cache = self._path_cache
+        if cache is not None:
+            resolved = cache.get(path)
+            if resolved is not None:
+                return resolved
+        resolved = os.path.realpath(path)
+        if not resolved.endswith(os.path.sep):
+            resolved = resolved + os.path.sep
+        if cache is not None:
+            cache.put(path, resolved)
+        return resolved
+
+#-----------------------------------------------------------------------------#
+
+class AsyncDownloader(Downloader):
+    """
+    Downloader that runs its HTTP requests from a single event loop thread,
+    so thousands of them can be in flight at once.
+    
+    L{download} has the same contract as in L{Downloader}: it blocks until
+    the download is done, and may be called from many threads at the same
+    time. L{submit} queues a download and returns right away, with a
+    L{Transfer} object to wait on.
+    
+    Hooks are called with the same arguments as in L{Downloader}. The
+    C{filter_request} phase runs in the thread calling L{submit}. The rest
+    of the phases, DNS lookups and file writes run in a small pool of worker
+    threads, so the event loop never blocks. All the work for one download
+    is done by the same worker, in order.
+    
+    The number of requests in flight is limited globally and per host, and
+    L{submit} blocks when too many downloads are queued. Reading from a
+    connection is paused while too much of its data is waiting to be
+    written, so slow disks slow down the downloads instead of filling the
+    memory.
+    
+    Connections are kept alive and reused like in L{Downloader}. Partial
+    files and the copy engine options are not used. HTTPS URLs are
+    downloaded with the blocking code from L{Downloader}, in a worker thread.
+    
+    Every address of a host is tried in turn until one of them accepts the
+    connection, and the addresses are cached for L{dns_ttl} seconds,
+    starting with the one that worked last.
+    
+    This class only works on POSIX systems, since the event loop is woken
+    up through a pipe.
+    
+    @type dns_ttl: float
+    @cvar dns_ttl: Time in seconds to cache the addresses of a host.
+    """
+    
+    class _OptionsSiteMirrorMode(Downloader._OptionsSiteMirrorMode):
+        """
+        Set of options for L{AsyncDownloader} to work in site mirror mode.
+        """
+        
+        def __init__(self):
+            Downloader._OptionsSiteMirrorMode.__init__(self)
+            self.maxconnections = 1000
+            self.maxperhost = 8
+            self.maxqueued = 10000
+            self.timeout = 30.0
+            self.workers = 4
+            self.maxbuffered = 1024 * 1024
+    
+    class _OptionsDownloadManagerMode(Downloader._OptionsDownloadManagerMode):
+        """
+        Set of options for L{AsyncDownloader} to work in download manager
+        mode.
+        """
+        
+        def __init__(self):
+            Downloader._OptionsDownloadManagerMode.__init__(self)
+            self.maxconnections = 1000
+            self.maxperhost = 8
+            self.maxqueued = 10000
+            self.timeout = 30.0
+            self.workers = 4
+            self.maxbuffered = 1024 * 1024
+    
+    class _DefaultOptions(_OptionsDownloadManagerMode):
+        """
+        Default options for L{AsyncDownloader}.
+        """
+    
+    # Maximum number of redirections to follow, as in urllib2
+    max_redirections = urllib2.HTTPRedirectHandler.max_redirections
+    
+    # Maximum number of times to visit the same URL while redirecting
+    max_repeats = urllib2.HTTPRedirectHandler.max_repeats
+    
+    # Seconds between checks for timed out connections
+    _check_interval = 0.5
+    
+    # Seconds to cache the addresses of a host
+    dns_ttl = 300.0
+    
+    # Block size for decoding compressed data
+    bufsize = 64 * 1024
+    
+    class Transfer(object):
+        """
+        Download queued in an L{AsyncDownloader}.
+        
+        @type url: str
+        @ivar url: URL to download.
+        
+        @type referer: str
+        @ivar referer: Referer URL.
+        """
+        
+        def __init__(self, url, referer, callback):
+            self.url          = url
+            self.referer      = referer
+            self._callback    = callback
+            self._event       = threading.Event()
+            self._result      = None
+            self._error       = None
+            self._done        = False   # True once completed
+            self._lock        = threading.Lock()
+            self._queue       = None    # worker queue for this transfer
+            self._req         = None    # current urllib2 request
+            self._hostkey     = None    # (host, port) of the request
+            self._active      = False   # True while counted as in flight
+            self._conn        = None    # connection in use
+            self._retried     = False   # True if retried on a new connection
+            self._redirects   = {}      # URLs visited while redirecting
+            self._response    = None
+            self._path        = None
+            self._name        = None
+            self._lastupdated = None
+            self._timestamp   = None
+            self._tmpname     = None
+            self._file        = None
+            self._decoder     = None
+            self._encoding    = None
+            self._hash        = None
+            self._size        = 0
+            self._encoded_size = 0
+            self._buffered    = 0       # bytes read but not written yet
+            self._paused      = False   # True while reading is paused
+        
+        def done(self):
+            """
+            @rtype: bool
+            @return: C{True} if the download is finished.
+            """
+            return self._event.is_set()
+        
+        def wait(self, timeout=None):
+            """
+            Wait until the download is finished.
+            
+            @type  timeout: float
+            @param timeout: Optional, maximum time to wait in seconds.
+            
+            @rtype: bool
+            @return: C{True} if the download is finished.
+            """
+            self._event.wait(timeout)
+            return self._event.is_set()
+        
+        def result(self, timeout=None):
+            """
+            Wait until the download is finished and get its result.
+            
+            @type  timeout: float
+            @param timeout: Optional, maximum time to wait in seconds.
+            
+            @rtype: Resource or None
+            @return: The same as L{Downloader.download} would return.
+            
+            @raise socket.timeout: The download is not finished yet.
+            @raise Exception: The exception L{Downloader.download} would
+                raise, if the download failed.
+            """
+            if not self.wait(timeout):
+                raise socket.timeout("Download not finished: %s" % self.url)
+            if self._error is not None:
+                raise self._error[0], self._error[1], self._error[2]
+            return self._result
+    
+    class _Response(object):
+        """
+        Response headers in the shape of the file-like objects returned by
+        C{urllib2}, to be given to the hooks and the cookie jar.
+        """
+        
+        def __init__(self, url, code, msg, headers):
+            self.url     = url
+            self.code    = code
+            self.msg     = msg
+            self.headers = headers
+        
+        def info(self):
+            return self.headers
+        
+        def geturl(self):
+            return self.url
+        
+        def getcode(self):
+            return self.code
+    
+    class _Waker(asyncore.file_dispatcher):
+        """
+        Read end of a pipe used to wake up the event loop.
+        """
+        
+        def writable(self):
+            return False
+        
+        def handle_read(self):
+            try:
+                self.recv(4096)
+            except OSError:
+                pass
+        
+        def handle_close(self):
+            pass
+    
+    class _Connection(asyncore.dispatcher, object):
+        """
+        HTTP/1.1 client connection driven by the event loop. Parses the
+        responses and hands the headers and body data to the downloader.
+        
+        It derives from C{object} too, since C{asyncore.dispatcher} is an
+        old style class and would forward hashing to the socket.
+        """
+        
+        # Read block size
+        bufsize = 64 * 1024
+        
+        # Maximum size of the response headers
+        maxheaders = 64 * 1024
+        
+        def __init__(self, dwn, hostkey, map):
+            asyncore.dispatcher.__init__(self, map=map)
+            self.dwn        = dwn
+            self.hostkey    = hostkey
+            self.transfer   = None
+            self.addresses  = None      # the one in use first, then the rest
+            self.tries      = 0         # addresses left to try, this one too
+            self.reused     = False     # True if used for a previous request
+            self.received   = False     # True once some response data came
+            self.will_close = False
+            self.created    = time.time()
+            self.activity   = self.created
+            self._out       = ''
+            self._in        = ''
+            self._state     = None
+            self._remaining = 0         # body or chunk bytes left
+            self._discard   = False     # True to ignore the body
+        
+        def start(self, transfer, data):
+            """
+            Send a request on this connection.
+            
+            @type  transfer: L{AsyncDownloader.Transfer}
+            @param transfer: Download the request belongs to.
+            
+            @type  data: str
+            @param data: Raw HTTP request.
+            """
+            self.transfer = transfer
+            self.received = False
+            self.activity = time.time()
+            self._out     = data
+            self._in      = ''
+            self._state   = 'head'
+        
+        def detach(self):
+            """
+            Forget the current request, to keep the connection idle.
+            """
+            self.transfer = None
+            self.reused   = True
+            self.activity = time.time()
+            self._state   = None
+        
+        def readable(self):
+            transfer = self.transfer
+            if transfer is None:
+                return self.connected   # detect when the server hangs up
+            return not transfer._paused
+        
+        def writable(self):
+            return bool(self._out) or not self.connected
+        
+        def handle_connect(self):
+            self.dwn._on_connect(self)
+        
+        def handle_write(self):
+            sent = self.send(self._out[:self.bufsize])
+            self._out = self._out[sent:]
+            self.activity = time.time()
+        
+        def handle_read(self):
+            data = self.recv(self.bufsize)
+            if data:
+                if self.transfer is None:
+                    self.handle_close()     # nobody asked for this
+                    return
+                self.received = True
+                self.activity = time.time()
+                self._parse(data)
+        
+        def handle_close(self):
+            self.dwn._connection_closed(self)
+        
+        def handle_error(self):
+            self.dwn._connection_failed(self, sys.exc_info())
+        
+        # Feed response data to the parser
+        def _parse(self, data):
+            while data and self.transfer is not None:
+                state = self._state
+                if state in ('body', 'chunk'):
+                    if self._remaining is None:     # until the server closes
+                        piece, data = data, ''
+                    else:
+                        piece = data[:self._remaining]
+                        data  = data[len(piece):]
+                        self._remaining = self._remaining - len(piece)
+                    if not self._discard:
+                        self.dwn._on_body(self.transfer, piece)
+                    if self._remaining == 0:
+                        if state == 'body':
+                            self._end()
+                        else:
+                            self._state = 'chunkend'
+                    continue
+                self._in = self._in + data
+                data = ''
+                if state == 'head':
+                    index = self._in.find('\r\n\r\n')
+                    if index < 0:
+                        if len(self._in) > self.maxheaders:
+                            raise httplib.LineTooLong("header line")
+                        return
+                    head, data = self._in[:index + 2], self._in[index + 4:]
+                    self._in = ''
+                    self._parse_head(head)
+                else:
+                    index = self._in.find('\n')
+                    if index < 0:
+                        if len(self._in) > self.maxheaders:
+                            raise httplib.LineTooLong("chunk size")
+                        return
+                    line, data = self._in[:index], self._in[index + 1:]
+                    self._in = ''
+                    if state == 'chunksize':
+                        try:
+                            size = int(line.split(';', 1)[0], 16)
+                        except ValueError:
+                            raise httplib.IncompleteRead(line)
+                        if size:
+                            self._state = 'chunk'
+                            self._remaining = size
+                        else:
+                            self._state = 'trailer'
+                    elif state == 'chunkend':
+                        self._state = 'chunksize'
+                    elif state == 'trailer':
+                        if not line.strip():
+                            self._end()
+                    else:
+                        raise httplib.BadStatusLine(line)
+        
+        # Parse the status line and headers of a response
+        def _parse_head(self, head):
+            status_line, head = head.split('\r\n', 1)
+            try:
+                version, status, reason = (status_line.split(None, 2) +
+                                           [''])[:3]
+                status = int(status)
+            except ValueError:
+                raise httplib.BadStatusLine(status_line)
+            if not version.startswith('HTTP/') or not 100 <= status <= 999:
+                raise httplib.BadStatusLine(status_line)
+            if 100 <= status < 200:
+                self._state = 'head'    # wait for the real response
+                return
+            msg = httplib.HTTPMessage(StringIO.StringIO(head + '\r\n'), 0)
+            reason = reason.strip()
+            
+            # Decide whether the connection can be reused afterwards
+            conn = msg.getheader('connection', '').lower()
+            if version == 'HTTP/1.0':
+                self.will_close = 'keep-alive' not in conn
+            else:
+                self.will_close = 'close' in conn
+            
+            # Find out how the body is delimited
+            method = self.transfer._req.get_method()
+            length = msg.getheader('content-length')
+            if method == 'HEAD' or status in (204, 304):
+                self._state, self._remaining = 'body', 0
+            elif 'chunked' in msg.getheader('transfer-encoding', '').lower():
+                self._state = 'chunksize'
+            elif length and length.strip().isdigit():
+                self._state, self._remaining = 'body', int(length)
+            else:
+                self._state, self._remaining = 'body', None
+                self.will_close = True
+            
+            # Give the headers to the downloader
+            self._discard = not self.dwn._on_headers(self, status, reason, msg)
+            if self._state == 'body' and self._remaining == 0:
+                self._end()
+        
+        # The response body is complete
+        def _end(self):
+            self._state = 'done'
+            self.dwn._on_end(self)
+    
+    def __init__(self, options=None, cookiejar=None, hooks=None):
+        """
+        @type  options: Options
+        @param options: Optional, configuration.
+        
+        @type  cookiejar: cookielib.CookieJar
+        @param cookiejar: Optional, HTTP cookie jar.
+        
+        @type  hooks: list(L{Hook})
+        @param hooks: Hook chain in order of execution.
+            All requests and responses will be filtered by these hooks in the
+            given order.
+        
+        @raise NotImplementedError: This is not a POSIX system.
+        """
+        if fcntl is None:
+            raise NotImplementedError(
+                "AsyncDownloader is only supported on POSIX systems")
+        Downloader.__init__(self, options, cookiejar, hooks)
+        self._lock     = threading.Lock()
+        self._slots    = threading.Semaphore(self.options.maxqueued)
+        self._ids      = itertools.count()
+        self._thread   = None       # event loop thread
+        self._workers  = []         # worker threads
+        self._queues   = []         # worker job queues
+        self._commands = collections.deque()
+        self._map      = {}         # asyncore socket map
+        self._wakefd   = None       # write end of the waker pipe
+        self._closing  = False
+        self._queued   = collections.OrderedDict()  # host -> transfers
+        self._inflight = {}         # host -> number of transfers in flight
+        self._ninflight = 0
+        self._idle     = {}         # host -> idle connections
+        self._conns    = set()      # all open connections
+        self._dns      = {}         # host -> (expiration, addresses)
+        self._next_check = 0
+    
+    def submit(self, url, referer=None, callback=None):
+        """
+        Queue the download of the resource pointed to by the given URL.
+        Blocks if the C{maxqueued} option limit is reached, until some of
+        the queued downloads are finished.
+        
+        @type  url: str
+        @param url: Resource URL. Only "http://" and "https://" are supported.
+        
+        @type  referer: str
+        @param referer: Referer URL, as in the C{Referer} HTTP header.
+        
+        @type  callback: callable
+        @param callback: Optional, function to call with the
+            L{AsyncDownloader.Transfer} object when it's finished.
+            It's called from a worker thread, so it should not block.
+        
+        @rtype: L{AsyncDownloader.Transfer}
+        @return: Object to wait on for the result of the download.
+        """
+        self._start()
+        transfer = self.Transfer(url, referer, callback)
+        transfer._queue = self._queues[next(self._ids) % len(self._queues)]
+        self._slots.acquire()
+        try:
+            if urlparse.urlsplit(url).scheme.lower() != 'http':
+                self._post(transfer, self._download_blocking)
+                return transfer
+            prepared = self._prepare_request(url, referer)
+            if prepared is None:
+                self._post(transfer, self._complete)
+                return transfer
+            (transfer.url, transfer._req, transfer._path, transfer._name,
+             transfer._lastupdated) = prepared
+        except Exception:
+            self._post(transfer, self._complete, None, sys.exc_info())
+            return transfer
+        self._call_in_loop(self._enqueue, transfer)
+        return transfer
+    
+    def download(self, url, referer=None):
+        """
+        Download the resource pointed to by the given URL.
+        
+        @see: L{Downloader.download}
+        
+        @type  url: str
+        @param url: Resource URL. Only "http://" and "https://" are supported.
+        
+        @type  referer: str
+        @param referer: Referer URL, as in the C{Referer} HTTP header.
+        
+        @rtype: Resource or None
+        @return:
+            If the download is successful, this method returns a L{Resource}
+            instance describing it. If the download is skipped due to hooks or
+            configuration settings, C{None} is returned instead.
+        
+        @raise urllib2.HTTPError: Protocol or network error.
+        @raise os.OSError: System error while writing the downloaded data.
+        """
+        return self.submit(url, referer).result()
+    
+    def close(self):
+        """
+        Stop the event loop and the worker threads, and close all
+        connections. Downloads still in progress fail with C{socket.error}.
+        The downloader may still be used after calling this method.
+        """
+        with self._lock:
+            thread, self._thread = self._thread, None
+            workers, self._workers = self._workers, []
+            queues = self._queues
+        if thread is not None:
+            self._call_in_loop(self._shutdown)
+            thread.join()
+            for queue in queues:
+                queue.put(None)
+            for worker in workers:
+                worker.join()
+            os.close(self._wakefd)
+            self._wakefd = None
+        Downloader.close(self)
+    
+    # Start the event loop and worker threads, if not running yet
+    def _start(self):
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._closing = False
+            self._commands.clear()
+            self._queued.clear()
+            self._inflight.clear()
+            self._ninflight = 0
+            self._idle.clear()
+            self._conns.clear()
+            self._map = {}
+            rfd, self._wakefd = os.pipe()
+            fcntl.fcntl(self._wakefd, fcntl.F_SETFL, os.O_NONBLOCK)
+            self._Waker(rfd, self._map)
+            os.close(rfd)       # the dispatcher has its own copy
+            self._queues = []
+            self._workers = []
+            for _ in xrange(max(1, self.options.workers)):
+                queue = Queue.Queue()
+                worker = threading.Thread(target=self._run_worker,
+                                          args=(queue,))
+                worker.daemon = True
+                worker.start()
+                self._queues.append(queue)
+                self._workers.append(worker)
+            self._thread = threading.Thread(target=self._run_loop)
+            self._thread.daemon = True
+            self._thread.start()
+    
+    # Run a function in the event loop thread
+    def _call_in_loop(self, function, *args):
+        self._commands.append((function, args))
+        try:
+            os.write(self._wakefd, 'x')
+        except (OSError, TypeError):
+            pass        # the pipe is full, or the loop is gone
+    
+    # Run a function in the worker thread of a transfer
+    def _post(self, transfer, function, *args):
+        transfer._queue.put((transfer, function, args))
+    
+    def _run_loop(self):
+        map = self._map
+        commands = self._commands
+        try:
+            while not self._closing:
+                while commands:
+                    function, args = commands.popleft()
+                    try:
+                        function(*args)
+                    except Exception:
+                        warnings.warn(traceback.format_exc(), RuntimeWarning)
+                self._start_queued()
+                asyncore.loop(self._check_interval, True, map, 1)
+                now = time.time()
+                if now >= self._next_check:
+                    self._next_check = now + self._check_interval
+                    self._check_timeouts(now)
+        finally:
+            for channel in map.values():
+                channel.close()
+            map.clear()
+    
+    def _run_worker(self, queue):
+        while True:
+            job = queue.get()
+            if job is None:
+                break
+            transfer, function, args = job
+            try:
+                function(transfer, *args)
+            except Exception:
+                self._complete(transfer, None, sys.exc_info())
+                self._call_in_loop(self._abort, transfer)
+    
+    # Fail all the downloads and stop the event loop
+    def _shutdown(self):
+        error = socket.error("Downloader closed")
+        queued, self._queued = self._queued, collections.OrderedDict()
+        for transfers in queued.itervalues():
+            for transfer in transfers:
+                self._fail(transfer, error)
+        for conn in list(self._conns):
+            if conn.transfer is not None:
+                self._fail(conn.transfer, error)
+            self._drop(conn)
+        self._idle.clear()
+        self._closing = True
+    
+    # Queue a transfer to be started when there's room for it
+    def _enqueue(self, transfer, first=False):
+        if self._closing:
+            self._fail(transfer, socket.error("Downloader closed"))
+            return
+        host, port = urllib2.splitport(transfer._req.get_host())
+        transfer._hostkey = (host.lower(), int(port or httplib.HTTP_PORT))
+        queue = self._queued.get(transfer._hostkey)
+        if queue is None:
+            queue = self._queued[transfer._hostkey] = collections.deque()
+        if first:
+            queue.appendleft(transfer)
+        else:
+            queue.append(transfer)
+    
+    # Start as many queued transfers as the limits allow
+    def _start_queued(self):
+        maxconnections = self.options.maxconnections
+        maxperhost = self.options.maxperhost
+        if not self._queued or self._ninflight >= maxconnections:
+            return
+        inflight = self._inflight
+        for hostkey, queue in self._queued.items():
+            while queue and inflight.get(hostkey, 0) < maxperhost:
+                if self._ninflight >= maxconnections:
+                    return
+                transfer = queue.popleft()
+                transfer._active = True
+                inflight[hostkey] = inflight.get(hostkey, 0) + 1
+                self._ninflight = self._ninflight + 1
+                self._start_transfer(transfer)
+            if not queue:
+                del self._queued[hostkey]
+    
+    # The transfer no longer counts as in flight
+    def _deactivate(self, transfer):
+        if transfer._active:
+            transfer._active = False
+            hostkey = transfer._hostkey
+            count = self._inflight[hostkey] - 1
+            if count:
+                self._inflight[hostkey] = count
+            else:
+                del self._inflight[hostkey]
+            self._ninflight = self._ninflight - 1
+    
+    # Send the request of a transfer, on an idle connection if possible
+    def _start_transfer(self, transfer):
+        timings = transfer._req.timings
+        if timings.start is None:
+            timings.begin()
+        hostkey = transfer._hostkey
+        idle = self._idle.get(hostkey)
+        if idle:
+            conn = idle.pop()
+            if not idle:
+                del self._idle[hostkey]
+            self._send_request(conn, transfer)
+        else:
+            cached = self._dns.get(hostkey)
+            if cached is not None and cached[0] > time.time():
+                self._connect(transfer, cached[1])
+            else:
+                self._post(transfer, self._resolve)
+    
+    # Resolve the host name of a transfer (worker thread)
+    def _resolve(self, transfer):
+        host, port = transfer._hostkey
+        start = time.time()
+        addresses = [(family, sockaddr) for family, _, _, _, sockaddr
+                     in socket.getaddrinfo(host, port, 0, socket.SOCK_STREAM)]
+        transfer._req.timings.add('dns', time.time() - start)
+        if not addresses:
+            raise socket.error("getaddrinfo returns an empty list")
+        self._call_in_loop(self._resolved, transfer, addresses)
+    
+    def _resolved(self, transfer, addresses):
+        self._dns[transfer._hostkey] = (time.time() + self.dns_ttl, addresses)
+        if not transfer._done:
+            self._connect(transfer, addresses)
+    
+    # Open a new connection for a transfer to the first of the addresses,
+    # the rest are tried in turn if it fails
+    def _connect(self, transfer, addresses, tries = None):
+        family, sockaddr = addresses[0]
+        conn = self._Connection(self, transfer._hostkey, self._map)
+        conn.addresses = addresses
+        conn.tries = len(addresses) if tries is None else tries
+        conn.create_socket(family, socket.SOCK_STREAM)
+        conn.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self._conns.add(conn)
+        self._send_request(conn, transfer)
+        try:
+            conn.connect(sockaddr)
+        except socket.error, e:
+            self._connection_failed(conn, e)
+    
+    # Called by a new connection once it's established. The address that
+    # worked is tried first from now on.
+    def _on_connect(self, conn):
+        if conn.addresses is not None:
+            self._dns[conn.hostkey] = (time.time() + self.dns_ttl,
+                                       conn.addresses)
+        transfer = conn.transfer
+        if transfer is not None:
+            transfer._req.timings.add('connect', time.time() - conn.created)
+    
+    # Build the raw HTTP request for a transfer and send it
+    def _send_request(self, conn, transfer):
+        req = transfer._req
+        self._cookiejar.add_cookie_header(req)
+        headers = dict(req.unredirected_hdrs)
+        headers.update(req.headers)
+        headers.setdefault('Host', req.get_host())
+        lines = ['%s %s HTTP/1.1' % (req.get_method(), req.get_selector())]
+        lines.extend('%s: %s' % item for item in headers.iteritems())
+        lines.extend(('', ''))
+        transfer._conn = conn
+        conn.start(transfer, '\r\n'.join(lines))
+    
+    # Called by the connection when the response headers arrive.
+    # Returns True to pass the body on, False to discard it.
+    def _on_headers(self, conn, status, reason, msg):
+        transfer = conn.transfer
+        req = transfer._req
+        req.timings.end_headers()
+        response = self._Response(req.get_full_url(), status, reason, msg)
+        transfer._response = response
+        self._cookiejar.extract_cookies(response, req)
+        if 200 <= status < 300:
+            self._post(transfer, self._process_response, response)
+            return True
+        return False
+    
+    # Called by the connection with each piece of the response body
+    def _on_body(self, transfer, data):
+        with transfer._lock:
+            transfer._buffered = transfer._buffered + len(data)
+            if transfer._buffered > self.options.maxbuffered:
+                transfer._paused = True
+        self._post(transfer, self._write, data)
+    
+    # Called by the connection when the response is complete
+    def _on_end(self, conn):
+        transfer = conn.transfer
+        self._release(conn)
+        response = transfer._response
+        status = response.code
+        if 200 <= status < 300:
+            self._post(transfer, self._finish_body)
+            return
+        location = None
+        if status in (301, 302, 303, 307):
+            location = response.headers.getheader('location') or \
+                       response.headers.getheader('uri')
+        if location:
+            self._post(transfer, self._follow_redirect, location)
+        elif status == 304:
+            self._post(transfer, self._finish_not_modified)
+        else:
+            error = urllib2.HTTPError(response.url, status, response.msg,
+                                      response.headers, None)
+            self._post(transfer, self._complete, None, (type(error),
+                                                        error, None))
+    
+    # Take a connection away from its transfer, and keep it if possible
+    def _release(self, conn):
+        transfer = conn.transfer
+        if transfer is not None:
+            transfer._conn = None
+            self._deactivate(transfer)
+        if conn.will_close or not conn.connected or \
+                self.options.poolsize <= 0:
+            self._drop(conn)
+            return
+        idle = self._idle.setdefault(conn.hostkey, [])
+        if len(idle) >= self.options.poolsize:
+            self._drop(conn)
+        else:
+            conn.detach()
+            idle.append(conn)
+    
+    # Close a connection and forget about it
+    def _drop(self, conn):
+        idle = self._idle.get(conn.hostkey)
+        if idle and conn in idle:
+            idle.remove(conn)
+            if not idle:
+                del self._idle[conn.hostkey]
+        self._conns.discard(conn)
+        conn.close()
+    
+    # Called by the connection when the server hangs up
+    def _connection_closed(self, conn):
+        transfer = conn.transfer
+        if transfer is None:
+            self._drop(conn)
+        elif conn._state == 'body' and conn._remaining is None:
+            conn.will_close = True
+            conn._end()     # the body ends with the connection
+        elif conn.reused and not conn.received and not transfer._retried:
+            
+            # The server closed an idle connection just as we reused it,
+            # try again once on a new connection
+            transfer._retried = True
+            transfer._conn = None
+            self._deactivate(transfer)
+            self._drop(conn)
+            self._enqueue(transfer, first=True)
+        elif not conn.connected:
+            try:
+                code = conn.socket.getsockopt(socket.SOL_SOCKET,
+                                              socket.SO_ERROR)
+            except socket.error:
+                code = 0
+            code = code or errno.ECONNREFUSED
+            error = socket.error(code, os.strerror(code))
+            self._connection_failed(conn, error)
+        elif not conn.received:
+            self._connection_failed(conn, httplib.BadStatusLine(''))
+        else:
+            self._connection_failed(conn, httplib.IncompleteRead(''))
+    
+    # Called by the connection on errors. Like in urllib2, socket errors
+    # before the response arrives are reported as URLError. If the
+    # connection couldn't be established, the addresses of the host are
+    # resolved again next time, and the next address is tried now.
+    def _connection_failed(self, conn, error):
+        transfer = conn.transfer
+        connected = conn.connected
+        self._drop(conn)
+        if not connected:
+            self._dns.pop(conn.hostkey, None)
+            if transfer is not None and not transfer._done and \
+                                                    conn.tries > 1:
+                addresses = conn.addresses[1:] + conn.addresses[:1]
+                self._connect(transfer, addresses, conn.tries - 1)
+                return
+        if transfer is not None:
+            if isinstance(error, tuple):
+                error = error[1]
+            if not conn.received and isinstance(error, socket.error):
+                error = urllib2.URLError(error)
+            transfer._conn = None
+            self._deactivate(transfer)
+            self._fail(transfer, error)
+    
+    # Close the connection of a transfer that failed or was skipped
+    def _abort(self, transfer):
+        conn = transfer._conn
+        transfer._conn = None
+        self._deactivate(transfer)
+        if conn is not None:
+            self._drop(conn)
+    
+    # Fail a transfer with the given exception or exc_info tuple
+    def _fail(self, transfer, error):
+        if not isinstance(error, tuple):
+            error = (type(error), error, None)
+        self._deactivate(transfer)
+        self._post(transfer, self._complete, None, error)
+    
+    def _check_timeouts(self, now):
+        timeout = self.options.timeout
+        idletimeout = self.options.poolidletimeout
+        for conn in list(self._conns):
+            if conn.transfer is not None:
+                if timeout and now - conn.activity > timeout:
+                    self._connection_failed(conn, socket.timeout("timed out"))
+            elif now - conn.activity > idletimeout:
+                self._drop(conn)
+    
+    # Decide where to save a response and open a temporary file for it
+    # (worker thread)
+    def _process_response(self, transfer, response):
+        if transfer._done:
+            return
+        checked = self._check_response(transfer._req, response,
+                                       transfer._lastupdated)
+        if checked is None:
+            self._complete(transfer)
+            self._call_in_loop(self._abort, transfer)
+            return
+        transfer._path, transfer._name, timestamp = checked
+        transfer._timestamp = timestamp or time.time()
+        headers = response.info()
+        encoding = HttpUtils.get_content_encoding(headers)
+        if encoding and not self.options.storecompressed and \
+                encoding in HttpUtils.content_encodings:
+            transfer._decoder = self._ContentDecoder(encoding)
+            encoding = None
+        transfer._encoding = encoding
+        transfer._hash = hashlib.sha1()
+        fd, transfer._tmpname = self._in_dir(transfer._path, tempfile.mkstemp,
+                    prefix = '.%s.' % transfer._name, suffix = '.tmp',
+                    dir = transfer._path)
+        transfer._file = os.fdopen(fd, 'wb')
+    
+    # Write a piece of the response body (worker thread)
+    def _write(self, transfer, data):
+        try:
+            fdst = transfer._file
+            if fdst is not None and not transfer._done:
+                transfer._encoded_size = transfer._encoded_size + len(data)
+                decoder = transfer._decoder
+                if decoder is None:
+                    self._write_decoded(transfer, data)
+                else:
+                    decoder.feed(data)
+                    while decoder.pending or decoder.held:
+                        pending = decoder.pending
+                        decoded = decoder.decode(self.bufsize)
+                        self._write_decoded(transfer, decoded)
+                        if not decoded and decoder.pending == pending:
+                            break
+        finally:
+            with transfer._lock:
+                transfer._buffered = transfer._buffered - len(data)
+                resume = transfer._paused and \
+                         transfer._buffered <= self.options.maxbuffered // 2
+                if resume:
+                    transfer._paused = False
+            if resume:
+                self._call_in_loop(lambda: None)    # poll the socket again
+    
+    def _write_decoded(self, transfer, data):
+        if data:
+            transfer._hash.update(data)
+            transfer._size = transfer._size + len(data)
+            transfer._file.write(data)
+    
+    # Close the file of a finished download and move it into place
+    # (worker thread)
+    def _finish_body(self, transfer):
+        if transfer._done or transfer._file is None:
+            return
+        if transfer._decoder is not None:
+            self._write_decoded(transfer, transfer._decoder.flush())
+        transfer._file.close()
+        transfer._file = None
+        digest = transfer._hash.hexdigest()
+        filename = self._move_into_place(transfer._tmpname, transfer._path,
+                                         transfer._name, transfer._timestamp,
+                                         digest)
+        res = None
+        if filename:
+            timings = transfer._req.timings
+            timings.end_body()
+            response = transfer._response
+            res = self._make_resource(transfer._timestamp, transfer.url,
+                                      response.geturl(), filename,
+                                      transfer.referer, response.info(),
+                                      transfer._size, transfer._encoded_size,
+                                      transfer._encoding, digest, timings)
+        self._complete(transfer, res)
+    
+    # Called when the server answers "304 Not Modified" (worker thread)
+    def _finish_not_modified(self, transfer):
+        if not transfer._done:
+            self._handle_not_modified(self, transfer._req, transfer.url)
+            self._complete(transfer, self._not_modified(
+                        transfer._req, transfer.url, transfer.referer))
+    
+    # Follow a redirection, passing it through the hooks (worker thread)
+    def _follow_redirect(self, transfer, location):
+        if transfer._done:
+            return
+        req = transfer._req
+        response = transfer._response
+        code, msg, headers = response.code, response.msg, response.headers
+        newurl = urlparse.urljoin(req.get_full_url(), location)
+        if urlparse.urlsplit(newurl).scheme.lower() != 'http':
+            self._download_blocking(transfer)
+            return
+        visited = transfer._redirects
+        if visited.get(newurl, 0) >= self.max_repeats or \
+                len(visited) >= self.max_redirections:
+            raise urllib2.HTTPError(req.get_full_url(), code,
+                    urllib2.HTTPRedirectHandler.inf_msg + msg, headers, None)
+        visited[newurl] = visited.get(newurl, 0) + 1
+        if req.has_header('Referer'):
+            req.add_header('Referer', req.get_full_url())
+        if not self._filter_redirect(self, req, newurl):
+            raise urllib2.HTTPError(req.get_full_url(), code,
+                            "Blocked redirect: \"%s\"" % newurl,
+                            headers, None)
+        newreq = urllib2.HTTPRedirectHandler().redirect_request(
+                                    req, None, code, msg, headers, newurl)
+        newreq.timings = req.timings
+        transfer._req = newreq
+        transfer._retried = False
+        self._call_in_loop(self._enqueue, transfer)
+    
+    # Download with the blocking code, for what the event loop can't do
+    # (worker thread)
+    def _download_blocking(self, transfer):
+        res = Downloader._download(self, transfer.url, transfer.referer)
+        self._complete(transfer, res)
+    
+    # Set the result of a transfer, clean up and call the callback
+    # (worker thread)
+    def _complete(self, transfer, result=None, error=None):
+        with transfer._lock:
+            if transfer._done:
+                return
+            transfer._done = True
+        fdst, transfer._file = transfer._file, None
+        if fdst is not None:
+            fdst.close()
+        if transfer._tmpname is not None:
+            try:
+                FileUtils.remove_silently(transfer._tmpname)
+            except OSError:
+                pass
+        transfer._result = result
+        transfer._error = error
+        if error is not None:
+            try:
+                self._handle_error(self, transfer.url, error[1])
+            except Exception:
+                warnings.warn(traceback.format_exc(), RuntimeWarning)
+        transfer._event.set()
+        self._slots.release()
+        callback = transfer._callback
+        if callback is not None:
+            try:
+                callback(transfer)
+            except Exception:
+                warnings.warn(traceback.format_exc(), RuntimeWarning)
+
+#-----------------------------------------------------------------------------#
+
+class History(object):
+    """
+    Keeps a history of downloaded resources in a database.
+    
+    The database is an SQLite file in WAL mode, with one row per downloaded
+    resource indexed by location and timestamp. Adding a resource is a
+    single insert no matter how many times the URL was downloaded before.
+    Changes are committed when calling L{sync} or L{close}.
+    
+    The L{Validators} of the last download of each URL are kept alongside,
+    so conditional requests can be made with a single lookup.
+    
+    The same instance may be shared by several threads, and the same file
+    by several instances and processes. Each instance writes through a
+    single connection, and SQLite locks the file so writers from different
+    processes take turns, waiting up to L{busy_timeout} seconds. Reads go
+    through a pool of connections of their own, so concurrent threads can
+    read while another one writes. Reads made while this instance has
+    changes not yet committed go through the writing connection instead,
+    so they see those changes too.
+    
+    @type default_filename: str
+    @cvar default_filename: Default filename to use if not provided at the
+        constructor. This is the file part only, the directory part is taken
+        from the current user's home directory.
+    
+    @type legacy_filename: str
+    @cvar legacy_filename: Default filename used by older versions, where
+        the history was a pickled C{anydbm} database. See L{import_legacy}.
+    
+    @type busy_timeout: float
+    @cvar busy_timeout: Maximum time in seconds to wait for other
+        processes to release the history file.
+    
+    Example::
+        with History() as history:
+            if not history.contains(url):
+                downloader = Downloader(options=options)
+                resource = downloader.download(url)
+                if resource:
+                    history.add(resource)
+    """
+    
+    # Default filename
+    default_filename = '.pycrawl_history.db'
+    
+    # Default filename of the old anydbm history
+    legacy_filename = '.pycrawl_history'
+    
+    # Time to wait for other processes writing to the file
+    busy_timeout = 60.0
+    
+    # Database schema
+    _schema = (
+        "CREATE TABLE IF NOT EXISTS resources ("
+            "id INTEGER PRIMARY KEY, "
+            "location TEXT NOT NULL, "
+            "timestamp REAL, "
+            "url TEXT, "
+            "datafile TEXT, "
+            "referer TEXT, "
+            "headers TEXT, "
+            "fetched REAL, "
+            "size INTEGER, "
+            "encoded_size INTEGER, "
+            "encoding TEXT, "
+            "digest TEXT)",
+        "CREATE INDEX IF NOT EXISTS resources_location "
+            "ON resources (location, timestamp)",
+        "CREATE TABLE IF NOT EXISTS validators ("
+            "url TEXT PRIMARY KEY, "
+            "location TEXT, "
+            "datafile TEXT, "
+            "etag TEXT, "
+            "last_modified TEXT, "
+            "length INTEGER, "
+            "digest TEXT, "
+            "content_type TEXT, "
+            "encoding TEXT)",
+    )
+    
+    # Columns added after the first version of each table
+    _new_columns = {
+        'resources'  : (
+            ('fetched',      'REAL'),
+            ('size',         'INTEGER'),
+            ('encoded_size', 'INTEGER'),
+            ('encoding',     'TEXT'),
+            ('digest',       'TEXT'),
+        ),
+        'validators' : (
+            ('encoding',     'TEXT'),
+        ),
+    }
+    
+    # Columns to build Resource objects from
+    _columns = "timestamp, url, location, datafile, referer, headers, " \
+               "size, encoded_size, encoding, digest"
+    
+    # Columns to build Validators objects from
+    _validator_columns = "url, location, datafile, etag, last_modified, " \
+                         "length, digest, content_type, encoding"
+    
+    # Maximum number of URLs to look up in a single query,
+    # SQLite allows no more than 999 parameters by default
+    _max_params = 500
+    
+    def __init__(self, filename=None):
+        """
+        @type  filename: str
+        @param filename:
+            Optional history file name. If this argument is not set, the
+            default filename is obtained from L{get_default_filename}.
+        """
+        self._filename = filename
+        self._lock = threading.RLock()
+        self._dirty = False             # True if there are changes to commit
+        self._readers = []              # idle connections for reading
+        self._readers_lock = threading.Lock()
+    
+    def __enter__(self):
+        self.open()
+        return self
+    
+    def __exit__(self, type, value, traceback):
+        self.close()
+    
+    def get_default_filename(self):
+        """
+        @rtype:  str
+        @return: The default history filename.
+            If not set in the constructor, the default filename depends on the
+            user home directory and the class attribute L{default_filename}.
+        """
+        filename = self._filename
+        if not filename:
+            home = ShellUtils.get_home_folder()
+            if not home:
+                home = os.path.curdir
+            filename = os.path.join(home, self.default_filename)
+        return filename
+    
+    def get_partition_filename(self, index):
+        """
+        @type  index: int
+        @param index: Shard of a multi-process crawl.
+        
+        @rtype:  str
+        @return: Filename of the history partition written by the shard,
+            next to the history file. See L{merge}.
+        """
+        return '%s.shard%d' % (self.get_default_filename(), index)
+    
+    def find_partitions(self):
+        """
+        @rtype:  list(str)
+        @return: Filenames of the history partitions left next to the history
+            file, for example by an interrupted multi-process crawl.
+        """
+        prefix = self.get_default_filename() + '.shard'
+        return sorted(filename for filename in glob.glob(prefix + '*')
+                      if filename[len(prefix):].isdigit())
+    
+    def open(self, filename=None):
+        """
+        Open the history file.
+        
+        @note: this closes the previously open file for this instance.
+        
+        @type  filename: str
+        @param filename: Optional history file name.
+            If this argument is not set, the default filename is used.
+        """
+        if not filename:
+            filename = self.get_default_filename()
+        db = self._connect(filename)
+        try:
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=NORMAL")
+            for statement in self._schema:
+                db.execute(statement)
+            for table, new_columns in self._new_columns.iteritems():
+                columns = [row[1] for row in
+                           db.execute("PRAGMA table_info(%s)" % table)]
+                for column, type in new_columns:
+                    if column not in columns:
+                        db.execute("ALTER TABLE %s ADD COLUMN %s %s" %
+                                   (table, column, type))
+            db.commit()
+        except:
+            db.close()
+            raise
+        with self._lock:
+            try:
+                if hasattr(self, '_db'):
+                    self.close()
+            finally:
+                self._last_filename = filename
+                self._db = db
+    
+    # Open a connection to the database
+    def _connect(self, filename):
+        db = sqlite3.connect(filename, timeout=self.busy_timeout,
+                             check_same_thread=False)
+        db.text_factory = str
+        return db
+    
+    # Run a query, with a connection from the pool when possible.
+    # Returns all the rows if many is True, or the first one otherwise.
+    def _query(self, query, params, many=False):
+        if self._dirty:
+            with self._lock:
+                if self._dirty:
+                    cursor = self._db.execute(query, params)
+                    if many:
+                        return cursor.fetchall()
+                    return cursor.fetchone()
+        with self._readers_lock:
+            db = None
+            if self._readers:
+                db = self._readers.pop()
+        if db is None:
+            db = self._connect(self._last_filename)
+            db.execute("PRAGMA query_only=1")
+        try:
+            cursor = db.execute(query, params)
+            if many:
+                return cursor.fetchall()
+            return cursor.fetchone()
+        finally:
+            with self._readers_lock:
+                self._readers.append(db)
+    
+    def sync(self):
+        """
+        Persists database changes to disk.
+        """
+        with self._lock:
+            self._db.commit()
+            self._dirty = False
+    
+    def revert(self):
+        """
+        Revert all changes to the history file back to the last saved version.
+        """
+        with self._lock:
+            self._db.rollback()
+            self._dirty = False
+    
+    def close(self):
+        """
+        Closes the history file. After calling this method, you are only
+        allowed to call the L{open} method before using this instance again.
+        This will automatically save all changes.
+        """
+        with self._lock:
+            try:
+                self.sync()
+            finally:
+                try:
+                    self._db.close()
+                finally:
+                    del self._db
+                    with self._readers_lock:
+                        readers, self._readers = self._readers, []
+                    for db in readers:
+                        db.close()
+    
+    def add(self, resource):
+        """
+        Save a downloaded HTTP resource to the history file.
+        
+        @type  resource: L{Resource}
+        @param resource: HTTP resource.
+        """
+        self.add_many([resource])
+    
+    def add_many(self, resources):
+        """
+        Save several downloaded HTTP resources to the history file.
+        
+        @type  resources: list(L{Resource})
+        @param resources: HTTP resources.
+        """
+        fetched = time.time()
+        rows = [(resource.timestamp, resource.url, resource.location,
+                 resource.datafile, resource.referer, resource.headers,
+                 resource.size, resource.encoded_size, resource.encoding,
+                 resource.digest, fetched)
+                for resource in resources]
+        validators = [Validators.from_resource(resource)
+                      for resource in resources if resource.datafile]
+        with self._lock:
+            self._dirty = True
+            self._db.executemany(
+                "INSERT INTO resources (%s, fetched) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)" % self._columns,
+                rows)
+            self._db.executemany(
+                "INSERT OR REPLACE INTO validators (%s) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)" %
+                self._validator_columns, validators)
+    
+    def contains(self, location):
+        """
+        Determine if at least one HTTP resource at the given URL was saved to
+        the history file.
+        
+        @type  location: str
+        @param location: URL of the HTTP resource to look for.
+        
+        @rtype: bool
+        @return:
+            C{True} if a resource at that URL was saved,
+            C{False} otherwise.
+        """
+        row = self._query(
+                "SELECT 1 FROM resources WHERE location = ? LIMIT 1",
+                (location,))
+        return row is not None
+    
+    def get(self, location):
+        """
+        Get all resources for the given URL from the history file.
+        
+        @type  location: str
+        @param location: URL of the HTTP resources to look for.
+        
+        @rtype: set(L{Resource})
+        @return: Set of HTTP resources. Returns C{None} if no resource was
+            found for that URL in the history file.
+        """
+        rows = self._query(
+                "SELECT %s FROM resources WHERE location = ?"
+                % self._columns, (location,), many=True)
+        if not rows:
+            return None
+        return set(Resource(*row) for row in rows)
+    
+    def get_many(self, locations):
+        """
+        Get all resources for each of the given URLs from the history file.
+        This is much faster than calling L{get} for each URL.
+        
+        @type  locations: list(str)
+        @param locations: URLs of the HTTP resources to look for.
+        
+        @rtype: dict(str S{->} set(L{Resource}))
+        @return: Set of HTTP resources for each URL. URLs with no resources
+            in the history file are left out.
+        """
+        found = {}
+        query = "SELECT %s FROM resources WHERE location IN (%%s)" \
+                % self._columns
+        for row in self._query_many(query, locations):
+            resource = Resource(*row)
+            found.setdefault(resource.location, set()).add(resource)
+        return found
+    
+    def get_validators(self, url):
+        """
+        Get the validators of the last download of the given URL.
+        
+        @type  url: str
+        @param url: Canonical URL originally requested.
+        
+        @rtype: L{Validators}
+        @return: Validators for the URL. Returns C{None} if the URL was
+            never downloaded.
+        """
+        row = self._query(
+                "SELECT %s FROM validators WHERE url = ?"
+                % self._validator_columns, (url,))
+        if row is None:
+            return None
+        return Validators(*row)
+    
+    def get_validators_many(self, urls):
+        """
+        Get the validators of the last download of each of the given URLs.
+        This is much faster than calling L{get_validators} for each URL.
+        
+        @type  urls: list(str)
+        @param urls: Canonical URLs originally requested.
+        
+        @rtype: dict(str S{->} L{Validators})
+        @return: Validators for each URL. URLs never downloaded are left out.
+        """
+        query = "SELECT %s FROM validators WHERE url IN (%%s)" \
+                % self._validator_columns
+        return dict((row[0], Validators(*row))
+                    for row in self._query_many(query, urls))
+    
+    # Run a query for a list of keys, in as few batches as possible.
+    # The query must have a single %s where the parameters go.
+    def _query_many(self, query, keys):
+        keys = list(set(keys))
+        rows = []
+        step = self._max_params
+        for index in xrange(0, len(keys), step):
+            params = keys[index:index + step]
+            batch = query % ', '.join('?' * len(params))
+            rows.extend(self._query(batch, params, many=True))
+        return rows
+    
+    def get_latest(self, location, since=None):
+        """
+        Get the most recent resource for the given URL from the history file.
+        
+        @type  location: str
+        @param location: URL of the HTTP resource to look for.
+        
+        @type  since: float
+        @param since: Optional, only consider resources saved to the history
+            file at or after this time, as a Unix epoch.
+        
+        @rtype: L{Resource}
+        @return: HTTP resource with the newest timestamp. Returns C{None} if
+            no resource was found for that URL in the history file.
+        """
+        query = "SELECT %s FROM resources WHERE location = ?" % self._columns
+        params = (location,)
+        if since is not None:
+            query = query + " AND fetched >= ?"
+            params = (location, since)
+        query = query + " ORDER BY timestamp DESC, id DESC LIMIT 1"
+        row = self._query(query, params)
+        if row is None:
+            return None
+        return Resource(*row)
+    
+    def merge(self, filename):
+        """
+        Import all resources from another history file, such as the
+        partitions written by each process of a multi-process crawl.
+        The other file is left untouched.
+        
+        The other file is assumed to be newer, so its validators replace
+        the ones in this file for the same URLs.
+        
+        @type  filename: str
+        @param filename: History file name to import.
+        
+        @rtype:  int
+        @return: Number of resources imported.
+        """
+        with History(filename):
+            pass    # bring the schema up to date
+        columns = "location, timestamp, url, datafile, referer, headers, " \
+                  "fetched, size, encoded_size, encoding, digest"
+        with self._lock:
+            self.sync()     # can't attach in the middle of a transaction
+            db = self._db
+            db.execute("ATTACH DATABASE ? AS other", (filename,))
+            try:
+                try:
+                    cursor = db.execute(
+                        "INSERT INTO resources (%s) "
+                        "SELECT %s FROM other.resources ORDER BY id"
+                        % (columns, columns))
+                    count = cursor.rowcount
+                    db.execute(
+                        "INSERT OR REPLACE INTO validators (%s) "
+                        "SELECT %s FROM other.validators"
+                        % (self._validator_columns, self._validator_columns))
+                    db.commit()
+                except:
+                    db.rollback()
+                    raise
+            finally:
+                db.execute("DETACH DATABASE other")
+        return count
+    
+    def import_legacy(self, filename=None):
+        """
+        Import all resources from a history file in the old format (a pickled
+        C{anydbm} database). The legacy file itself is left untouched.
+        
+        @type  filename: str
+        @param filename: Legacy history file name. Defaults to the
+            L{legacy_filename} in the current user's home directory.
+        
+        @rtype:  int
+        @return: Number of resources imported.
+        """
+        if not filename:
+            home = ShellUtils.get_home_folder()
+            if not home:
+                home = os.path.curdir
+            filename = os.path.join(home, self.legacy_filename)
+        count = 0
+        legacy = anydbm.open(filename, 'r')
+        try:
+            with self._lock:
+                try:
+                    for location in legacy.keys():
+                        for resource in pickle.loads(legacy[location]):
+                            self.add(resource)
+                            count = count + 1
+                except:
+                    self.revert()
+                    raise
+                self.sync()
+        finally:
+            legacy.close()
+        return count
+
+#-----------------------------------------------------------------------------#
+
+class HistoryHook(Hook):
+    """
+    Downloader hook to use a history file.
+    
+    This provides more accurate tracking of which resources were downloaded
+    already and if they need to be downloaded again. Requests for URLs that
+    were downloaded before are made conditional using the stored
+    L{Validators}, so the server can answer C{"304 Not Modified"} instead
+    of sending the data again.
+    
+    Downloaded resources are buffered and written to the history file in
+    batches, each batch in a single transaction. A batch is written when
+    C{batchsize} resources are buffered, and a background thread writes
+    the buffer every C{interval} seconds in case it fills slowly. Closing the
+    hook writes whatever is left in the buffer, so a crash loses at most
+    the last batch, and the history file is never left half written.
+    The buffer is swapped for an empty one before writing it, so other
+    threads can keep downloading while a batch is being written, and they
+    still see the resources in it until it's committed.
+    
+    When a L{Crawler} queues the links found in a page, the history of all
+    of them is read in a single query and kept until they're requested,
+    for up to C{prefetch} URLs. Requests for those URLs don't have to
+    query the history file again, unless the prefetched history is older
+    than L{max_prefetch_age}, since other processes sharing the history
+    file may have downloaded them in the meantime.
+    
+    Example::
+        def my_download(url, options):
+            with History() as history:
+                with HistoryHook(history) as hook:
+                    downloader = Downloader(options=options, hooks=[hook])
+                    return downloader.download(url)
+    
+    @type max_prefetch_age: float
+    @cvar max_prefetch_age: Time in seconds the prefetched history of a
+        URL may be used for.
+    """
+    
+    # Prefetched history older than this (in seconds) is read again
+    max_prefetch_age = 60.0
+    
+    def __init__(self, history, batchsize=100, interval=1.0, prefetch=10000):
+        """
+        @type  history: L{History}
+        @param history: History file.
+        
+        @type  batchsize: int
+        @param batchsize: Maximum number of resources to buffer. Use C{1} to
+            write each resource as soon as it's downloaded.
+        
+        @type  interval: float
+        @param interval: Maximum time in seconds a resource may stay buffered.
+        
+        @type  prefetch: int
+        @param prefetch: Maximum number of URLs to keep the history of
+            until they're requested. Use C{0} to disable prefetching.
+        """
+        self.__history   = history
+        self.__batchsize = batchsize
+        self.__interval  = interval
+        self.__cond      = threading.Condition(threading.Lock())
+        self.__pending   = {}       # location -> list of resources
+        self.__validators = {}      # url -> validators of buffered resources
+        self.__count     = 0        # number of buffered resources
+        self.__writing   = None     # (pending, validators) being written
+        self.__flush_lock = threading.Lock()    # one batch at a time
+        self.__flusher   = None     # background thread
+        self.__closed    = False
+        self.__prefetched = None    # url -> (time, validators, resources)
+        if prefetch:
+            self.__prefetched = LRUCache(prefetch)
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, type, value, traceback):
+        self.close()
+    
+    def flush(self):
+        """
+        Write all buffered resources to the history file.
+        """
+        with self.__flush_lock:
+            
+            # Take the buffered resources, leaving an empty buffer
+            with self.__cond:
+                if not self.__count:
+                    return
+                pending, self.__pending = self.__pending, {}
+                validators, self.__validators = self.__validators, {}
+                self.__writing = (pending, validators)
+                count, self.__count = self.__count, 0
+            
+            # Write them without holding the lock
+            history = self.__history
+            resources = []
+            for res_list in pending.itervalues():
+                resources.extend(res_list)
+            try:
+                try:
+                    history.add_many(resources)
+                    history.sync()
+                except:
+                    history.revert()
+                    
+                    # Put them back in the buffer to try again later,
+                    # keeping any newer validators
+                    with self.__cond:
+                        for location, res_list in pending.iteritems():
+                            res_list.extend(self.__pending.get(location, ()))
+                            self.__pending[location] = res_list
+                        validators.update(self.__validators)
+                        self.__validators = validators
+                        self.__count = self.__count + count
+                    raise
+            finally:
+                with self.__cond:
+                    self.__writing = None
+    
+    def close(self):
+        """
+        Write all buffered resources to the history file and stop the
+        background flushing thread. The history file itself is not closed.
+        """
+        with self.__cond:
+            self.__closed = True
+            flusher, self.__flusher = self.__flusher, None
+            self.__cond.notify_all()
+        if flusher is not None:
+            flusher.join()
+        self.flush()
+    
+    # Background thread to write buffered resources on time
+    def __flush_loop(self):
+        while True:
+            with self.__cond:
+                if not self.__closed:
+                    self.__cond.wait(self.__interval)
+                if self.__closed:
+                    break
+            try:
+                self.flush()
+            except Exception, e:
+                msg = "Error writing the history file: %s" % e
+                warnings.warn(msg, RuntimeWarning)
+    
+    # Read the history of URLs that will be requested soon.
+    # The resources are only read for URLs without usable validators,
+    # since filter_request won't look at them otherwise.
+    def handle_targets(self, dwn, urls):
+        prefetched = self.__prefetched
+        if prefetched is None:
+            return
+        history = self.__history
+        found = history.get_validators_many(urls)
+        missing = []
+        for url in urls:
+            validators = found.get(url)
+            if validators is None or not (validators.etag or
+                                          validators.last_modified):
+                missing.append(url)
+        resources = {}
+        if missing:
+            resources = history.get_many(missing)
+            missing = set(missing)
+        now = time.time()
+        for url in urls:
+            res_set = None
+            if url in missing:
+                res_set = resources.get(url, ())
+            prefetched.put(url, (now, found.get(url), res_set))
+    
+    # Take the prefetched history of a URL as a tuple of validators and
+    # resources, or None if not prefetched or too old
+    def __get_prefetched(self, url):
+        if self.__prefetched is None:
+            return None
+        prefetched = self.__prefetched.pop(url)
+        if prefetched is None or \
+                time.time() - prefetched[0] > self.max_prefetch_age:
+            return None
+        return prefetched[1:]
+    
+    # Get the resources for a URL from the history file and the buffer
+    def __get_resources(self, url, prefetched=None):
+        if prefetched is not None and prefetched[1] is not None:
+            res_set = set(prefetched[1])
+        else:
+            res_set = self.__history.get(url)
+        with self.__cond:
+            buffered = self.__pending.get(url)
+            if buffered:
+                if res_set is None:
+                    res_set = set()
+                res_set.update(buffered)
+            if self.__writing is not None:
+                buffered = self.__writing[0].get(url)
+                if buffered:
+                    if res_set is None:
+                        res_set = set()
+                    res_set.update(buffered)
+        return res_set
+    
+    # Get the validators for a URL from the buffer or the history file
+    def __get_validators(self, url, prefetched=None):
+        with self.__cond:
+            validators = self.__validators.get(url)
+            if validators is None and self.__writing is not None:
+                validators = self.__writing[1].get(url)
+        if validators is None:
+            if prefetched is not None:
+                validators = prefetched[0]
+            else:
+                validators = self.__history.get_validators(url)
+        return validators
+    
+    def filter_request(self, dwn, req, url):
+        
+        # Calculate the target local filename
+        targetfile = os.path.join(*dwn.calc_local_name(url))
+        
+        # If we have the validators for the last download of this URL,
+        # and the file is still there, make a fully conditional request
+        prefetched = self.__get_prefetched(url)
+        validators = self.__get_validators(url, prefetched)
+        if validators is not None and validators.datafile == targetfile \
+                and (validators.etag or validators.last_modified) \
+                and os.path.isfile(targetfile):
+            if validators.etag:
+                req.add_header('If-None-Match', validators.etag)
+            if validators.last_modified:
+                req.add_header('If-Modified-Since', validators.last_modified)
+            req.validators = validators
+            return True
+        
+        # Fetch all matching resources for this URL
+        # in the history file and skip if not found
+        res_set = self.__get_resources(url, prefetched)
+        if not res_set:
+            return True
+        
+        # Get the current value for the If-Modified-Since header if present,
+        # or the local file time if not.
+        currenthdr = req.get_header('If-Modified-Since')
+        current = None
+        if currenthdr:
+            try:
+                current = rfc822.parsedate_tz(currenthdr)
+            except Exception:
+                current = None
+        if not current:
+            currenthdr = None
+            if os.path.exists(targetfile):
+                current = FileUtils.get_file_time(targetfile)
+                if current:
+                    try:
+                        currenthdr = rfc822.formatdate(current)
+                    except Exception:
+                        currenthdr = None
+                    if not currenthdr:
+                        current = None
+        
+        # Iterate through all past downloads with the same URL
+        isfile = None
+        for resource in res_set:
+            
+            # Skip if the file was not successfully downloaded
+            datafile = resource.datafile
+            if not datafile:
+                continue
+            
+            # Skip if the target local file does not match
+            if datafile != targetfile:
+                continue
+            
+            # Skip if the local file does not exist in the target location.
+            # All the resources left have the same file, so check it once.
+            if isfile is None:
+                isfile = os.path.isfile(targetfile)
+            if not isfile:
+                continue
+            
+            # Get the resource's last modification time
+            lastmod = resource.get_header('Last-Modified')
+            timestamp = None
+            if lastmod:
+                try:
+                    timestamp = rfc822.parsedate_tz(lastmod)
+                except Exception:
+                    timestamp = None
+            if not timestamp:
+                lastmod = None
+                timestamp = resource.timestamp
+                if timestamp:
+                    try:
+                        lastmod = rfc822.formatdate(timestamp)
+                    except Exception:
+                        lastmod = None
+                if not lastmod:
+                    timestamp = None
+            
+            # If this timestamp is newer than the current timestamp,
+            # update the If-Modified-Since header
+            if timestamp and (not current or timestamp > current):
+                current = timestamp
+                currenthdr = lastmod
+        
+        # If we have an updated If-Modified-Since header, set it
+        if currenthdr:
+            req.add_header('If-Modified-Since', currenthdr)
+        
+        return True
+    
+    # Same processing as filter_request, but first forget the conditional
+    # headers and validators for the old URL, they don't apply to the new one
+    def filter_redirect(self, dwn, req, newurl):
+        for header in ('If-modified-since', 'If-none-match'):
+            req.headers.pop(header, None)
+            req.unredirected_hdrs.pop(header, None)
+        req.validators = None
+        return self.filter_request(dwn, req, newurl)
+    
+    # Record downloaded resources into the history file
+    def filter_resource(self, dwn, resource):
+        if resource.datafile:
+            validators = Validators.from_resource(resource)
+        else:
+            validators = None
+        if self.__prefetched is not None:
+            self.__prefetched.pop(resource.url)
+            self.__prefetched.pop(resource.location)
+        with self.__cond:
+            self.__pending.setdefault(resource.location, []).append(resource)
+            if validators is not None:
+                self.__validators[resource.url] = validators
+            self.__count = self.__count + 1
+            full = self.__count >= self.__batchsize
+            if not full and self.__flusher is None and not self.__closed:
+                self.__flusher = threading.Thread(target=self.__flush_loop)
+                self.__flusher.daemon = True
+                self.__flusher.start()
+        if full:
+            self.flush()
+        return True
+
+#-----------------------------------------------------------------------------#
+
+class Cookies(cookielib.LWPCookieJar, Configurable):
+    """
+    Persistent cookie jar. Based on LWPCookieJar for persistence, with some
+    minor tweaks (has a default filename and supports the C{with} clause).
+    
+    The cookies file may be shared by several processes. The file is locked
+    while it's being read or written, and saving first adds the cookies
+    other processes saved in the meantime to this jar, then replaces the
+    file with a new one in a single step. So no process loses the cookies
+    of another, or reads a file half written. Cookies that were already in
+    the file when it was last loaded or saved, and that were removed from
+    this jar since then, are not added back.
+    """
+    
+    default_filename = '.pycrawl_cookies'
+    
+    class _DefaultOptions(object):
+        """
+        Default options for L{Cookies}.
+        """
+        
+        def __init__(self):
+            self.cookie_file  = None
+            self.load_cookies = True
+            self.save_cookies = True
+    
+    def __init__(self, options=None):
+        Configurable.__init__(self, options)
+        filename = self.options.cookie_file
+        if not filename:
+            filename = self.get_default_filename()
+        cookielib.LWPCookieJar.__init__(self, filename, False, None)
+        self._known = set()     # cookies in the file last loaded or saved
+    
+    def get_default_filename(self):
+        """
+        The default filename is calculated from the user's home directory and
+        the L{default_filename} class attribute.
+        """
+        home = ShellUtils.get_home_folder()
+        if not home:
+            home = os.path.curdir
+        return os.path.join(home, self.default_filename)
+    
+    def __enter__(self):
+        """
+        Upon entering a context the cookies are automatically loaded if the
+        file exists.
+        """
+        if self.options.load_cookies and os.path.exists(self.filename):
+            self.load()
+        return self
+    
+    def __exit__(self, type, value, traceback):
+        """
+        Upon exiting a context the cookies are automatically saved to the file.
+        """
+        if self.options.save_cookies:
+            self.save()
+    
+    def load(self, filename=None, ignore_discard=False, ignore_expires=False):
+        if filename is None:
+            filename = self.filename
+        with FileUtils.lock_file(filename, exclusive=False):
+            cookielib.LWPCookieJar.load(self, filename, ignore_discard,
+                                        ignore_expires)
+        with self._cookies_lock:
+            self._known.update(self._get_keys(self))
+    
+    def save(self, filename=None, ignore_discard=False, ignore_expires=False):
+        if filename is None:
+            filename = self.filename
+        if filename is None:
+            raise ValueError(cookielib.MISSING_FILENAME_TEXT)
+        path, name = os.path.split(os.path.abspath(filename))
+        with FileUtils.lock_file(filename):
+            self._merge(filename, ignore_discard, ignore_expires)
+            fd, tmpname = tempfile.mkstemp(prefix = '.%s.' % name,
+                                           suffix = '.tmp', dir = path)
+            os.close(fd)
+            try:
+                with self._cookies_lock:
+                    cookielib.LWPCookieJar.save(self, tmpname,
+                                                ignore_discard, ignore_expires)
+                    self._known = self._get_keys(self)
+                FileUtils.move_overwriting(tmpname, filename)
+            except:
+                FileUtils.remove_silently(tmpname)
+                raise
+    
+    # Get the domain, path and name of each cookie in a jar
+    @staticmethod
+    def _get_keys(jar):
+        return set((cookie.domain, cookie.path, cookie.name)
+                   for cookie in jar)
+    
+    # Add the cookies in the file that this jar doesn't have, and that
+    # weren't there when we last loaded or saved it (so other processes
+    # added them since). Must be called with the file locked.
+    def _merge(self, filename, ignore_discard, ignore_expires):
+        if not os.path.exists(filename):
+            return
+        saved = cookielib.LWPCookieJar()
+        try:
+            saved.load(filename, ignore_discard, ignore_expires)
+        except (IOError, cookielib.LoadError), e:
+            warnings.warn("Error reading cookies: %s" % e, RuntimeWarning)
+            return
+        with self._cookies_lock:
+            known = self._known
+            for cookie in saved:
+                if (cookie.domain, cookie.path, cookie.name) in known:
+                    continue
+                names = self._cookies.get(cookie.domain, {}).get(cookie.path)
+                if not names or cookie.name not in names:
+                    self.set_cookie(cookie)
+
+#-----------------------------------------------------------------------------#
+
+class LRUCache(object):
+    """
+    Thread safe dictionary that holds a limited number of items, discarding
+    the least recently used ones when full.
+    """
+    
+    def __init__(self, maxsize):
+        """
+        @type  maxsize: int
+        @param maxsize: Maximum number of items.
+        """
+        self.maxsize = maxsize
+        self._lock   = threading.Lock()
+        self._items  = collections.OrderedDict()
+    
+    def __len__(self):
+        return len(self._items)
+    
+    def get(self, key, default=None):
+        """
+        @param key: Key to look for.
+        @param default: Value to return if the key is not in the cache.
+        @return: Cached value, or the default if not found.
+        """
+        with self._lock:
+            try:
+                value = self._items.pop(key)
+            except KeyError:
+                return default
+            self._items[key] = value
+            return value
+    
+    def put(self, key, value):
+        """
+        @param key: Key to add or update.
+        @param value: Value to store.
+        """
+        with self._lock:
+            items = self._items
+            items.pop(key, None)
+            items[key] = value
+            while len(items) > self.maxsize:
+                items.popitem(last=False)
+    
+    def pop(self, key, default=None):
+        """
+        @param key: Key to remove.
+        @param default: Value to return if the key is not in the cache.
+        @return: Cached value, or the default if not found.
+        """
+        with self._lock:
+            return self._items.pop(key, default)
+    
+    def clear(self):
+        """
+        Discard all items.
+        """
+        with self._lock:
+            self._items.clear()
+
+#-----------------------------------------------------------------------------#
+
+class RobotsRules(object):
+    """
+    Access rules from a robots.txt file that apply to a given user agent.
+    
+    C{Allow} and C{Disallow} rules are matched against the path and query
+    of the URL, and the longest matching rule wins (with C{Allow} winning
+    ties). The C{*} and C{$} wildcards are supported.
+    
+    @type crawl_delay: float
+    @ivar crawl_delay: Delay in seconds between requests asked for by the
+        C{Crawl-delay} field, or C{None} if not present.
+    """
+    
+    def __init__(self, text='', useragent='*'):
+        """
+        @type  text: str
+        @param text: Contents of the robots.txt file.
+            An empty file allows everything.
+        
+        @type  useragent: str
+        @param useragent: User agent string of the crawler. Only the product
+            token is used, for example C{"pycrawl"} for C{"PyCrawl 0.1"}.
+        """
+        self.crawl_delay = None
+        self._rules = []    # list of (length, allow, prefix, regexp)
+        
+        # Split the file into groups of user agents and their rules
+        groups = []
+        group  = None
+        for line in text.splitlines():
+            line = line.split('#', 1)[0]
+            if ':' not in line:
+                continue
+            field, value = line.split(':', 1)
+            field = field.strip().lower()
+            value = value.strip()
+            if field == 'user-agent':
+                if group is None or group[1] or group[2] is not None:
+                    group = [[], [], None]  # agents, rules, crawl delay
+                    groups.append(group)
+                group[0].append(value.lower())
+            elif group is None:
+                continue
+            elif field in ('allow', 'disallow'):
+                group[1].append( (field == 'allow', value) )
+            elif field == 'crawl-delay':
+                try:
+                    group[2] = float(value)
+                except ValueError:
+                    pass
+        
+        # Pick the groups for our product token, or else the "*" groups.
+        # The whole token must match, ignoring case (RFC 9309).
+        token = useragent.lower().split('/')[0].split()
+        token = token and token[0] or '*'
+        best  = None
+        for agents, _, _ in groups:
+            for agent in agents:
+                if agent == token:
+                    best = agent
+                elif agent == '*' and best is None:
+                    best = agent
+        if best is None:
+            return
+        for agents, rules, delay in groups:
+            if best not in agents:
+                continue
+            if delay is not None:
+                self.crawl_delay = delay
+            for allow, pattern in rules:
+                if not pattern:
+                    continue    # "Disallow:" with no path allows everything
+                if '*' in pattern or pattern.endswith('$'):
+                    regexp = pattern.rstrip('$')
+                    regexp = '.*'.join(re.escape(x) for x in regexp.split('*'))
+                    if pattern.endswith('$'):
+                        regexp = regexp + '$'
+                    regexp = re.compile(regexp)
+                    self._rules.append( (len(pattern), allow, None, regexp) )
+                else:
+                    self._rules.append( (len(pattern), allow, pattern, None) )
+    
+    def allowed(self, url):
+        """
+        @type  url: str
+        @param url: URL to check.
+        
+        @rtype:  bool
+        @return: C{True} if the URL may be crawled, C{False} otherwise.
+        """
+        if not self._rules:
+            return True
+        parts = urlparse.urlsplit(url)
+        path = parts.path or '/'
+        if parts.query:
+            path = path + '?' + parts.query
+        best = None
+        for length, allow, prefix, regexp in self._rules:
+            if prefix is not None:
+                matched = path.startswith(prefix)
+            else:
+                matched = regexp.match(path) is not None
+            if matched and (best is None or length > best[0] or
+                            (length == best[0] and allow)):
+                best = (length, allow)
+        return best is None or best[1]
+
+#-----------------------------------------------------------------------------#
+
+class RobotsHook(Hook):
+    """
+    Downloader hook to obey robots.txt files.
+    
+    The robots.txt file of each host is downloaded and parsed only once,
+    and the rules are kept in a L{LRUCache}. Requests to disallowed URLs
+    are blocked. If the downloader has a L{Frontier} (that is, it's a
+    L{Crawler}), the C{Crawl-delay} field is passed on to it so requests to
+    the same host are spaced out accordingly.
+    """
+    
+    # Crawl delays longer than this (in seconds) are capped
+    max_crawl_delay = 60.0
+    
+    # Timeout to download robots.txt files
+    timeout = 15.0
+    
+    def __init__(self, cachesize=1000):
+        """
+        @type  cachesize: int
+        @param cachesize: Maximum number of hosts to keep the rules for.
+        """
+        self._cache    = LRUCache(cachesize)
+        self._lock     = threading.Lock()
+        self._fetching = {}     # host -> Event set when the rules are ready
+        
+        # Plain opener, so the hooks are not run for robots.txt files
+        self._urlopener = urllib2.build_opener()
+    
+    def get_rules(self, dwn, url):
+        """
+        Get the robots.txt rules for the host of the given URL,
+        downloading them if they're not in the cache.
+        
+        @type  dwn: L{Downloader}
+        @param dwn: Downloader asking for the rules.
+        
+        @type  url: str
+        @param url: URL to get the rules for.
+        
+        @rtype:  L{RobotsRules}
+        @return: Rules for the host.
+        """
+        parts = urlparse.urlsplit(url)
+        key = (parts.scheme.lower(), parts.netloc.lower())
+        rules = self._cache.get(key)
+        if rules is not None:
+            return rules
+        
+        # Only one thread downloads the file, the others wait for it
+        with self._lock:
+            event = self._fetching.get(key)
+            fetch = event is None
+            if fetch:
+                event = threading.Event()
+                self._fetching[key] = event
+        if not fetch:
+            event.wait()
+            return self._cache.get(key) or RobotsRules()
+        try:
+            rules = self._fetch_rules(dwn, key[0], key[1])
+            self._cache.put(key, rules)
+        finally:
+            with self._lock:
+                del self._fetching[key]
+            event.set()
+        return rules
+    
+    # Download and parse a robots.txt file
+    def _fetch_rules(self, dwn, scheme, netloc):
+        url = '%s://%s/robots.txt' % (scheme, netloc)
+        req = urllib2.Request(url, headers={'User-Agent' : dwn.USER_AGENT})
+        try:
+            fsrc = self._urlopener.open(req, timeout=self.timeout)
+            try:
+                text = fsrc.read()
+            finally:
+                fsrc.close()
+        except urllib2.HTTPError, e:
+            e.close()
+            if e.code in (401, 403):
+                return RobotsRules('User-agent: *\nDisallow: /\n')
+            return RobotsRules()
+        except Exception:
+            return RobotsRules()
+        return RobotsRules(text, dwn.USER_AGENT)
+    
+    def filter_request(self, dwn, req, url):
+        rules = self.get_rules(dwn, url)
+        if not rules.allowed(url):
+            return False
+        if rules.crawl_delay:
+            frontier = getattr(dwn, 'frontier', None)
+            if frontier is not None:
+                delay = min(rules.crawl_delay, self.max_crawl_delay)
+                frontier.set_delay(Frontier.get_host(url), delay)
+        return True
+    
+    # Same processing as filter_request
+    def filter_redirect(self, dwn, req, newurl):
+        return self.filter_request(dwn, req, newurl)
+
+#-----------------------------------------------------------------------------#
+
+class MetricsHook(Hook):
+    """
+    Hook that collects metrics about the performance of a crawl: requests
+    sent, bytes received, C{"304 Not Modified"} answers, errors, the depth
+    of the crawl frontier, and histograms of the time spent on each stage
+    of the downloads (see L{Timings}) for each host.
+    
+    Use a L{MetricsExporter} to report them periodically. Each event only
+    updates a few counters while holding a lock, so collecting the metrics
+    costs very little compared to the downloads themselves.
+    
+    @type buckets: tuple(float)
+    @cvar buckets: Upper bounds of the latency histogram buckets, in
+        seconds. The last bucket has no upper bound.
+    
+    @type stages: tuple(str)
+    @cvar stages: Stages of a download with a latency histogram.
+    """
+    
+    buckets = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+               1.0, 2.5, 5.0, 10.0)
+    
+    stages = ('dns', 'connect', 'ttfb', 'body')
+    
+    # Host name used for the hosts past the maximum
+    other_hosts = '(other)'
+    
+    def __init__(self, maxhosts=1000):
+        """
+        @type  maxhosts: int
+        @param maxhosts: Maximum number of hosts to keep histograms for.
+            The rest of the hosts are added up together, so the size of
+            the reports doesn't grow without bounds on large crawls.
+        """
+        self._maxhosts     = maxhosts
+        self._lock         = threading.Lock()
+        self._started      = time.time()
+        self._frontier     = None
+        self._requests     = 0
+        self._downloads    = 0
+        self._not_modified = 0
+        self._bytes        = 0
+        self._errors       = {}     # kind -> count
+        self._latency      = {}     # host -> stage -> bucket counts + sum
+    
+    # Add the timings of a download to the histograms of its host
+    def _record(self, url, timings):
+        if timings is None:
+            return
+        host = Frontier.get_host(url)
+        buckets = self.buckets
+        with self._lock:
+            latency = self._latency.get(host)
+            if latency is None:
+                if len(self._latency) >= self._maxhosts:
+                    host = self.other_hosts
+                    latency = self._latency.get(host)
+                if latency is None:
+                    latency = self._latency[host] = dict(
+                        (stage, [0] * (len(buckets) + 2))
+                        for stage in self.stages)
+            for stage in self.stages:
+                value = getattr(timings, stage)
+                if value is not None:
+                    counts = latency[stage]
+                    index = bisect.bisect_left(buckets, value)
+                    counts[index] = counts[index] + 1
+                    counts[-1] = counts[-1] + value
+    
+    def filter_request(self, dwn, req, url):
+        if self._frontier is None:
+            self._frontier = getattr(dwn, 'frontier', None)
+        with self._lock:
+            self._requests = self._requests + 1
+        return True
+    
+    def filter_resource(self, dwn, resource):
+        with self._lock:
+            self._downloads = self._downloads + 1
+            self._bytes = self._bytes + (resource.encoded_size or 0)
+        self._record(resource.location, resource.timings)
+        return True
+    
+    def handle_not_modified(self, dwn, req, url):
+        with self._lock:
+            self._not_modified = self._not_modified + 1
+        self._record(req.get_full_url(), getattr(req, 'timings', None))
+    
+    def handle_error(self, dwn, url, error):
+        if isinstance(error, urllib2.HTTPError):
+            kind = 'http_%d' % error.code
+        else:
+            kind = type(getattr(error, 'reason', error)).__name__
+        with self._lock:
+            self._errors[kind] = self._errors.get(kind, 0) + 1
+    
+    def snapshot(self):
+        """
+        @rtype:  dict
+        @return: Current values of the metrics:
+             - C{time}: time of the snapshot, as a UNIX epoch.
+             - C{uptime}: seconds since the hook was created.
+             - C{requests}: requests sent.
+             - C{downloads}: resources downloaded.
+             - C{not_modified}: C{"304 Not Modified"} answers.
+             - C{bytes}: bytes received, before decoding.
+             - C{errors}: number of failed downloads of each kind, such as
+               C{"http_404"} or C{"timeout"}.
+             - C{frontier}: targets queued in the crawl frontier, or
+               C{None} if not crawling.
+             - C{latency}: histograms of each stage for each host, as a
+               dictionary of host names to dictionaries of stages to
+               dictionaries with the C{buckets} counts (see L{buckets}),
+               the C{sum} of the times and their C{count}.
+        """
+        frontier = self._frontier
+        depth = None
+        if frontier is not None:
+            depth = len(frontier)
+        now = time.time()
+        with self._lock:
+            latency = {}
+            for host, stages in self._latency.iteritems():
+                latency[host] = dict(
+                    (stage, {'buckets': counts[:-1],
+                             'sum':     counts[-1],
+                             'count':   sum(counts[:-1])})
+                    for stage, counts in stages.iteritems())
+            return {
+                'time':         now,
+                'uptime':       now - self._started,
+                'requests':     self._requests,
+                'downloads':    self._downloads,
+                'not_modified': self._not_modified,
+                'bytes':        self._bytes,
+                'errors':       dict(self._errors),
+                'frontier':     depth,
+                'latency':      latency,
+            }
+    
+    # Escape a Prometheus label value
+    @staticmethod
+    def _label(value):
+        return value.replace('\\', '\\\\').replace('"', '\\"') \
+                    .replace('\n', '\\n')
+    
+    def format_prometheus(self, snapshot=None):
+        """
+        @type  snapshot: dict
+        @param snapshot: Optional, metrics returned by L{snapshot}.
+            Defaults to the current metrics.
+        
+        @rtype:  str
+        @return: Metrics in the Prometheus text exposition format.
+        """
+        if snapshot is None:
+            snapshot = self.snapshot()
+        lines = []
+        for name, key, help in (
+                ('requests',     'requests',     'Requests sent'),
+                ('downloads',    'downloads',    'Resources downloaded'),
+                ('not_modified', 'not_modified', '304 Not Modified answers'),
+                ('received_bytes', 'bytes',      'Bytes received'),
+                ):
+            lines.append('# HELP pycrawl_%s_total %s.' % (name, help))
+            lines.append('# TYPE pycrawl_%s_total counter' % name)
+            lines.append('pycrawl_%s_total %d' % (name, snapshot[key]))
+        lines.append('# HELP pycrawl_errors_total Failed downloads.')
+        lines.append('# TYPE pycrawl_errors_total counter')
+        for kind, count in sorted(snapshot['errors'].iteritems()):
+            lines.append('pycrawl_errors_total{kind="%s"} %d' % (
+                                                self._label(kind), count))
+        if snapshot['frontier'] is not None:
+            lines.append('# HELP pycrawl_frontier_depth Queued targets.')
+            lines.append('# TYPE pycrawl_frontier_depth gauge')
+            lines.append('pycrawl_frontier_depth %d' % snapshot['frontier'])
+        lines.append('# HELP pycrawl_latency_seconds '
+                     'Time spent on each stage of the downloads.')
+        lines.append('# TYPE pycrawl_latency_seconds histogram')
+        bounds = ['%g' % x for x in self.buckets] + ['+Inf']
+        for host, stages in sorted(snapshot['latency'].iteritems()):
+            host = self._label(host)
+            for stage in self.stages:
+                histogram = stages[stage]
+                labels = 'host="%s",stage="%s"' % (host, stage)
+                total = 0
+                for bound, count in zip(bounds, histogram['buckets']):
+                    total = total + count
+                    lines.append('pycrawl_latency_seconds_bucket'
+                                 '{%s,le="%s"} %d' % (labels, bound, total))
+                lines.append('pycrawl_latency_seconds_sum{%s} %r' % (
+                                                labels, histogram['sum']))
+                lines.append('pycrawl_latency_seconds_count{%s} %d' % (
+                                                labels, histogram['count']))
+        lines.append('')
+        return '\n'.join(lines)
+
+#-----------------------------------------------------------------------------#
+
+class MetricsExporter(object):
+    """
+    Reports the metrics collected by a L{MetricsHook}.
+    
+    Every few seconds a snapshot of the metrics is appended to a file as a
+    line of JSON, with the request and byte rates since the previous line
+    and the ratio of C{"304 Not Modified"} answers added to it. The metrics
+    can also be served over HTTP in the Prometheus text format, from the
+    C{/metrics} path of a local port.
+    """
+    
+    class _Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+        """
+        Serves the metrics in the Prometheus text format.
+        """
+        
+        def do_GET(self):
+            if self.path.split('?', 1)[0] != '/metrics':
+                self.send_error(404)
+                return
+            data = self.server.hook.format_prometheus()
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+        
+        def log_message(self, format, *args):
+            pass
+    
+    def __init__(self, hook, filename=None, interval=10.0, address=None):
+        """
+        @type  hook: L{MetricsHook}
+        @param hook: Hook that collects the metrics.
+        
+        @type  filename: str
+        @param filename: Optional, file to append the JSON lines to,
+            or C{"-"} for standard output.
+        
+        @type  interval: float
+        @param interval: Seconds between JSON lines.
+        
+        @type  address: tuple(str, int)
+        @param address: Optional, address and port to serve the metrics
+            from, such as C{("127.0.0.1", 9100)}.
+        """
+        self.hook      = hook
+        self.filename  = filename
+        self.interval  = interval
+        self.address   = address
+        self._file     = None
+        self._server   = None
+        self._thread   = None
+        self._stop     = threading.Event()
+        self._previous = None
+    
+    def __enter__(self):
+        self.start()
+        return self
+    
+    def __exit__(self, type, value, traceback):
+        self.close()
+    
+    def start(self):
+        """
+        Start writing the JSON lines and serving the metrics.
+        """
+        if self.filename == '-':
+            self._file = sys.stdout
+        elif self.filename:
+            self._file = open(self.filename, 'a')
+        if self.address is not None:
+            self._server = BaseHTTPServer.HTTPServer(self.address,
+                                                     self._Handler)
+            self._server.hook = self.hook
+            thread = threading.Thread(target=self._server.serve_forever)
+            thread.daemon = True
+            thread.start()
+        self._previous = self.hook.snapshot()
+        if self._file is not None:
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run)
+            self._thread.daemon = True
+            self._thread.start()
+    
+    def close(self):
+        """
+        Write a last JSON line and stop.
+        """
+        if self._thread is not None:
+            self._stop.set()
+            self._thread.join()
+            self._thread = None
+        if self._file is not None:
+            self.write()
+            if self._file is not sys.stdout:
+                self._file.close()
+            self._file = None
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+    
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.write()
+            except Exception:
+                warnings.warn(traceback.format_exc(), RuntimeWarning)
+    
+    def write(self):
+        """
+        Append a JSON line with the current metrics to the file.
+        """
+        snapshot = self.hook.snapshot()
+        previous, self._previous = self._previous, snapshot
+        if previous is not None and snapshot['time'] > previous['time']:
+            elapsed = snapshot['time'] - previous['time']
+            snapshot['requests_per_second'] = \
+                (snapshot['requests'] - previous['requests']) / elapsed
+            snapshot['bytes_per_second'] = \
+                (snapshot['bytes'] - previous['bytes']) / elapsed
+        answered = snapshot['downloads'] + snapshot['not_modified']
+        if answered:
+            snapshot['not_modified_ratio'] = \
+                float(snapshot['not_modified']) / answered
+        self._file.write(json.dumps(snapshot, sort_keys=True) + '\n')
+        self._file.flush()
+
+#-----------------------------------------------------------------------------#
+
+class SeenSet(object):
+    """
+    Compact set of URLs, storing only a 64 bit fingerprint of each one in an
+    open addressing hash table. It takes between 11 and 21 bytes per URL,
+    while a Python set of strings takes well over 100.
+    
+    The price is a tiny chance of false positives: with 50 million URLs
+    the odds of any two of them sharing a fingerprint are about 1 in 15000.
+    
+    This class is not thread safe.
+    """
+    
+    # Array type code for 64 bit integers. Where longs are only 32 bits,
+    # use doubles instead, which hold integers of up to 53 bits exactly.
+    if array.array('L').itemsize >= 8:
+        _typecode = 'L'
+        _fp_mask  = (1 << 64) - 1
+    else:
+        _typecode = 'd'
+        _fp_mask  = (1 << 53) - 1
+    
+    # Maximum load factor before the table is resized.
+    _max_load = 0.75
+    
+    def __init__(self, expected=0):
+        """
+        @type  expected: int
+        @param expected: Optional, expected number of URLs. Sizing the table
+            in advance saves the time to resize it as it grows.
+        """
+        size = 1024
+        while size * self._max_load < expected:
+            size = size * 2
+        self._count = 0
+        self._resize(size)
+    
+    def __len__(self):
+        return self._count
+    
+    def __contains__(self, url):
+        table = self._table
+        mask  = self._mask
+        fp    = self._fingerprint(url)
+        index = fp & mask
+        while True:
+            slot = table[index]
+            if slot == fp:
+                return True
+            if not slot:
+                return False
+            index = (index + 1) & mask
+    
+    def add(self, url):
+        """
+        Add a URL to the set.
+        
+        @type  url: str
+        @param url: URL to add.
+        
+        @rtype:  bool
+        @return: C{True} if the URL was added,
+            C{False} if it was already in the set.
+        """
+        table = self._table
+        mask  = self._mask
+        fp    = self._fingerprint(url)
+        index = fp & mask
+        while True:
+            slot = table[index]
+            if slot == fp:
+                return False
+            if not slot:
+                break
+            index = (index + 1) & mask
+        table[index] = fp
+        self._count = self._count + 1
+        if self._count > self._limit:
+            self._resize(len(table) * 2)
+        return True
+    
+    # Hash the URL into a non zero fingerprint (zero marks empty slots)
+    def _fingerprint(self, url):
+        if isinstance(url, unicode):
+            url = url.encode('utf-8')
+        fp = struct.unpack('<Q', hashlib.md5(url).digest()[:8])[0]
+        return (fp & self._fp_mask) or 1
+    
+    # Rebuild the hash table with a new size (must be a power of 2)
+    def _resize(self, size):
+        old = getattr(self, '_table', ())
+        table = array.array(self._typecode, [0]) * size
+        mask = size - 1
+        for fp in old:
+            if fp:
+                index = int(fp) & mask
+                while table[index]:
+                    index = (index + 1) & mask
+                table[index] = fp
+        self._table = table
+        self._mask  = mask
+        self._limit = int(size * self._max_load)
 
 #-----------------------------------------------------------------------------#
 
-class History(object):
+class Frontier(object):
     """
-    Keeps a history of downloaded resources in a database.
-    
-    @type default_filename: str
-    @cvar default_filename: Default filename to use if not provided at the
-        constructor. This is the file part only, the directory part is taken
-        from the current user's home directory.
+    Thread safe queue of URLs pending to be crawled.
     
-    @type protocol: int
-    @cvar protocol: Pickle protocol for serialization
-    
-    Example::
-        with History() as history:
-            if not history.contains(url):
-                downloader = Downloader(options=options)
-                resource = downloader.download(url)
-                if resource:
-                    history.add(resource)
+    Targets are kept in one queue per host, and hosts take turns so no more
+    than C{maxperhost} downloads from the same host are running at the same
+    time, and consecutive downloads from the same host are at least C{delay}
+    seconds apart. While a host has to wait, targets from other hosts are
+    handed out instead. Each URL is only queued the first time it's seen.
     """
     
-    # Pickle protocol for serialization
-    protocol = pickle.HIGHEST_PROTOCOL
+    # Maximum time in seconds to wait before checking again if there's more
+    # work, in case it can come from somewhere that doesn't notify us
+    _poll_interval = None
     
-    # Default filename
-    default_filename = '.pycrawl_history'
-    
-    def __init__(self, filename=None):
+    def __init__(self, maxperhost=0, delay=0.0):
         """
-        @type  filename: str
-        @param filename:
-            Optional history file name. If this argument is not set, the
-            default filename is obtained from L{get_default_filename}.
+        @type  maxperhost: int
+        @param maxperhost: Maximum number of concurrent downloads per host.
+            Use C{0} for no limit.
+        
+        @type  delay: float
+        @param delay: Minimum time in seconds between downloads from the
+            same host. It can be changed for each host with L{set_delay}.
         """
-        self._filename = filename
-    
-    def __enter__(self):
-        self.open()
-        return self
+        self._maxperhost = maxperhost
+        self._delay   = delay
+        self._delays  = {}                      # host -> delay for the host
+        self._last    = {}                      # host -> last download time
+        self._wakeup  = None                    # when the next host is ready
+        self._cond    = threading.Condition(threading.Lock())
+        self._queues  = {}                      # host -> deque of targets
+        self._ready   = collections.deque()     # hosts with queued targets
+        self._active  = {}                      # host -> downloads in flight
+        self._seen    = SeenSet()               # URLs queued so far
+        self._pending = 0                       # targets queued or in flight
+        self._closed  = False
+        self.started  = time.time()             # when the crawl began
     
-    def __exit__(self, type, value, traceback):
-        self.close()
+    def __len__(self):
+        with self._cond:
+            return self._pending
     
-    def get_default_filename(self):
+    @staticmethod
+    def get_host(url):
         """
+        @type  url: str
+        @param url: URL to examine.
+        
         @rtype:  str
-        @return: The default history filename.
-            If not set in the constructor, the default filename depends on the
-            user home directory and the class attribute L{default_filename}.
+        @return: Host name and port the URL points to, in lowercase.
         """
-        filename = self._filename
-        if not filename:
-            home = ShellUtils.get_home_folder()
-            if not home:
-                home = os.path.curdir
-            filename = os.path.join(home, self.default_filename)
-        return filename
+        return urlparse.urlsplit(url).netloc.lower()
     
-    def open(self, filename=None):
+    def is_local(self, url):
         """
-        Open the history file.
+        @type  url: str
+        @param url: URL to examine.
         
-        @note: this closes the previously open file for this instance.
+        @rtype:  bool
+        @return: C{True} if targets with this URL are crawled by this
+            process, C{False} if they're sent somewhere else.
+        """
+        return True
+    
+    def was_seen(self, url):
+        """
+        @type  url: str
+        @param url: Normalized URL to examine.
         
-        @type  filename: str
-        @param filename: Optional history file name.
-            If this argument is not set, the default filename is used.
+        @rtype:  bool
+        @return: C{True} if the URL was queued before, C{False} otherwise.
         """
-        if not filename:
-            filename = self.get_default_filename()
-        db = anydbm.open(filename, 'c')
-        try:
-            if hasattr(self, '_db'):
-                self.close()
-        finally:
-            self._last_filename = filename
-            self._db = db
+        with self._cond:
+            return url in self._seen
     
-    def sync(self):
+    def put(self, url, referer=None):
         """
-        Persists database changes to disk.
+        Add a target to the frontier.
+        
+        @type  url: str
+        @param url: URL to crawl.
+        
+        @type  referer: str
+        @param referer: Referer URL, as in the C{Referer} HTTP header.
+        
+        @rtype:  bool
+        @return: C{True} if the target was queued,
+            C{False} if the URL was seen before.
         """
-        self._db.sync()
+        host = self.get_host(url)
+        with self._cond:
+            if not self._seen.add(url):
+                return False
+            if self._enqueue(host, url, referer):
+                self._ready.append(host)
+            self._pending = self._pending + 1
+            self._cond.notify()
+        return True
     
-    def revert(self):
+    def get(self, timeout=None):
         """
-        Revert all changes to the history file back to the last saved version.
+        Wait for the next target that may be downloaded. Every target
+        returned by this method must be released with L{task_done}.
+        
+        @type  timeout: float
+        @param timeout: Optional, maximum time to wait in seconds.
+        
+        @rtype:  tuple(str, str)
+        @return: Tuple with the URL and referer. Returns C{None} when there
+            are no more targets to crawl, when the frontier was closed, or
+            when the timeout expires.
         """
-        del self._db
-        self.open(self._last_filename)
+        if timeout is not None:
+            deadline = time.time() + timeout
+        with self._cond:
+            while not self._closed and self._more():
+                target = self._pop()
+                if target is not None:
+                    return target
+                wait = None
+                if timeout is not None:
+                    wait = deadline - time.time()
+                    if wait <= 0:
+                        break
+                if self._wakeup is not None:
+                    delay = self._wakeup - time.time()
+                    if wait is None or delay < wait:
+                        wait = max(delay, 0.001)
+                poll = self._poll_interval
+                if poll is not None and (wait is None or poll < wait):
+                    wait = poll
+                self._cond.wait(wait)
+        return None
     
-    def close(self):
+    # Returns True if the crawl is not over yet. Must be called with the
+    # lock held.
+    def _more(self):
+        return self._pending
+    
+    def set_delay(self, host, delay):
         """
-        Closes the history file. After calling this method, you are only
-        allowed to call the L{open} method before using this instance again.
-        This will automatically save all changes.
+        Set the minimum time between downloads from a host.
+        The delay given in the constructor is used for all other hosts.
+        
+        @type  host: str
+        @param host: Host name and port, as returned by L{get_host}.
+        
+        @type  delay: float
+        @param delay: Delay in seconds.
         """
-        try:
-            self.sync()
-        finally:
-            try:
-                self._db.close()
-            finally:
-                del self._db
+        with self._cond:
+            self._delays[host] = max(delay, self._delay)
+    
+    # Pop the next target from a host that's under the concurrency limit.
+    # Must be called with the lock held.
+    def _pop(self):
+        maxperhost = self._maxperhost
+        now = time.time()
+        wakeup = None
+        for _ in xrange(len(self._ready)):
+            host = self._ready.popleft()
+            active = self._active.get(host, 0)
+            if maxperhost and active >= maxperhost:
+                self._ready.append(host)
+                continue
+            if host in self._last:
+                ready = self._last[host] + self._delays.get(host, self._delay)
+                if ready > now:
+                    self._ready.append(host)
+                    if wakeup is None or ready < wakeup:
+                        wakeup = ready
+                    continue
+            target, more = self._dequeue(host)
+            if more:
+                self._ready.append(host)
+            if target is None:
+                continue
+            self._active[host] = active + 1
+            self._last[host] = now      # even if the delay is set later
+            self._wakeup = None
+            return target
+        self._wakeup = wakeup
+        return None
     
-    def _serialize(self, object):
-        return pickle.dumps(object, protocol=self.protocol)
+    # Queue a target for a host. Returns True if the host had no targets
+    # queued before. Must be called with the lock held.
+    def _enqueue(self, host, url, referer):
+        queue = self._queues.get(host)
+        if queue is None:
+            queue = collections.deque()
+            self._queues[host] = queue
+        queue.append( (url, referer) )
+        return len(queue) == 1
     
-    def _deserialize(self, serial):
-        return pickle.loads(serial)
+    # Take the next target for a host. Returns the target and whether there
+    # are more targets queued for the host, or None as the target if none
+    # was left after all. Must be called with the lock held.
+    def _dequeue(self, host):
+        queue = self._queues[host]
+        target = queue.popleft()
+        if not queue:
+            del self._queues[host]
+        return target, bool(queue)
     
-    def add(self, resource):
+    # Called when a target has been processed. Must be called with the lock
+    # held.
+    def _done(self, url):
+        pass
+    
+    def task_done(self, url):
         """
-        Save a downloaded HTTP resource to the history file.
+        Release a target returned by L{get} once it's been processed.
         
-        @type  resource: L{Resource}
-        @param resource: HTTP resource.
+        @type  url: str
+        @param url: URL returned by L{get}.
         """
-        try:
-            res_set = self._deserialize(self._db[resource.location])
-        except KeyError:
-            res_set = set()
-        res_set.add(resource)
-        self._db[resource.location] = self._serialize(res_set)
+        host = self.get_host(url)
+        with self._cond:
+            active = self._active[host] - 1
+            if active:
+                self._active[host] = active
+            else:
+                del self._active[host]
+            self._pending = self._pending - 1
+            self._done(url)
+            self._cond.notify_all()
     
-    def contains(self, location):
+    def checkpoint(self):
         """
-        Determine if at least one HTTP resource at the given URL was saved to
-        the history file.
-        
-        @type  location: str
-        @param location: URL of the HTTP resource to look for.
-        
-        @rtype: bool
-        @return:
-            C{True} if a resource at that URL was saved,
-            C{False} otherwise.
+        Save the state of the frontier, if it's persistent.
         """
-        return self._db.has_key(location)
+        pass
     
-    def get(self, location):
+    def close(self):
         """
-        Get all resources for the given URL from the history file.
-        
-        @type  location: str
-        @param location: URL of the HTTP resources to look for.
-        
-        @rtype: set(L{Resource})
-        @return: Set of HTTP resources. Returns C{None} if no resource was
-            found for that URL in the history file.
+        Stop the crawl. Targets still queued are discarded.
         """
-        try:
-            return self._deserialize(self._db[location])
-        except KeyError:
-            return None
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
 
 #-----------------------------------------------------------------------------#
 
-class HistoryHook(Hook):
+class DiskFrontier(Frontier):
     """
-    Downloader hook to use a history file.
+    L{Frontier} kept in an SQLite database, so a crawl can be resumed after
+    a crash or an interruption.
     
-    This provides more accurate tracking of which resources were downloaded
-    already and if they need to be downloaded again.
+    Queued targets stay on disk, and only a few of them per host are loaded
+    in memory at a time. Memory usage grows with the number of hosts rather
+    than the number of URLs, except for the set of seen URLs which takes
+    about 16 bytes per URL (see L{SeenSet}).
     
-    Example::
-        def my_download(url, options):
-            with History() as history:
-                hook = HistoryHook(history)
-                downloader = Downloader(options=options, hook=hook)
-                return downloader.download(url)
+    Changes are committed to disk every C{interval} seconds and when calling
+    L{checkpoint} or L{close}. Links found in a resource are always queued
+    before the resource is marked as done, so a checkpoint never records a
+    resource as crawled while losing its links. Targets that were being
+    downloaded when the crawl was interrupted are queued again on resume.
+    
+    @type default_filename: str
+    @cvar default_filename: Default filename, in the current user's home
+        directory.
     """
-    def __init__(self, history):
-        self.__history = history
     
-    def filter_request(self, dwn, req, url):
+    # Default filename
+    default_filename = '.pycrawl_frontier.db'
+    
+    # Maximum number of targets per host to load in memory at once
+    _head_size = 32
+    
+    # Database schema
+    _schema = (
+        "CREATE TABLE IF NOT EXISTS frontier ("
+            "id INTEGER PRIMARY KEY, "
+            "host TEXT NOT NULL, "
+            "url TEXT NOT NULL, "
+            "referer TEXT, "
+            "done INTEGER NOT NULL DEFAULT 0)",
+        "CREATE INDEX IF NOT EXISTS frontier_queue "
+            "ON frontier (done, host, id)",
+        "CREATE TABLE IF NOT EXISTS meta ("
+            "name TEXT PRIMARY KEY, "
+            "value)",
+    )
+    
+    def __init__(self, filename=None, maxperhost=0, delay=0.0, resume=False,
+                 interval=5.0):
+        """
+        @type  filename: str
+        @param filename: Optional frontier file name. Defaults to
+            L{default_filename} in the current user's home directory.
         
-        # Fetch all matching resources for this URL
-        # in the history file and skip if not found
-        res_set = self.__history.get(url)
-        if not res_set:
-            return True
+        @type  maxperhost: int
+        @param maxperhost: Maximum number of concurrent downloads per host.
+            Use C{0} for no limit.
         
-        # Calculate the target local filename
-        targetfile = os.path.join(*dwn.calc_local_name(url))
+        @type  delay: float
+        @param delay: Minimum time in seconds between downloads from the
+            same host.
         
-        # Get the current value for the If-Modified-Since header if present,
-        # or the local file time if not.
-        currenthdr = req.get_header('If-Modified-Since')
-        current = None
-        if currenthdr:
-            try:
-                current = rfc822.parsedate_tz(currenthdr)
-            except Exception:
-                current = None
-        if not current:
-            currenthdr = None
-            if os.path.exists(targetfile):
-                current = FileUtils.get_file_time(targetfile)
-                if current:
-                    try:
-                        currenthdr = rfc822.formatdate(current)
-                    except Exception:
-                        currenthdr = None
-                    if not currenthdr:
-                        current = None
+        @type  resume: bool
+        @param resume: C{True} to continue the crawl saved in the file,
+            C{False} to discard it and begin a new one.
         
-        # Iterate through all past downloads with the same URL
-        for resource in res_set:
-            
-            # Skip if the file was not successfully downloaded
-            datafile = resource.datafile
-            if not datafile:
-                continue
-            
-            # Skip if the target local file does not match
-            if datafile != targetfile:
-                continue
-            
-            # Skip if the local file does not exist in the target location
-            if not os.path.isfile(datafile):
-                continue
-            
-            # Get the resource's last modification time
-            lastmod = resource.parse_headers().get('Last-Modified', None)
-            timestamp = None
-            if lastmod:
+        @type  interval: float
+        @param interval: Time in seconds between automatic checkpoints.
+        """
+        Frontier.__init__(self, maxperhost, delay)
+        if not filename:
+            filename = self.get_default_filename()
+        self.filename  = filename
+        self._interval = interval
+        self._heads    = {}     # host -> deque of (id, url, referer) in memory
+        self._ondisk   = {}     # host -> number of targets not in memory
+        self._cursors  = {}     # host -> highest row id loaded in memory
+        self._inflight = {}     # url -> row id
+        db = sqlite3.connect(filename, check_same_thread=False)
+        try:
+            db.text_factory = str
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=NORMAL")
+            for statement in self._schema:
+                db.execute(statement)
+            self._db = db
+            if resume:
+                self._load()
+            else:
+                db.execute("DELETE FROM frontier")
+                db.execute("INSERT OR REPLACE INTO meta VALUES (?, ?)",
+                           ('started', self.started))
+            db.commit()
+        except:
+            db.close()
+            raise
+        self._last_checkpoint = time.time()
+    
+    @classmethod
+    def get_default_filename(cls):
+        """
+        @rtype:  str
+        @return: The default frontier filename, which depends on the user
+            home directory and the class attribute L{default_filename}.
+        """
+        home = ShellUtils.get_home_folder()
+        if not home:
+            home = os.path.curdir
+        return os.path.join(home, cls.default_filename)
+    
+    # Load the state of an interrupted crawl
+    def _load(self):
+        db = self._db
+        row = db.execute(
+            "SELECT value FROM meta WHERE name = 'started'").fetchone()
+        if row is not None:
+            self.started = row[0]
+        for (url,) in db.execute("SELECT url FROM frontier"):
+            self._seen.add(url)
+        for host, count in db.execute(
+                "SELECT host, COUNT(*) FROM frontier WHERE done = 0 "
+                "GROUP BY host"):
+            self._ondisk[host] = count
+            self._ready.append(host)
+            self._pending = self._pending + count
+    
+    def _enqueue(self, host, url, referer):
+        self._db.execute(
+            "INSERT INTO frontier (host, url, referer) VALUES (?, ?, ?)",
+            (host, url, referer))
+        count = self._ondisk.get(host, 0)
+        self._ondisk[host] = count + 1
+        self._auto_checkpoint()
+        return not count and not self._heads.get(host)
+    
+    def _dequeue(self, host):
+        head = self._heads.get(host)
+        if not head:
+            rows = self._db.execute(
+                "SELECT id, url, referer FROM frontier "
+                "WHERE done = 0 AND host = ? AND id > ? "
+                "ORDER BY id LIMIT ?",
+                (host, self._cursors.get(host, 0), self._head_size)
+            ).fetchall()
+            if not rows:
+                
+                # The count was wrong, so there's nothing left to crawl
+                self._pending = self._pending - self._ondisk.pop(host)
+                return None, False
+            head = collections.deque(rows)
+            self._heads[host] = head
+            self._cursors[host] = rows[-1][0]
+            count = self._ondisk[host] - len(rows)
+            if count:
+                self._ondisk[host] = count
+            else:
+                del self._ondisk[host]
+        row_id, url, referer = head.popleft()
+        self._inflight[url] = row_id
+        if not head:
+            del self._heads[host]
+        more = bool(head) or host in self._ondisk
+        return (url, referer), more
+    
+    def _done(self, url):
+        row_id = self._inflight.pop(url)
+        self._db.execute("UPDATE frontier SET done = 1 WHERE id = ?",
+                         (row_id,))
+        self._auto_checkpoint()
+    
+    # Commit to disk if enough time has passed since the last checkpoint.
+    # Must be called with the lock held.
+    def _auto_checkpoint(self):
+        now = time.time()
+        if now - self._last_checkpoint >= self._interval:
+            self._db.commit()
+            self._last_checkpoint = now
+    
+    def checkpoint(self):
+        """
+        Save the state of the frontier to disk.
+        """
+        with self._cond:
+            self._db.commit()
+            self._last_checkpoint = time.time()
+    
+    def close(self):
+        """
+        Stop the crawl, save the state of the frontier and close the file.
+        The crawl can be continued later by passing C{resume=True} to the
+        constructor.
+        """
+        Frontier.close(self)
+        with self._cond:
+            if self._db is not None:
                 try:
-                    timestamp = rfc822.parsedate_tz(lastmod)
-                except Exception:
-                    timestamp = None
-            if not timestamp:
-                lastmod = None
-                timestamp = resource.timestamp
-                if timestamp:
-                    try:
-                        lastmod = rfc822.formatdate(timestamp)
-                    except Exception:
-                        lastmod = None
-                if not lastmod:
-                    timestamp = None
-            
-            # If this timestamp is newer than the current timestamp,
-            # update the If-Modified-Since header
-            if timestamp and (not current or timestamp > current):
-                current = timestamp
-                currenthdr = lastmod
-        
-        # If we have an updated If-Modified-Since header, set it
-        if currenthdr:
-            req.add_header('If-Modified-Since', currenthdr)
+                    self._db.commit()
+                finally:
+                    self._db.close()
+                    self._db = None
+
+#-----------------------------------------------------------------------------#
+
+class ShardRing(object):
+    """
+    Consistent hash ring that assigns hosts to the shards of a multi-process
+    crawl.
+    
+    Each shard is placed at several points of the ring, and a host belongs
+    to the shard of the first point after the hash of its name. All the
+    targets of a host go to the same shard, so the per-host limits and
+    delays still apply, and changing the number of shards only moves the
+    hosts next to the points added or removed.
+    
+    @type shards: int
+    @ivar shards: Number of shards.
+    """
+    
+    def __init__(self, shards, replicas=64):
+        """
+        @type  shards: int
+        @param shards: Number of shards.
         
-        return True
+        @type  replicas: int
+        @param replicas: Number of points of the ring for each shard.
+            More points spread the hosts more evenly.
+        """
+        points = []
+        for shard in xrange(shards):
+            for replica in xrange(replicas):
+                points.append( (self._hash('%d-%d' % (shard, replica)),
+                                shard) )
+        points.sort()
+        self.shards  = shards
+        self._hashes = [point[0] for point in points]
+        self._owners = [point[1] for point in points]
     
-    # Same processing as filter_request
-    def filter_redirect(self, dwn, req, newurl):
-        return self.filter_request(dwn, req, newurl)
+    # Hash a string into a point of the ring
+    @staticmethod
+    def _hash(key):
+        return struct.unpack('>Q', hashlib.md5(key).digest()[:8])[0]
     
-    # Record downloaded resources into the history file
-    def filter_resource(self, dwn, resource):
-        self.__history.add(resource)
-        return True
+    def get_shard(self, host):
+        """
+        @type  host: str
+        @param host: Host name and port, as returned by L{Frontier.get_host}.
+        
+        @rtype:  int
+        @return: Index of the shard that owns the host.
+        """
+        index = bisect.bisect(self._hashes, self._hash(host))
+        return self._owners[index % len(self._owners)]
 
 #-----------------------------------------------------------------------------#
 
-class Cookies(cookielib.LWPCookieJar, Configurable):
+class ShardedFrontier(Frontier):
     """
-    Persistent cookie jar. Based on LWPCookieJar for persistence, with some
-    minor tweaks (has a default filename and supports the C{with} clause).
+    L{Frontier} for one process of a multi-process crawl.
+    
+    Each process owns the hosts that a L{ShardRing} assigns to it. Targets
+    for other hosts are sent to the process that owns them, through its
+    inbox queue, and a background thread queues the targets arriving at
+    this process' inbox. Targets are sent in batches when a target is
+    released with L{task_done}, so each parsed page costs at most one
+    message per process.
+    
+    A counter shared by all the processes keeps the number of targets
+    queued, in flight or in transit anywhere. Every target is counted before
+    the one that found it is released, so the counter only drops to zero
+    when the whole crawl is over, and that's when L{get} returns C{None}.
+    If a process dies its targets are never released, so the parent must
+    call L{abort} to close the frontiers of the others.
     """
     
-    default_filename = '.pycrawl_cookies'
+    # Check the shared counter this often when idle, since other processes
+    # can't notify us
+    _poll_interval = 0.1
     
-    class _DefaultOptions(object):
+    def __init__(self, ring, index, inboxes, outstanding,
+                 maxperhost=0, delay=0.0):
         """
-        Default options for L{Cookies}.
+        @type  ring: L{ShardRing}
+        @param ring: Assignment of hosts to shards.
+        
+        @type  index: int
+        @param index: Shard of this process.
+        
+        @type  inboxes: list(multiprocessing.Queue)
+        @param inboxes: Inbox queue of each shard.
+        
+        @type  outstanding: multiprocessing.Value
+        @param outstanding: Counter shared by all the shards,
+            see L{create_counter}.
+        
+        @type  maxperhost: int
+        @param maxperhost: Maximum number of concurrent downloads per host.
+            Use C{0} for no limit.
+        
+        @type  delay: float
+        @param delay: Minimum time in seconds between downloads from the
+            same host.
         """
+        Frontier.__init__(self, maxperhost, delay)
+        self._ring        = ring
+        self._index       = index
+        self._inboxes     = inboxes
+        self._outstanding = outstanding
+        self._routed      = SeenSet()   # URLs sent to other shards
+        self._outbox      = {}          # shard -> targets not sent yet
+        self._outlock     = threading.Lock()
+        self._receiver    = None
+    
+    @staticmethod
+    def create_counter():
+        """
+        @rtype:  multiprocessing.Value
+        @return: New counter to share between the shards of a crawl.
+        """
+        return multiprocessing.Value('l', 0)
+    
+    @staticmethod
+    def seed(ring, inboxes, outstanding, url, referer=None):
+        """
+        Send the first target of a crawl to the shard that owns it, before
+        the shards are started.
         
-        def __init__(self):
-            self.cookie_file  = None
-            self.load_cookies = True
-            self.save_cookies = True
+        @type  ring: L{ShardRing}
+        @param ring: Assignment of hosts to shards.
+        
+        @type  inboxes: list(multiprocessing.Queue)
+        @param inboxes: Inbox queue of each shard.
+        
+        @type  outstanding: multiprocessing.Value
+        @param outstanding: Counter shared by all the shards.
+        
+        @type  url: str
+        @param url: Normalized URL to crawl.
+        
+        @type  referer: str
+        @param referer: Referer URL, as in the C{Referer} HTTP header.
+        """
+        with outstanding.get_lock():
+            outstanding.value = outstanding.value + 1
+        shard = ring.get_shard(Frontier.get_host(url))
+        inboxes[shard].put([ (url, referer) ])
     
-    def __init__(self, options=None):
-        Configurable.__init__(self, options)
-        filename = options.cookie_file
-        if not filename:
-            filename = self.get_default_filename()
-        cookielib.LWPCookieJar.__init__(self, filename, False, None)
+    @staticmethod
+    def abort(inboxes):
+        """
+        Close the frontiers of all the shards, discarding the targets still
+        queued. Used to end the crawl when a shard died, since the targets
+        counted by it will never be released.
+        
+        @type  inboxes: list(multiprocessing.Queue)
+        @param inboxes: Inbox queue of each shard.
+        """
+        for inbox in inboxes:
+            inbox.put(False)
     
-    def get_default_filename(self):
+    def start(self):
         """
-        The default filename is calculated from the user's home directory and
-        the L{default_filename} class attribute.
+        Start receiving targets from the other shards.
         """
-        home = ShellUtils.get_home_folder()
-        if not home:
-            home = os.path.curdir
-        return os.path.join(home, self.default_filename)
+        self._receiver = threading.Thread(target=self._receive)
+        self._receiver.daemon = True
+        self._receiver.start()
     
-    def __enter__(self):
+    def stop(self):
         """
-        Upon entering a context the cookies are automatically loaded if the
-        file exists.
+        Stop receiving targets from the other shards.
         """
-        if self.options.load_cookies and os.path.exists(self.filename):
-            self.load()
-        return self
+        receiver, self._receiver = self._receiver, None
+        if receiver is not None:
+            self._inboxes[self._index].put(None)
+            receiver.join()
     
-    def __exit__(self, type, value, traceback):
+    # Add to the shared counter
+    def _count(self, delta):
+        outstanding = self._outstanding
+        with outstanding.get_lock():
+            outstanding.value = outstanding.value + delta
+    
+    # Queue the targets arriving at our inbox. They were counted when sent,
+    # so the count is dropped for those seen before.
+    def _receive(self):
+        inbox = self._inboxes[self._index]
+        while True:
+            targets = inbox.get()
+            if targets is None:
+                break
+            if targets is False:        # see abort()
+                Frontier.close(self)
+                break
+            dropped = 0
+            for url, referer in targets:
+                if not Frontier.put(self, url, referer):
+                    dropped = dropped + 1
+            if dropped:
+                self._count(-dropped)
+    
+    def is_local(self, url):
+        return self._ring.get_shard(self.get_host(url)) == self._index
+    
+    def put(self, url, referer=None):
         """
-        Upon exiting a context the cookies are automatically saved to the file.
+        Add a target to the frontier, or send it to the shard that owns it.
+        
+        @type  url: str
+        @param url: URL to crawl.
+        
+        @type  referer: str
+        @param referer: Referer URL, as in the C{Referer} HTTP header.
+        
+        @rtype:  bool
+        @return: C{True} if the target was queued or sent,
+            C{False} if the URL was seen before.
         """
-        if self.options.save_cookies:
-            self.save()
+        shard = self._ring.get_shard(self.get_host(url))
+        if shard == self._index:
+            self._count(1)      # before another thread can release it
+            if Frontier.put(self, url, referer):
+                return True
+            self._count(-1)
+            return False
+        with self._outlock:
+            if not self._routed.add(url):
+                return False
+            self._outbox.setdefault(shard, []).append( (url, referer) )
+        return True
+    
+    def flush(self):
+        """
+        Send the targets for other shards found so far.
+        """
+        with self._outlock:
+            outbox, self._outbox = self._outbox, {}
+        if outbox:
+            self._count(sum(len(targets) for targets in outbox.itervalues()))
+            for shard, targets in outbox.iteritems():
+                self._inboxes[shard].put(targets)
+    
+    def task_done(self, url):
+        """
+        Release a target returned by L{get} once it's been processed,
+        sending the targets it found for other shards first.
+        
+        @type  url: str
+        @param url: URL returned by L{get}.
+        """
+        self.flush()
+        Frontier.task_done(self, url)
+        self._count(-1)
+    
+    # The crawl is over when there's nothing left anywhere
+    def _more(self):
+        return self._pending or self._outstanding.value > 0
+    
+    def close(self):
+        """
+        Stop the crawl in this process. Targets still queued are discarded.
+        """
+        Frontier.close(self)
+        self.stop()
 
 #-----------------------------------------------------------------------------#
 
@@ -1483,86 +7094,480 @@ class Crawler(Downloader):
     Web crawler.
     """
     
-    # Maximum size in bytes of files to be parsed in-memory.
+    # Maximum size in bytes of file data to be parsed in-memory at once.
     _max_in_mem_parse = 1024 * 1024
     
+    # Maximum length of URLs captured in plaintext. Longer URLs are truncated.
+    _max_url_length = 4096
+    
+    # Maximum number of queued URLs to pass to the hooks at once.
+    _max_targets_batch = 500
+    
     # Regular expression to capture URLs in plaintext.
-    tmp = "%(c)s((?:https?|ftp)://[^%(c)s]*[^%(c)s\\.])%(c)s"
-    _reURL = re.compile("(?:%s|(?:%s|%s))" % (
-                tmp % {'c' : '\\b'},
-                tmp % {'c' : '"'},
-                tmp % {'c' : "'"},
-                ), re.IGNORECASE)
+    # Each alternative has its own group, use lastindex to get the URL.
+    # The length of the matches must be bounded to parse files in chunks.
+    tmp = "%(a)s((?:https?|ftp)://[^%(x)s]{0,%(n)d}[^%(x)s\\.])%(b)s"
+    _reURL = re.compile("(?:%s|%s|%s)" % (
+        tmp % {'a':'\\b', 'b':'',  'x':'\\s"\'<>', 'n':_max_url_length},
+        tmp % {'a':'"',   'b':'"', 'x':'"',       'n':_max_url_length},
+        tmp % {'a':"'",   'b':"'", 'x':"'",       'n':_max_url_length},
+        ), re.IGNORECASE)
     del tmp
     
+    # Longest possible match of the regular expression above, plus a margin.
+    _max_match_length = _max_url_length + 16
+    
+    # Content types to be parsed as HTML.
+    _html_content_types = ('text/html', 'application/xhtml+xml')
+    
     class _DefaultOptions(Downloader._OptionsSiteMirrorMode):
         """
         Default options for L{Crawler}.
         """
-
-    def __init__(self, options=None, cookiejar=None, hooks=None):
         
-        # TODO
+        def __init__(self):
+            Downloader._OptionsSiteMirrorMode.__init__(self)
+            self.workers = 8
+            self.maxperhost = 2
+            self.crawldelay = 0.0
+            self.obeyrobots = True
+            self.robotscache = 1000
+            self.frontierfile = None
+            self.resume = False
+    
+    # History to check for targets already downloaded, when resuming.
+    _resume_history = None
+    
+    def __init__(self, options=None, cookiejar=None, hooks=None,
+                 frontier=None):
+        """
+        @type  options: Options
+        @param options: Optional, configuration.
+        
+        @type  cookiejar: cookielib.CookieJar
+        @param cookiejar: Optional, HTTP cookie jar.
+        
+        @type  hooks: list(L{Hook})
+        @param hooks: Hook chain in order of execution.
+        
+        @type  frontier: L{Frontier}
+        @param frontier: Optional, crawl frontier to use instead of the one
+            built from the options, such as a L{ShardedFrontier}.
+        """
         
         Downloader.__init__(self, options, cookiejar, hooks)
+        
+        # Crawl frontier, shared by all worker threads.
+        # It's kept on disk when a filename is given, to resume crawls.
+        options = self.options
+        self.__own_frontier = frontier is None
+        if frontier is not None:
+            self.frontier = frontier
+        elif options.frontierfile:
+            self.frontier = DiskFrontier(options.frontierfile,
+                                         maxperhost = options.maxperhost,
+                                         delay      = options.crawldelay,
+                                         resume     = options.resume)
+        else:
+            self.frontier = Frontier(options.maxperhost, options.crawldelay)
+        
+        # Obey robots.txt files before anything else
+        if options.obeyrobots:
+            self.prepend_hook(RobotsHook(options.robotscache))
+    
+    def close(self):
+        """
+        Close any persistent connections left open, and the frontier file if
+        the crawler opened one, saving its state. The crawler may still be
+        used after calling this method, unless its frontier is kept on disk.
+        """
+        try:
+            Downloader.close(self)
+        finally:
+            if self.__own_frontier and isinstance(self.frontier, DiskFrontier):
+                self.frontier.close()
+            else:
+                self.frontier.checkpoint()
     
     def crawl(self, url, referer=None):
         """
         Download the given resource and all linked resources.
         
+        Downloads are performed by a pool of C{workers} threads (see the
+        options), and URLs already crawled by this instance are skipped.
+        
         @type  url: str
         @param url: Resource URL. Only "http://" and "https://" are supported.
         
         @type  referer: str
         @param referer: Referer URL, as in the C{Referer} HTTP header.
         """
-        self.targets = [(url, referer)]
-        while self.targets:
-            url, referer = self.targets.pop()
-            res = self.download(url, referer)
-            if res:
-                self.parse(res)
+        sort_query = self.options.sortquery
+        self.frontier.put(HttpUtils.normalize_url(url, sort_query), referer)
+        self._run_workers()
+    
+    def resume(self, history=None):
+        """
+        Continue an interrupted crawl. This only makes sense when the
+        frontier is kept on disk (see the C{frontierfile} and C{resume}
+        options).
+        
+        @type  history: L{History}
+        @param history: Optional history file. Targets recorded in it since
+            the crawl began are not downloaded again, instead their local
+            copies are parsed to queue the links they contain.
+        """
+        self._resume_history = history
+        try:
+            self._run_workers()
+        finally:
+            self._resume_history = None
+    
+    def run(self):
+        """
+        Crawl the targets already in the frontier, and all linked resources.
+        """
+        self._run_workers()
     
-    def add_targets(urls, referer):
+    # Run the worker threads until the frontier is exhausted
+    def _run_workers(self):
+        frontier = self.frontier
+        workers = max(1, self.options.workers)
+        try:
+            
+            # With a single worker there's no need to spawn threads
+            if workers == 1:
+                self._crawl_worker()
+                return
+            
+            threads = []
+            for _ in xrange(workers):
+                t = threading.Thread(target=self._crawl_worker)
+                t.daemon = True
+                t.start()
+                threads.append(t)
+            for t in threads:
+                while t.is_alive():     # join() can't be interrupted
+                    t.join(1.0)
+        except:
+            frontier.close()
+            raise
+    
+    # When the server says our copy is up to date, parse the local copy
+    # instead so the links in it are still followed
+    def _not_modified(self, req, url, referer):
+        validators = getattr(req, 'validators', None)
+        if validators is None:
+            return None
+        timestamp = FileUtils.get_file_time(validators.datafile)
+        if timestamp is None:
+            return None
+        headers = ''
+        if validators.content_type:
+            headers = 'Content-Type: %s\r\n' % validators.content_type
+        return Resource(timestamp, url, validators.location,
+                        validators.datafile, referer, headers,
+                        encoding = validators.encoding,
+                        digest   = validators.digest)
+    
+    # Worker loop: download and parse targets until the frontier is exhausted
+    def _crawl_worker(self):
+        frontier = self.frontier
+        history  = self._resume_history
+        while True:
+            target = frontier.get()
+            if target is None:
+                break
+            url, referer = target
+            try:
+                res = None
+                if history is not None:
+                    res = history.get_latest(url, since=frontier.started)
+                    if res is not None and not os.path.isfile(res.datafile):
+                        res = None
+                if res is None:
+                    res = self.download(url, referer)
+                if res:
+                    self.parse(res)
+            except Exception, e:
+                msg = "Error crawling %s: %s" % (url, e)
+                warnings.warn(msg, RuntimeWarning)
+            finally:
+                frontier.task_done(url)
+    
+    def add_targets(self, urls, referer):
+        """
+        Queue URLs found in a crawled resource. The new URLs for this
+        process are passed in batches to the C{handle_targets} method of
+        the hooks, before they're queued, so the hooks are done with them
+        by the time a worker takes them.
+        
+        @type  urls: list(str)
+        @param urls: URLs to crawl.
+        
+        @type  referer: str
+        @param referer: Referer URL, as in the C{Referer} HTTP header.
+        """
+        normalize = HttpUtils.normalize_url
+        sort_query = self.options.sortquery
+        if not self._on_targets:
+            put = self.frontier.put
+            for url in urls:
+                put(normalize(url, sort_query), referer)
+            return
+        batch = []
         for url in urls:
-            self.targets.append( (url, referer) )
+            batch.append(normalize(url, sort_query))
+            if len(batch) >= self._max_targets_batch:
+                self.__put_targets(batch, referer)
+                batch = []
+        if batch:
+            self.__put_targets(batch, referer)
+    
+    # Pass a batch of targets to the handle_targets hooks, then queue them
+    def __put_targets(self, batch, referer):
+        frontier = self.frontier
+        new = []
+        found = set()
+        for url in batch:
+            if url not in found and frontier.is_local(url) \
+                                and not frontier.was_seen(url):
+                new.append(url)
+                found.add(url)
+        if new:
+            self._handle_targets(self, new)
+        for url in batch:
+            frontier.put(url, referer)
     
     def parse(self, res):
-        content_type = res.parse_headers().get('Content-Type')
+        content_type = res.get_header('Content-Type')
         if content_type is not None:
-            content_type = content_type.lower()
-            if content_type == 'text/html':
+            content_type = content_type.split(';')[0].strip().lower()
+            if content_type in self._html_content_types:
                 self.parse_html(res)
             elif content_type.startswith('text/'):
                 self.parse_text(res)
     
+    # Open the local copy of a resource, decoding it on the fly
+    # if it was saved compressed
+    def _open_datafile(self, res):
+        fd = open(res.datafile, 'rb')
+        if res.encoding in HttpUtils.content_encodings:
+            fd = self._DecodingReader(fd, res.encoding)
+        return fd
+    
     def parse_text(self, res):
-        if FileUtils.get_file_size(res.datafile) <= self._max_in_mem_parse:
-            with open(res.datafile, 'rb') as fd:
-                data = fd.read()
-            urls = self._reURL.findall(data)
-            del data
-            self.add_targets(urls, res.location)
-            del urls
+        with self._open_datafile(res) as fd:
+            for urls in self.scan_urls(fd, self._max_in_mem_parse):
+                self.add_targets(urls, res.location)
+    
+    @classmethod
+    def scan_urls(cls, fd, chunk_size):
+        """
+        Find URLs in plain text, reading the file in chunks. Memory usage
+        depends only on the chunk size, not on the size of the file.
         
+        URLs that span the boundary between two chunks are found too: the
+        tail of each chunk that could hold the beginning of an incomplete
+        match is carried over and scanned again with the next chunk.
         
-        else:
+        @type  fd: file
+        @param fd: File object to read from.
+        
+        @type  chunk_size: int
+        @param chunk_size: Number of bytes to read at a time.
+        
+        @rtype:  generator of list(str)
+        @return: Yields the URLs found, one list per chunk.
+        """
+        pattern  = cls._reURL
+        overlap  = cls._max_match_length
+        chunk_size = max(chunk_size, overlap)
+        buf   = ''
+        start = 0       # where to resume scanning the buffer
+        while True:
+            chunk = fd.read(chunk_size)
+            buf = buf + chunk
             
-            # TODO
+            # Matches beginning before the limit can't grow with more data,
+            # so they're final. At the end of the file all matches are.
+            if chunk:
+                limit = len(buf) - overlap
+            else:
+                limit = len(buf)
+            urls = []
+            last = start
+            for match in pattern.finditer(buf, start):
+                if match.start() >= limit:
+                    break
+                urls.append(match.group(match.lastindex))
+                last = match.end()
+            if urls:
+                yield urls
+            if not chunk:
+                break
             
-            pass
+            # Carry over the unscanned tail, plus one character of context
+            # so the word boundary at the beginning is still detected.
+            start = max(last, limit)
+            keep  = max(start - 1, 0)
+            buf   = buf[keep:]
+            start = start - keep
     
     def parse_html(self, res):
         try:
-            BeautifulSoup
-        except NameError:
-            return parse_text(res)
+            with self._open_datafile(res) as fd:
+                for urls in self.scan_html(fd, res.location,
+                                           self._max_in_mem_parse):
+                    self.add_targets(urls, res.location)
         
+        # If the HTML parser chokes, fall back to the plain text parser.
+        # URLs found twice are discarded by the frontier anyway.
+        except HTMLParser.HTMLParseError:
+            self.parse_text(res)
+    
+    @classmethod
+    def scan_html(cls, fd, base, chunk_size):
+        """
+        Find links in an HTML document, feeding it to an incremental parser
+        in chunks. The document tree is never built, so memory usage depends
+        only on the chunk size.
         
+        Links are taken from C{href}, C{src}, C{srcset} and similar
+        attributes, and from C{<meta http-equiv="refresh">} tags. Relative
+        links are resolved against the C{<base>} tag if present, or the
+        given base URL otherwise.
         
-        # TODO
+        @type  fd: file
+        @param fd: File object to read from.
         
-        pass
+        @type  base: str
+        @param base: URL of the document.
+        
+        @type  chunk_size: int
+        @param chunk_size: Number of bytes to read at a time.
+        
+        @rtype:  generator of list(str)
+        @return: Yields the absolute URLs found, one list per chunk.
+        
+        @raise HTMLParser.HTMLParseError: The document is too malformed.
+        """
+        parser = cls._LinkParser(base)
+        while True:
+            chunk = fd.read(chunk_size)
+            if chunk:
+                parser.feed(chunk)
+            else:
+                parser.close()
+            if parser.urls:
+                yield parser.urls
+                parser.urls = []
+            if not chunk:
+                break
+    
+    class _LinkParser(HTMLParser.HTMLParser):
+        """
+        Incremental HTML parser that collects links into the C{urls} list.
+        """
+        
+        # Tag attributes that hold a single URL
+        _url_attrs = {
+            'a'      : ('href',),
+            'area'   : ('href',),
+            'link'   : ('href',),
+            'img'    : ('src', 'lowsrc', 'longdesc'),
+            'script' : ('src',),
+            'iframe' : ('src', 'longdesc'),
+            'frame'  : ('src', 'longdesc'),
+            'embed'  : ('src',),
+            'source' : ('src',),
+            'audio'  : ('src',),
+            'video'  : ('src', 'poster'),
+            'track'  : ('src',),
+            'input'  : ('src',),
+            'object' : ('data',),
+            'body'   : ('background',),
+            'table'  : ('background',),
+            'td'     : ('background',),
+        }
+        
+        # URL schemes we can crawl
+        _schemes = ('http', 'https', 'ftp')
+        
+        # Regexp to get the URL from the meta refresh tag
+        _reRefresh = re.compile(r'^\s*\d*\s*[;,]?\s*url\s*=\s*(.*)$', re.I)
+        
+        # Regexp to find HTML entities, same as HTMLParser's
+        _reEntity = re.compile(r"&(#?[xX]?(?:[0-9a-fA-F]+|\w{1,8}));")
+        
+        def __init__(self, base):
+            HTMLParser.HTMLParser.__init__(self)
+            self.base = base
+            self.urls = []
+            self._seen_base = False
+        
+        def add_url(self, url):
+            url = url.strip()
+            if url:
+                url = urlparse.urljoin(self.base, url)
+                if url[:url.find(':')].lower() in self._schemes:
+                    self.urls.append(url)
+        
+        def handle_startendtag(self, tag, attrs):
+            self.handle_starttag(tag, attrs)
+        
+        def handle_starttag(self, tag, attrs):
+            names = self._url_attrs.get(tag)
+            if names:
+                for name, value in attrs:
+                    if value and name in names:
+                        self.add_url(value)
+            if tag in ('img', 'source'):
+                for name, value in attrs:
+                    if value and name == 'srcset':
+                        for candidate in value.split(','):
+                            candidate = candidate.split()
+                            if candidate:
+                                self.add_url(candidate[0])
+            elif tag == 'meta':
+                attrs = dict(attrs)
+                equiv = attrs.get('http-equiv')
+                content = attrs.get('content')
+                if equiv and content and equiv.lower() == 'refresh':
+                    match = self._reRefresh.match(content)
+                    if match:
+                        self.add_url(match.group(1).strip('\'"'))
+            
+            # Only the first <base> tag counts
+            elif tag == 'base' and not self._seen_base:
+                for name, value in attrs:
+                    if value and name == 'href':
+                        self.base = urlparse.urljoin(self.base, value.strip())
+                        self._seen_base = True
+        
+        # HTMLParser.unescape mixes unicode with byte strings, which breaks
+        # with non ASCII characters, so decode the entities as UTF-8 instead
+        def unescape(self, s):
+            if '&' not in s:
+                return s
+            return self._reEntity.sub(self._replace_entity, s)
+        
+        @staticmethod
+        def _replace_entity(match):
+            s = match.group(1)
+            try:
+                if s[0] == '#':
+                    if s[1] in 'xX':
+                        c = int(s[2:], 16)
+                    else:
+                        c = int(s[1:])
+                elif s == 'apos':
+                    c = ord("'")
+                else:
+                    c = htmlentitydefs.name2codepoint[s]
+                return unichr(c).encode('utf-8')
+            except (ValueError, KeyError, OverflowError, IndexError):
+                return match.group(0)
 
 #-----------------------------------------------------------------------------#
 
@@ -1577,74 +7582,434 @@ class Main(object):
             Cookies._DefaultOptions.__init__(self)
             self.keep_history = True
             self.history_file = None
+            self.history_batch = 100
+            self.history_interval = 1.0
             self.referer = None
             self.recursive = True
+            self.frontierfile = None    # the default one is used to resume
+            self.processes = 1      # more than one needs no frontier file
+            self.metrics_file = None        # JSON lines, "-" for stdout
+            self.metrics_interval = 10.0
+            self.metrics_address = None     # (host, port) for Prometheus
+            self.verbose = False            # print requests and responses
+    
+    # Values for --onduplicate
+    _onduplicate = {
+        'overwrite' : Downloader.ON_DUPLICATE_OVERWRITE,
+        'rename'    : Downloader.ON_DUPLICATE_RENAME,
+        'fail'      : Downloader.ON_DUPLICATE_FAIL,
+        'skip'      : Downloader.ON_DUPLICATE_SKIP,
+    }
+    
+    # Build the commandline parser
+    def __get_parser(self):
+        usage = '%prog [options] [URL...]'
+        parser = optparse.OptionParser(usage=usage)
+        
+        group = optparse.OptionGroup(parser, 'Input')
+        group.add_option('-i', '--input', metavar='FILE', action='append',
+                         default=[],
+                         help='read URLs from FILE, one per line '
+                              '("-" for standard input)')
+        group.add_option('--referer', metavar='URL',
+                         help='referer URL for the given URLs')
+        parser.add_option_group(group)
+        
+        group = optparse.OptionGroup(parser, 'Crawling',
+                    'Without -r the URLs are downloaded in download manager '
+                    'mode, otherwise in site mirror mode.')
+        group.add_option('-r', '--recursive', action='store_true',
+                         default=False,
+                         help='also download the linked resources')
+        group.add_option('--resume', action='store_true', default=False,
+                         help='continue an interrupted crawl, started with '
+                              '--frontier so it can be resumed (implies -r)')
+        group.add_option('--frontier', dest='frontierfile', metavar='FILE',
+                         help='keep the crawl frontier in this file, so the '
+                              'crawl can be resumed (default for --resume: '
+                              '~/%s)' % DiskFrontier.default_filename)
+        group.add_option('-w', '--workers', type='int',
+                         help='number of concurrent downloads')
+        group.add_option('--processes', type='int',
+                         help='number of crawler processes (can\'t be used '
+                              'with --resume or --frontier)')
+        group.add_option('--maxperhost', type='int',
+                         help='concurrent downloads per host when crawling')
+        group.add_option('--crawldelay', type='float', metavar='SECONDS',
+                         help='delay between requests to the same host')
+        group.add_option('--ignore-robots', dest='obeyrobots',
+                         action='store_false',
+                         help='ignore robots.txt files')
+        parser.add_option_group(group)
+        
+        group = optparse.OptionGroup(parser, 'Output')
+        group.add_option('-d', '--targetdir', metavar='DIR',
+                         help='directory to save the files to')
+        group.add_option('--flatten', action='store_true',
+                         help='save all files in the target directory')
+        group.add_option('--no-flatten', dest='flatten',
+                         action='store_false',
+                         help='save files in a directory for each host')
+        group.add_option('--onduplicate', type='choice',
+                         choices=sorted(self._onduplicate),
+                         help='what to do when a file exists: %s' %
+                              ', '.join(sorted(self._onduplicate)))
+        group.add_option('--usefstimes', action='store_true',
+                         help='set file times from the server and skip '
+                              'files not modified since')
+        group.add_option('--no-usefstimes', dest='usefstimes',
+                         action='store_false',
+                         help="don't use the file times")
+        parser.add_option_group(group)
+        
+        group = optparse.OptionGroup(parser, 'Cookies')
+        group.add_option('--cookies', dest='cookie_file', metavar='FILE',
+                         help='cookies file')
+        group.add_option('--no-load-cookies', dest='load_cookies',
+                         action='store_false',
+                         help="don't load the cookies file")
+        group.add_option('--no-save-cookies', dest='save_cookies',
+                         action='store_false',
+                         help="don't save the cookies file")
+        parser.add_option_group(group)
+        
+        group = optparse.OptionGroup(parser, 'History')
+        group.add_option('--history', dest='history_file', metavar='FILE',
+                         help='history file')
+        group.add_option('--no-history', dest='keep_history',
+                         action='store_false',
+                         help="don't keep a history file")
+        group.add_option('--import-history', metavar='FILE',
+                         help='import a history file of the old format '
+                              'and exit')
+        group.add_option('--merge-history', action='store_true',
+                         default=False,
+                         help='merge the history partitions given as '
+                              'arguments, or left by an interrupted '
+                              'multi-process crawl, and exit')
+        parser.add_option_group(group)
+        
+        group = optparse.OptionGroup(parser, 'Metrics')
+        group.add_option('--metrics-file', metavar='FILE',
+                         help='append metrics to FILE as JSON lines '
+                              '("-" for standard output)')
+        group.add_option('--metrics-interval', type='float',
+                         metavar='SECONDS',
+                         help='time between JSON lines')
+        group.add_option('--metrics-address', metavar='[HOST:]PORT',
+                         help='serve metrics for Prometheus on this port')
+        group.add_option('-v', '--verbose', action='store_true',
+                         help='print every request and response')
+        parser.add_option_group(group)
+        
+        return parser
+    
+    # Options copied as they are from the commandline when given
+    _copied_options = (
+        'referer', 'workers', 'processes', 'maxperhost', 'crawldelay',
+        'obeyrobots', 'targetdir', 'flatten', 'usefstimes', 'cookie_file',
+        'load_cookies', 'save_cookies', 'history_file', 'keep_history',
+        'metrics_file', 'metrics_interval', 'verbose', 'frontierfile',
+    )
     
     # Parse the commandline
     def run(self, argv=None):
         if argv is None:
             argv = sys.argv
+        parser = self.__get_parser()
+        cmdline, args = parser.parse_args(argv[1:])
         
+        # Convert a history file from the old anydbm format
+        if cmdline.import_history:
+            self.import_history(cmdline.import_history,
+                                cmdline.history_file)
+            return
         
+        # Merge the history partitions of a multi-process crawl
+        if cmdline.merge_history:
+            self.merge_history(cmdline.history_file, args)
+            return
         
-        # TODO
+        # URLs from the commandline first, then from the input files
+        if not args and not cmdline.input and not cmdline.resume:
+            parser.error("no URLs given")
+        targets = [args]
+        for filename in cmdline.input:
+            targets.append(self.read_targets(filename))
         
-        
-        
-        # just testing...
+        # Start from the defaults of the crawler or the download manager
         options = self.__class__._DefaultOptions()
-        options.referer = 'http://www.example.com'
-        args = ['http://www.google.com',
-                'http://winappdbg.sourceforge.net/dist/winappdbg-1.0.zip']
-        
-        
+        options.recursive = cmdline.recursive or cmdline.resume
+        options.resume    = cmdline.resume
+        if not options.recursive:
+            defaults = Downloader._OptionsDownloadManagerMode()
+            options.__dict__.update(defaults.__dict__)
+        for name in self._copied_options:
+            value = getattr(cmdline, name)
+            if value is not None:
+                setattr(options, name, value)
+        if options.processes > 1 and options.recursive and \
+                                    (options.resume or options.frontierfile):
+            parser.error("--resume and --frontier can't be used with "
+                         "--processes")
+        if options.resume:
+            if not options.frontierfile:
+                options.frontierfile = DiskFrontier.get_default_filename()
+            if not os.path.exists(options.frontierfile):
+                parser.error("nothing to resume, %s not found (pass "
+                             "--frontier on the first run to be able to "
+                             "resume the crawl)" % options.frontierfile)
+        if cmdline.onduplicate:
+            options.onduplicate = self._onduplicate[cmdline.onduplicate]
+        if cmdline.metrics_address:
+            host, _, port = cmdline.metrics_address.rpartition(':')
+            try:
+                options.metrics_address = (host or '127.0.0.1', int(port))
+            except ValueError:
+                parser.error("invalid metrics address: %s" %
+                             cmdline.metrics_address)
         
         # Save the options and targets and run
         self.options = options
-        self.targets = args
+        self.targets = itertools.chain.from_iterable(targets)
         self.__run()
     
-    # Create the cookiejar
-    def __run(self):
-        if self.options.load_cookies or self.options.save_cookies:
-            with Cookies(self.options) as cookiejar:
-                self.__run_with_cookies(cookiejar)
+    # Read the URLs in a file, one per line, skipping blank lines and
+    # comments. Lines are read only as they're needed, so the whole list
+    # is never held in memory.
+    @staticmethod
+    def read_targets(filename):
+        if filename == '-':
+            fd = sys.stdin
+        else:
+            fd = open(filename, 'rU')
+        try:
+            for line in iter(fd.readline, ''):
+                line = line.strip()
+                if line and not line.startswith('#'):
+                    yield line
+        finally:
+            if fd is not sys.stdin:
+                fd.close()
+    
+    # Import a legacy history file into the current history file
+    def import_history(self, legacy_file=None, history_file=None):
+        history = History(history_file)
+        with history:
+            count = history.import_legacy(legacy_file)
+        print "Imported %d resources into %s" % (
+                                count, history.get_default_filename())
+    
+    # Merge history partitions into the history file, deleting them.
+    # If no partitions are given, merge the ones left next to the file.
+    def merge_history(self, history_file=None, partitions=None):
+        history = History(history_file)
+        if not partitions:
+            partitions = history.find_partitions()
+        with history:
+            for partition in partitions:
+                if not os.path.exists(partition):
+                    continue
+                count = history.merge(partition)
+                for suffix in ('', '-wal', '-shm'):
+                    FileUtils.remove_silently(partition + suffix)
+                print "Merged %d resources from %s into %s" % (
+                            count, partition, history.get_default_filename())
+    
+    # Create the cookiejar.
+    # The history file and frontier are only given to the shards of a
+    # multi-process crawl.
+    def __run(self, history_file=None, frontier=None):
+        options = self.options
+        if frontier is None and options.recursive and options.processes > 1:
+            self.__run_sharded()
+        elif options.load_cookies or options.save_cookies:
+            with Cookies(options) as cookiejar:
+                self.__run_with_cookies(cookiejar, history_file, frontier)
         else:
-                self.__run_with_cookies(None)
+                self.__run_with_cookies(None, history_file, frontier)
     
     # Create the history
-    def __run_with_cookies(self, cookiejar):
+    def __run_with_cookies(self, cookiejar, history_file, frontier):
         if self.options.keep_history:
-            with History(self.options.history_file) as history:
-                self.__run_with_cookies_and_history(cookiejar, history)
+            history_file = history_file or self.options.history_file
+            with History(history_file) as history:
+                self.__run_with_cookies_and_history(cookiejar, history,
+                                                    frontier)
         else:
-                self.__run_with_cookies_and_history(cookiejar, None)
+                self.__run_with_cookies_and_history(cookiejar, None,
+                                                    frontier)
     
     # Create the downloader and run it through every target
-    def __run_with_cookies_and_history(self, cookiejar, history):
+    def __run_with_cookies_and_history(self, cookiejar, history, frontier):
         options = self.options
         hooks = []
+        history_hook = None
         if history is not None:
-            hooks.append(HistoryHook(history))
-        hooks.append(PrintHook())       # DEBUG
+            history_hook = HistoryHook(history, options.history_batch,
+                                       options.history_interval)
+            hooks.append(history_hook)
+        if options.verbose:
+            hooks.append(PrintHook())
+        exporter = None
+        if options.metrics_file or options.metrics_address:
+            metrics = MetricsHook()
+            hooks.append(metrics)
+            exporter = MetricsExporter(metrics, options.metrics_file,
+                                       options.metrics_interval,
+                                       options.metrics_address)
         if options.recursive:
-            crawler = Crawler(options, cookiejar, hooks)
-            action  = crawler.crawl
+            downloader = Crawler(options, cookiejar, hooks, frontier)
         else:
             downloader = Downloader(options, cookiejar, hooks)
-            action     = downloader.download
-        referer = options.referer
+        try:
+            if exporter is not None:
+                exporter.start()
+            if frontier is not None:
+                frontier.start()
+                try:
+                    downloader.run()
+                finally:
+                    frontier.stop()
+            elif options.recursive:
+                downloader.add_targets(self.targets, options.referer)
+                if options.resume:
+                    downloader.resume(history)
+                else:
+                    downloader.run()
+            else:
+                self.__download_all(downloader)
+        finally:
+            try:
+                downloader.close()
+            finally:
+                try:
+                    if history_hook is not None:
+                        history_hook.close()
+                finally:
+                    if exporter is not None:
+                        exporter.close()
+    
+    # Download every target with a pool of worker threads. Targets are
+    # taken from the iterator only when a worker is about to need them.
+    def __download_all(self, downloader):
+        referer = self.options.referer
+        queue = Queue.Queue(max(1, self.options.workers) * 2)
+        
+        def worker():
+            while True:
+                url = queue.get()
+                if url is None:
+                    break
+                try:
+                    downloader.download(url, referer)
+                except Exception, e:
+                    msg = "Error downloading %s: %s" % (url, e)
+                    warnings.warn(msg, RuntimeWarning)
+        
+        threads = []
+        for _ in xrange(max(1, self.options.workers)):
+            t = threading.Thread(target=worker)
+            t.daemon = True
+            t.start()
+            threads.append(t)
+        try:
+            for url in self.targets:
+                while True:
+                    try:
+                        queue.put(url, timeout=1.0)     # interruptible
+                        break
+                    except Queue.Full:
+                        pass
+        except:
+            while True:         # drop the queued targets
+                try:
+                    queue.get_nowait()
+                except Queue.Empty:
+                    break
+            raise
+        finally:
+            for t in threads:
+                queue.put(None)
+            for t in threads:
+                while t.is_alive():     # join() can't be interrupted
+                    t.join(1.0)
+    
+    # Seconds to wait for the other shards to finish after one of them died
+    _abort_timeout = 30.0
+    
+    # Crawl with several processes, each one owning a shard of the hosts
+    # and writing its own history partition, then merge the partitions
+    def __run_sharded(self):
+        options = self.options
+        count = options.processes
+        ring = ShardRing(count)
+        inboxes = [multiprocessing.Queue() for _ in xrange(count)]
+        outstanding = ShardedFrontier.create_counter()
         for url in self.targets:
-            action(url, referer)
-
-#-----------------------------------------------------------------------------#
-
-# TODO
+            url = HttpUtils.normalize_url(url, options.sortquery)
+            ShardedFrontier.seed(ring, inboxes, outstanding, url,
+                                 options.referer)
+        history = History(options.history_file)
+        processes = []
+        for index in xrange(count):
+            partition = history.get_partition_filename(index)
+            process = multiprocessing.Process(target=self.__run_shard,
+                        args=(index, ring, inboxes, outstanding, partition))
+            processes.append(process)
+        try:
+            for process in processes:
+                process.start()
+            failed = None
+            deadline = None
+            while True:
+                running = [p for p in processes if p.is_alive()]
+                if failed is None:
+                    for process in processes:
+                        if process.exitcode:
+                            failed = process
+                            break
+                    if failed is not None and running:
+                        
+                        # The targets counted by the dead shard are never
+                        # released, so the others would wait forever
+                        ShardedFrontier.abort(inboxes)
+                        deadline = time.time() + self._abort_timeout
+                if not running:
+                    break
+                if deadline is not None and time.time() > deadline:
+                    for process in running:
+                        process.terminate()
+                    deadline = None
+                running[0].join(1.0)    # join() can't be interrupted
+            if failed is not None:
+                msg = "Crawler process %d failed with exit code %d"
+                msg = msg % (processes.index(failed), failed.exitcode)
+                raise RuntimeError(msg)
+        except:
+            for process in processes:
+                if process.is_alive():
+                    process.terminate()
+            raise
+        finally:
+            if options.keep_history:
+                self.merge_history(options.history_file)
+    
+    # Run one shard of a multi-process crawl, in its own process
+    def __run_shard(self, index, ring, inboxes, outstanding, partition):
+        options = self.options
+        if options.metrics_file and options.metrics_file != '-':
+            options.metrics_file = '%s.shard%d' % (options.metrics_file, index)
+        if options.metrics_address:
+            host, port = options.metrics_address
+            options.metrics_address = (host, port + index)
+        frontier = ShardedFrontier(ring, index, inboxes, outstanding,
+                                   options.maxperhost, options.crawldelay)
+        self.__run(partition, frontier)
 
 #-----------------------------------------------------------------------------#
 
 def main():
-    # just testing...
     Main().run()
 
 #-----------------------------------------------------------------------------#
@@ -0,0 +1,1236 @@
+#!/usr/bin/env python
+#-----------------------------------------------------------------------------#
+# Copyright (c) 2011, Mario Vilas
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#     * Redistributions of source code must retain the above copyright notice,
+#       this list of conditions and the following disclaimer.
+#     * Redistributions in binary form must reproduce the above copyright
+#       notice,this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution.
+#     * Neither the name of the copyright holder nor the names of its
+#       contributors may be used to endorse or promote products derived from
+#       this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#-----------------------------------------------------------------------------#
+
+"""Benchmarks for pycrawl, run against a local HTTP server.
+
+Distributed under BSD licence.
+"""
+
+from __future__ import with_statement
+
+import os
+import re
+import sys
+import json
+import math
+import time
+import zlib
+import errno
+import Queue
+import urllib2
+import cPickle
+import resource
+import random
+import signal
+import socket
+import shutil
+import tempfile
+import optparse
+import warnings
+import threading
+
+import multiprocessing
+import SocketServer
+import BaseHTTPServer
+
+import pycrawl
+
+#-----------------------------------------------------------------------------#
+
+def compress(data, encoding):
+    "Compress data with the given HTTP content encoding."
+    if encoding == 'gzip':
+        compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    else:
+        compressor = zlib.compressobj(6)
+    return compressor.compress(data) + compressor.flush()
+
+#-----------------------------------------------------------------------------#
+
+class SiteHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """
+    Serves the pages of a L{Site}.
+    """
+
+    # Needed for keep-alive connections
+    protocol_version = 'HTTP/1.1'
+
+    # Send each response in one go, otherwise Nagle's algorithm and delayed
+    # ACKs stall every response on persistent connections
+    wbufsize = -1
+
+    def do_GET(self):
+        site = self.server
+        if site.latency:
+            time.sleep(site.latency)
+        if self.path.startswith('/blob/'):
+            self.send_blob()
+            return
+        try:
+            index = int(self.path.split('/')[-1])
+        except ValueError:
+            index = -1
+        if not 0 <= index < site.pages:
+            self.send_error(404)
+            return
+        if self.path.startswith('/redirect/'):
+            self.send_response(302)
+            self.send_header('Location', site.get_url(index))
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        body = site.get_page(index)
+        etag = '"%d-%d-%d"' % (index, len(body), site.get_version(index))
+        encoding = None
+        if site.compression:
+            accepted = self.headers.get('Accept-Encoding', '')
+            accepted = [x.split(';')[0].strip() for x in accepted.split(',')]
+            for encoding in ('gzip', 'deflate', None):
+                if encoding in accepted:
+                    break
+        if encoding:
+            body = compress(body, encoding)
+            etag = etag[:-1] + '-' + encoding + '"'
+        if self.headers.get('If-None-Match') == etag:
+            site.not_modified = site.not_modified + 1
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain')
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('ETag', etag)
+        if encoding:
+            self.send_header('Content-Encoding', encoding)
+        if site.is_attachment(index):
+            self.send_header('Content-Disposition',
+                             'attachment; filename=page-%d.txt' % index)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_blob(self):
+        """
+        Serve C{/blob/<size>}, a binary file of the given size, honoring
+        C{Range} and C{If-Range}. If the site has C{drop_after} set, the
+        connection is dropped after sending that many bytes, to simulate
+        a flaky link.
+        """
+        site = self.server
+        try:
+            size = int(self.path.split('/')[-1])
+        except ValueError:
+            self.send_error(404)
+            return
+        body, version = site.get_blob(size, with_version=True)
+        etag = '"blob-%d-%d"' % (size, version)
+        start, end = 0, size - 1
+        status = 200
+        ranges = self.headers.get('Range')
+        if_range = self.headers.get('If-Range')
+        if ranges and (if_range is None or if_range == etag):
+            start, end = ranges.split('=')[1].split('-')
+            start = int(start)
+            end = min(int(end or size - 1), size - 1)
+            status = 206
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/octet-stream')
+        self.send_header('Content-Length', str(end - start + 1))
+        self.send_header('Accept-Ranges', 'bytes')
+        self.send_header('ETag', etag)
+        if status == 206:
+            self.send_header('Content-Range',
+                             'bytes %d-%d/%d' % (start, end, size))
+        self.end_headers()
+        data = body[start:end + 1]
+        with site.lock:
+            site.ranges.append((start, end))
+            drop = site.drop_after
+            if drop is not None and drop < len(data):
+                site.drop_after = None
+                data = data[:drop]
+            else:
+                drop = None
+        self.wfile.write(data)
+        if drop is not None:
+            self.wfile.flush()
+            self.close_connection = 1
+    
+    # Be quiet
+    def log_message(self, format, *args):
+        pass
+
+#-----------------------------------------------------------------------------#
+
+class Site(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """
+    Local HTTP server with a synthetic web site.
+
+    Pages are laid out as a tree with the given fan-out, and every page also
+    links back to its parent. The pages are spread across several loopback
+    addresses (127.0.0.1, 127.0.0.2...) so the crawler sees multiple hosts.
+
+    Optionally, page sizes follow a log-normal distribution around the
+    given size, every Nth page is linked through a redirection or served
+    as an attachment with a C{Content-Disposition} header, and a fraction
+    of the pages changes whenever the C{generation} counter is increased,
+    while the rest keep answering C{"304 Not Modified"} to revalidations.
+    Everything is derived from the page index, so runs are reproducible.
+    """
+
+    daemon_threads = True
+    request_queue_size = 1024
+
+    def __init__(self, pages=1000, fanout=8, hosts=4, latency=0.0,
+                 pagesize=4096, compression=True, sizespread=0.0,
+                 redirects=0, attachments=0, churn=0.0):
+        BaseHTTPServer.HTTPServer.__init__(self, ('', 0), SiteHandler)
+        self.pages    = pages
+        self.fanout   = fanout
+        self.hosts    = hosts
+        self.latency  = latency
+        self.pagesize = pagesize
+        self.compression = compression
+        self.sizespread  = sizespread   # sigma of the log-normal sizes
+        self.redirects   = redirects    # link every Nth page via a redirect
+        self.attachments = attachments  # every Nth page is an attachment
+        self.churn       = churn        # fraction of pages that change
+        self.generation  = multiprocessing.Value('i', 0, lock=False)
+        self.port     = self.server_address[1]
+        self.not_modified = 0       # number of 304 responses sent
+        self.ranges = []            # byte ranges of blobs sent
+        self.drop_after = None      # drop the next blob after these bytes
+        self.lock = threading.Lock()
+        self._blobs = {}            # size -> (data, version)
+
+    def get_url(self, index):
+        host = '127.0.0.%d' % (1 + index % self.hosts)
+        return 'http://%s:%d/page/%d' % (host, self.port, index)
+
+    def get_link(self, index):
+        "URL other pages link to, which may go through a redirection."
+        if self.redirects and index % self.redirects == self.redirects - 1:
+            host = '127.0.0.%d' % (1 + index % self.hosts)
+            return 'http://%s:%d/redirect/%d' % (host, self.port, index)
+        return self.get_url(index)
+
+    def is_attachment(self, index):
+        return bool(self.attachments) and \
+               index % self.attachments == self.attachments - 1
+
+    def get_version(self, index):
+        "Pages that change are at the current generation, the rest at 0."
+        if self.churn and (index * 2654435761) % 1000 < self.churn * 1000:
+            return self.generation.value
+        return 0
+
+    def get_size(self, index):
+        if not self.sizespread:
+            return self.pagesize
+        rng = random.Random(index)
+        size = rng.lognormvariate(math.log(self.pagesize), self.sizespread)
+        return min(int(size), self.pagesize * 64)
+
+    def get_page(self, index):
+        links = []
+        if index:
+            links.append(self.get_link((index - 1) // self.fanout))
+        first = index * self.fanout + 1
+        for child in xrange(first, min(first + self.fanout, self.pages)):
+            links.append(self.get_link(child))
+        version = self.get_version(index)
+        if version:
+            links.append('version %d' % version)
+        body = '\n'.join(links) + '\n'
+        size = self.get_size(index)
+        if len(body) < size:
+            body = body + 'x' * (size - len(body))
+        return body
+
+    def get_blob(self, size, with_version=False):
+        "Data of /blob/<size>, and optionally its version for the ETag."
+        with self.lock:
+            blob = self._blobs.get(size)
+            if blob is None:
+                block = ''.join(chr(i % 251) for i in xrange(251))
+                blob = ((block * (size // len(block) + 1))[:size], 0)
+                self._blobs[size] = blob
+        if with_version:
+            return blob
+        return blob[0]
+
+    def set_blob(self, size, data):
+        "Change the data of /blob/<size>, which must be that long."
+        assert len(data) == size
+        with self.lock:
+            version = self._blobs.get(size, (None, 0))[1] + 1
+            self._blobs[size] = (data, version)
+    
+    # Clients hanging up are not worth a traceback
+    def handle_error(self, request, client_address):
+        error = sys.exc_info()[1]
+        if isinstance(error, socket.error) and error.args and \
+                error.args[0] in (errno.EPIPE, errno.ECONNRESET):
+            return
+        BaseHTTPServer.HTTPServer.handle_error(self, request,
+                                               client_address)
+
+    def __enter__(self):
+        t = threading.Thread(target=self.serve_forever)
+        t.daemon = True
+        t.start()
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.shutdown()
+        self.server_close()
+
+#-----------------------------------------------------------------------------#
+
+def bench_crawl(workers_list, pages, fanout, hosts, latency, maxperhost,
+                poolsize, metrics=False):
+    """
+    Crawl the whole synthetic site with each number of workers and print the
+    number of pages per second. Optionally crawl again collecting metrics,
+    to measure what they cost.
+    """
+    print "Crawl: %d pages, fan-out %d, %d hosts, %.3fs latency" % (
+                                        pages, fanout, hosts, latency)
+    print "%8s %8s %8s %8s %10s" % ('workers', 'metrics', 'pages', 'errors',
+                                    'pages/s')
+    runs = [(workers, False) for workers in workers_list]
+    if metrics:
+        runs = [(workers, with_metrics) for workers in workers_list
+                                        for with_metrics in (False, True)]
+    with Site(pages, fanout, hosts, latency) as site:
+        for workers, with_metrics in runs:
+            targetdir = tempfile.mkdtemp(prefix='pycrawl_bench_')
+            try:
+                options = pycrawl.Crawler._DefaultOptions()
+                options.targetdir  = targetdir
+                options.workers    = workers
+                options.maxperhost = maxperhost
+                options.poolsize   = poolsize
+                hooks = []
+                if with_metrics:
+                    hooks.append(pycrawl.MetricsHook())
+                crawler = pycrawl.Crawler(options, None, hooks)
+                with warnings.catch_warnings(record=True) as errors:
+                    warnings.simplefilter('always')
+                    start = time.time()
+                    crawler.crawl(site.get_url(0))
+                    elapsed = time.time() - start
+                crawler.close()
+                count = sum(len(f) for _, _, f in os.walk(targetdir))
+                print "%8d %8s %8d %8d %10.1f" % (
+                        workers, ('no', 'yes')[with_metrics], count,
+                        len(errors), count / elapsed)
+            finally:
+                shutil.rmtree(targetdir, ignore_errors=True)
+
+#-----------------------------------------------------------------------------#
+
+def bench_copy(size, repeat):
+    """
+    Download a large file from a loopback server with several copy engine
+    settings and print the throughput and CPU time. The server runs in a
+    child process so it doesn't compete with the client for the GIL.
+    """
+    configs = [
+        ('copyfileobj 16K', None),
+        ('buffer 64K',      dict(copybuffer=64*1024, preallocate=False)),
+        ('buffer 1M',       dict(copybuffer=2**20, preallocate=False)),
+        ('1M + prealloc',   dict(copybuffer=2**20)),
+        ('1M + O_DIRECT',   dict(copybuffer=2**20, directio=True)),
+        ('1M + dontneed',   dict(copybuffer=2**20, dontneed=True)),
+    ]
+    site = Site(hosts=1)
+    blob = site.get_blob(size)
+    pid = os.fork()
+    if pid == 0:
+        try:
+            site.serve_forever()
+        finally:
+            os._exit(0)
+    del blob
+    targetdir = tempfile.mkdtemp(prefix='pycrawl_bench_')
+    try:
+        url = 'http://127.0.0.1:%d/blob/%d' % (site.port, size)
+        print "Copy: %d MB file, best of %d" % (size // 2**20, repeat)
+        print "%-16s %10s %12s" % ('', 'MB/s', 'CPU s/GB')
+        for label, settings in configs:
+            options = pycrawl.Downloader._OptionsSiteMirrorMode()
+            options.targetdir = targetdir
+            options.partial   = False
+            for key, value in (settings or {}).iteritems():
+                setattr(options, key, value)
+            downloader = pycrawl.Downloader(options)
+            if settings is None:
+                downloader._copier = None   # plain shutil.copyfileobj
+            best = None
+            for _ in xrange(repeat):
+                start = time.time()
+                cpu = sum(os.times()[:2])
+                res = downloader.download(url)
+                cpu = sum(os.times()[:2]) - cpu
+                elapsed = time.time() - start
+                assert os.path.getsize(res.datafile) == size
+                os.unlink(res.datafile)
+                if best is None or elapsed < best[0]:
+                    best = (elapsed, cpu)
+            downloader.close()
+            elapsed, cpu = best
+            print "%-16s %10.1f %12.2f" % (label, size / elapsed / 2**20,
+                                          cpu * 2**30 / size)
+    finally:
+        shutil.rmtree(targetdir, ignore_errors=True)
+        os.kill(pid, signal.SIGTERM)
+        os.waitpid(pid, 0)
+        site.server_close()
+
+#-----------------------------------------------------------------------------#
+
+def make_text_file(filename, size):
+    """
+    Write a synthetic text file of about the given size in bytes, with URLs
+    scattered across it. Returns the number of URLs written.
+    """
+    words = ['lorem', 'ipsum', 'dolor', 'sit', 'amet', 'consectetur']
+    links = ['http://www.example.com/%d/page.html',
+             '"https://static.example.org/img/%d.png"',
+             "'ftp://ftp.example.net/pub/file-%d.tar.gz'"]
+    block = []
+    count = 0
+    for i in xrange(1000):
+        block.append(words[i % len(words)])
+        if i % 7 == 0:
+            block.append(links[count % len(links)] % count)
+            count = count + 1
+    block = ' '.join(block) + '\n'
+    blocks = max(1, size // len(block))
+    with open(filename, 'wb') as fd:
+        for _ in xrange(blocks):
+            fd.write(block)
+    return blocks * count
+
+def bench_scan(size, chunk_size):
+    """
+    Scan a large synthetic text file for URLs and print the throughput and
+    the peak memory usage.
+    """
+    fd, filename = tempfile.mkstemp(prefix='pycrawl_bench_')
+    os.close(fd)
+    try:
+        expected = make_text_file(filename, size)
+        print "Scan: %d MB file, %d KB chunks" % (
+                    os.path.getsize(filename) // 2**20, chunk_size // 1024)
+        start = time.time()
+        found = 0
+        with open(filename, 'rb') as fd:
+            for urls in pycrawl.Crawler.scan_urls(fd, chunk_size):
+                found = found + len(urls)
+        elapsed = time.time() - start
+        print "%d of %d URLs found in %.1fs, %.1f MB/s, peak RSS %d MB" % (
+                    found, expected, elapsed,
+                    os.path.getsize(filename) / elapsed / 2**20,
+                    get_peak_rss() // 1024)
+    finally:
+        os.unlink(filename)
+
+def make_html_file(filename, size):
+    """
+    Write a synthetic HTML file of about the given size in bytes.
+    Returns the number of links written.
+    """
+    row = ('<tr><td><a href="/dir/page%(i)d.html">Page %(i)d</a></td>'
+           '<td><img src="img/%(i)d.png" alt="&lt;%(i)d&gt;"></td>'
+           '<td class="text">Lorem ipsum dolor sit amet, consectetur.</td>'
+           '</tr>\n')
+    count = 0
+    with open(filename, 'wb') as fd:
+        fd.write('<html><head><title>Test</title></head><body><table>\n')
+        written = 0
+        while written < size:
+            data = row % {'i' : count}
+            fd.write(data)
+            written = written + len(data)
+            count = count + 1
+        fd.write('</table></body></html>\n')
+    return count * 2
+
+def count_soup_links(tree, base):
+    """
+    Count the links in a BeautifulSoup tree, passing each tag through the
+    incremental parser so the same attributes are looked at.
+    """
+    parser = pycrawl.Crawler._LinkParser(base)
+    found = 0
+    for tag in tree.findAll(True):
+        attrs = tag.attrs
+        if isinstance(attrs, dict):     # bs4, BeautifulSoup 3 has a list
+            attrs = attrs.items()
+        parser.handle_starttag(tag.name, attrs)
+        found = found + len(parser.urls)
+        parser.urls = []
+    return found
+
+def bench_html(size, chunk_size):
+    """
+    Extract the links from a synthetic HTML file with the incremental parser
+    and, if available, with a BeautifulSoup full parse.
+    """
+    fd, filename = tempfile.mkstemp(prefix='pycrawl_bench_')
+    os.close(fd)
+    try:
+        expected = make_html_file(filename, size)
+        mb = os.path.getsize(filename) / float(2**20)
+        print "HTML: %.1f MB file, %d links" % (mb, expected)
+        base = 'http://www.example.com/'
+        start = time.time()
+        found = 0
+        with open(filename, 'rb') as fd:
+            for urls in pycrawl.Crawler.scan_html(fd, base, chunk_size):
+                found = found + len(urls)
+        elapsed = time.time() - start
+        print "%-16s %8d links %8.2f MB/s  peak RSS %d MB" % (
+            'incremental', found, mb / elapsed, get_peak_rss() // 1024)
+        try:
+            import bs4
+            soup = lambda data: bs4.BeautifulSoup(data, 'html.parser')
+        except ImportError:
+            try:
+                import BeautifulSoup
+                soup = BeautifulSoup.BeautifulSoup
+            except ImportError:
+                print "%-16s not installed" % 'BeautifulSoup'
+                return
+        start = time.time()
+        with open(filename, 'rb') as fd:
+            tree = soup(fd.read())
+        found = count_soup_links(tree, base)
+        elapsed = time.time() - start
+        print "%-16s %8d links %8.2f MB/s  peak RSS %d MB" % (
+            'BeautifulSoup', found, mb / elapsed, get_peak_rss() // 1024)
+    finally:
+        os.unlink(filename)
+
+def get_peak_rss():
+    "Peak resident set size of this process in kilobytes."
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+#-----------------------------------------------------------------------------#
+
+def bench_filter(rules, count):
+    """
+    Run URLs through a hook chain with domain and regular expression filters
+    of the given number of rules each, and print the URLs checked per second.
+    For comparison, also time checking the same rules one by one.
+    """
+    deny_domains = ['host%d.example%d.com' % (i, i % 97)
+                    for i in xrange(rules)]
+    deny_regexps = [r'^https?://[^/]*/private%d/' % i for i in xrange(rules)]
+    urls = ['http://www%d.host%d.example%d.com/public/page%d.html' % (
+                i % 7, i % (rules * 2), i % 97, i) for i in xrange(count)]
+    req = urllib2.Request(urls[0])
+    print "Filter: %d domain rules, %d regexp rules, %d URLs" % (
+                                                    rules, rules, count)
+    print "%-16s %8s %12s %10s" % ('', 'allowed', 'URLs/s', 'usec/URL')
+    
+    start = time.time()
+    domains = pycrawl.DomainFilterHook(deny=deny_domains)
+    regexps = pycrawl.RegexpFilterHook(deny=deny_regexps)
+    chain = domains + regexps
+    chain._filter_request(None, req, urls[0])   # compile the expressions
+    print "%-16s %.2fs" % ('setup', time.time() - start)
+    
+    start = time.time()
+    allowed = 0
+    for url in urls:
+        if chain._filter_request(None, req, url):
+            allowed = allowed + 1
+    elapsed = time.time() - start
+    print "%-16s %8d %12.1f %10.2f" % (
+        'compiled', allowed, count / elapsed, elapsed * 1e6 / count)
+    
+    # Naive version: one regexp search and one domain comparison per rule
+    compiled = [re.compile(x) for x in deny_regexps]
+    sample = urls[::100]
+    start = time.time()
+    allowed = 0
+    for url in sample:
+        host = url.split('/')[2]
+        if any(host == d or host.endswith('.' + d) for d in deny_domains):
+            continue
+        if any(r.search(url) for r in compiled):
+            continue
+        allowed = allowed + 1
+    elapsed = time.time() - start
+    print "%-16s %8d %12.1f %10.2f  (%d URLs)" % (
+        'one by one', allowed, len(sample) / elapsed,
+        elapsed * 1e6 / len(sample), len(sample))
+
+#-----------------------------------------------------------------------------#
+
+def bench_async(count, delay, hosts, threads_list, inflight_list):
+    """
+    Download pages from a server that takes the given time to answer each
+    request, with the threaded Downloader and each number of threads, and
+    with the AsyncDownloader and each limit of requests in flight. Print
+    the requests per second, the CPU time used and the peak thread count.
+    The server runs in a child process so it doesn't compete for the GIL.
+    """
+    site = Site(pages=count, hosts=hosts, latency=delay, compression=False)
+    urls = [site.get_url(i) for i in xrange(count)]
+    pid = os.fork()
+    if pid == 0:
+        try:
+            site.serve_forever()
+        finally:
+            os._exit(0)
+    site.server_close()
+    
+    def cpu_time():
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+        return usage.ru_utime + usage.ru_stime
+    
+    def report(label, elapsed, cpu, errors, threads):
+        print "%-20s %10.1f %10.2f %8d %8d" % (label, count / elapsed,
+                                               cpu * 1000.0 / count,
+                                               errors, threads)
+    
+    print "Async: %d requests, %.3fs server delay, %d hosts" % (
+                                                    count, delay, hosts)
+    print "%-20s %10s %10s %8s %8s" % (
+        '', 'req/s', 'CPU ms/req', 'errors', 'threads')
+    targetdir = tempfile.mkdtemp(prefix='pycrawl_bench_')
+    try:
+        for threads in threads_list:
+            options = pycrawl.Downloader._OptionsSiteMirrorMode()
+            options.targetdir = targetdir
+            options.usefstimes = False
+            options.poolsize = max(4, threads // hosts)
+            dwn = pycrawl.Downloader(options)
+            queue = Queue.Queue()
+            for url in urls:
+                queue.put(url)
+            errors = []
+            def worker():
+                while True:
+                    try:
+                        url = queue.get_nowait()
+                    except Queue.Empty:
+                        return
+                    try:
+                        dwn.download(url)
+                    except Exception, e:
+                        errors.append(e)
+            workers = [threading.Thread(target=worker)
+                       for _ in xrange(threads)]
+            cpu = cpu_time()
+            start = time.time()
+            for thread in workers:
+                thread.start()
+            peak = threading.active_count()
+            for thread in workers:
+                thread.join()
+            elapsed = time.time() - start
+            report('threaded %d' % threads, elapsed, cpu_time() - cpu,
+                   len(errors), peak)
+            dwn.close()
+        for inflight in inflight_list:
+            options = pycrawl.AsyncDownloader._OptionsSiteMirrorMode()
+            options.targetdir = targetdir
+            options.usefstimes = False
+            options.maxconnections = inflight
+            options.maxperhost = max(1, inflight // hosts)
+            options.poolsize = options.maxperhost
+            dwn = pycrawl.AsyncDownloader(options)
+            cpu = cpu_time()
+            start = time.time()
+            transfers = [dwn.submit(url) for url in urls]
+            peak = threading.active_count()
+            errors = 0
+            for transfer in transfers:
+                try:
+                    transfer.result()
+                except Exception:
+                    errors = errors + 1
+            elapsed = time.time() - start
+            report('async %d' % inflight, elapsed, cpu_time() - cpu,
+                   errors, peak)
+            dwn.close()
+    finally:
+        shutil.rmtree(targetdir, ignore_errors=True)
+        os.kill(pid, signal.SIGTERM)
+        os.waitpid(pid, 0)
+
+#-----------------------------------------------------------------------------#
+
+class CountingHook(pycrawl.Hook):
+    "Hook that only overrides filter_request, to measure dispatch overhead."
+    
+    def __init__(self):
+        self.count = 0
+    
+    def filter_request(self, dwn, req, url):
+        self.count = self.count + 1
+        return True
+
+class LegacyHookChain(object):
+    "The hook chain dispatch before callbacks were precompiled."
+    
+    def __init__(self, chain):
+        self._chain = chain
+    
+    def _run_callbacks(self, callbacks, arguments):
+        allowed = True
+        for method in callbacks:
+            allowed = allowed and method(*arguments)
+            if not allowed:
+                break
+        return allowed
+    
+    def _filter_request(self, dwn, req, url):
+        callbacks = [hook.filter_request for hook in self._chain]
+        return self._run_callbacks(callbacks, (dwn, req, url))
+
+def bench_hooks(counts, calls):
+    """
+    Run the request phase of hook chains of different lengths and print
+    the overhead per request. Half the hooks in each chain only inherit the
+    no-op methods of the base class, and half override filter_request.
+    For comparison, also time the old dispatch that built a list of bound
+    methods on every call.
+    """
+    req = urllib2.Request('http://www.example.com/')
+    url = req.get_full_url()
+    print "Hooks: %d calls to _filter_request per chain" % calls
+    print "%8s %14s %14s" % ('hooks', 'usec/request', 'legacy')
+    for count in counts:
+        hooks = []
+        for i in xrange(count):
+            if i % 2:
+                hooks.append(pycrawl.Hook())
+            else:
+                hooks.append(CountingHook())
+        chain = pycrawl.HookChain(hooks)
+        
+        start = time.time()
+        for _ in xrange(calls):
+            chain._filter_request(None, req, url)
+        compiled = time.time() - start
+        
+        legacy = LegacyHookChain(hooks)
+        start = time.time()
+        for _ in xrange(calls):
+            legacy._filter_request(None, req, url)
+        per_call = time.time() - start
+        
+        print "%8d %14.3f %14.3f" % (
+            count, compiled * 1e6 / calls, per_call * 1e6 / calls)
+
+#-----------------------------------------------------------------------------#
+
+class LegacyResource(object):
+    "Resource with its attributes in __dict__, as in older versions."
+
+def bench_resources(count):
+    """
+    Build resources like the ones loaded from a large history file, then
+    time looking up two of their headers, as the history hook and the
+    crawler do, and saving and loading them with pack() and with pickles
+    of their attributes, the way older versions stored them.
+    """
+    headers = ('Date: Mon, 01 Jan 2024 00:00:00 GMT\r\n'
+               'Server: Apache\r\n'
+               'Last-Modified: Mon, 01 Jan 2024 00:00:00 GMT\r\n'
+               'ETag: "%d-4096"\r\n'
+               'Content-Type: text/html; charset=utf-8\r\n'
+               'Content-Length: 4096\r\n')
+    print "Resources: %d" % count
+    rss = get_peak_rss()
+    start = time.time()
+    resources = [pycrawl.Resource(1700000000 + i,
+                    'http://host%d.example.com/page/%d' % (i % 16, i),
+                    'http://host%d.example.com/page/%d' % (i % 16, i),
+                    '/mirror/host%d.example.com/page/%d' % (i % 16, i),
+                    None, headers % i, 4096, None, 'gzip')
+                 for i in xrange(count)]
+    print "%-24s %10.2f usec" % ('create', (time.time() - start) * 1e6 / count)
+    start = time.time()
+    for res in resources:
+        res.get_header('Last-Modified')
+        res.get_header('Content-Type')
+    print "%-24s %10.2f usec" % ('get two headers',
+                                 (time.time() - start) * 1e6 / count)
+    print "%-24s %10.2f MB" % ('peak rss growth',
+                               (get_peak_rss() - rss) / 1024.0)
+    legacy = []
+    for res in resources:
+        old = LegacyResource()
+        for name in pycrawl.Resource._fields:
+            setattr(old, name, getattr(res, name))
+        legacy.append(old)
+    for label, objects, dump, load in (
+            ('pack', resources, pycrawl.Resource.pack,
+             pycrawl.Resource.unpack),
+            ('pickle', legacy, lambda res: cPickle.dumps(res, 2),
+             cPickle.loads)):
+        start = time.time()
+        packed = [dump(res) for res in objects]
+        dumped = time.time() - start
+        start = time.time()
+        for data in packed:
+            load(data)
+        loaded = time.time() - start
+        print "%-24s %10.2f usec dump %8.2f usec load %6d bytes" % (label,
+                dumped * 1e6 / count, loaded * 1e6 / count,
+                sum(len(data) for data in packed) // count)
+
+def bench_history(count, batch):
+    """
+    Fill a history file with the given number of downloads, then time
+    looking up the validators of all of them one URL at a time, the way
+    each request used to, and in batches the way the crawler prefetches
+    the links found in a page. Half the URLs looked up were never
+    downloaded.
+    """
+    tempdir = tempfile.mkdtemp(prefix='pycrawl-bench-')
+    try:
+        headers = 'ETag: "%d"\r\nContent-Type: text/html\r\n'
+        with pycrawl.History(os.path.join(tempdir, 'history.db')) as history:
+            history.add_many([pycrawl.Resource(1700000000,
+                                'http://example.com/page/%d' % i,
+                                'http://example.com/page/%d' % i,
+                                os.path.join(tempdir, 'page%d' % i),
+                                None, headers % i)
+                              for i in xrange(count)])
+            history.sync()
+            urls = ['http://example.com/page/%d' % i
+                    for i in xrange(0, count * 2, 2)]
+            print "History: %d URLs, batches of %d" % (count, batch)
+            start = time.time()
+            found = 0
+            for url in urls:
+                if history.get_validators(url) is not None:
+                    found = found + 1
+            single = time.time() - start
+            print "%-12s %10.2f usec/url %8d found" % ('single',
+                                            single * 1e6 / count, found)
+            start = time.time()
+            found = 0
+            for index in xrange(0, count, batch):
+                found = found + len(history.get_validators_many(
+                                            urls[index:index + batch]))
+            batched = time.time() - start
+            print "%-12s %10.2f usec/url %8d found" % ('batched',
+                                            batched * 1e6 / count, found)
+    finally:
+        shutil.rmtree(tempdir, ignore_errors=True)
+
+#-----------------------------------------------------------------------------#
+
+class SyscallCounter(object):
+    "Count calls to some functions of the os module while active."
+    
+    names = ('stat', 'lstat', 'mkdir')
+    
+    def __init__(self):
+        self.counts = dict.fromkeys(self.names, 0)
+        self._saved = {}
+    
+    def _wrap(self, name, function):
+        counts = self.counts
+        def wrapper(*args, **kwargs):
+            counts[name] = counts[name] + 1
+            return function(*args, **kwargs)
+        return wrapper
+    
+    def __enter__(self):
+        for name in self.names:
+            function = getattr(os, name)
+            self._saved[name] = function
+            setattr(os, name, self._wrap(name, function))
+        return self
+    
+    def __exit__(self, type, value, traceback):
+        for name, function in self._saved.iteritems():
+            setattr(os, name, function)
+
+def bench_paths(files, perdir, hosts):
+    """
+    Compute the local pathnames for a mirror of the given number of files
+    and create their directories, the way Downloader.download does for
+    every file, and print the filesystem calls made with and without the
+    pathname and directory caches.
+    """
+    urls = ['http://host%d.example.com/static/dir%d/sub/file%d.html' % (
+                (i // perdir) % hosts, i // perdir, i) for i in xrange(files)]
+    print "Paths: %d files, %d per directory, %d hosts" % (
+                                                    files, perdir, hosts)
+    print "%-10s %10s %10s %10s %12s %10s" % (
+        '', 'stat', 'lstat', 'mkdir', 'calls/file', 'usec/file')
+    for label, namecache in (('uncached', 0), ('cached', 10000)):
+        targetdir = tempfile.mkdtemp(prefix='pycrawl-bench-')
+        try:
+            options = pycrawl.Downloader._OptionsSiteMirrorMode()
+            options.targetdir = targetdir
+            options.namecache = namecache
+            dwn = pycrawl.Downloader(options)
+            with SyscallCounter() as counter:
+                start = time.time()
+                for url in urls:
+                    path, name = dwn.calc_local_name(url)   # before request
+                    path, name = dwn.calc_local_name(url)   # after response
+                    dwn._makedirs(path)
+                elapsed = time.time() - start
+            counts = counter.counts
+            total = sum(counts.itervalues())
+            print "%-10s %10d %10d %10d %12.2f %10.2f" % (label,
+                counts['stat'], counts['lstat'], counts['mkdir'],
+                float(total) / files, elapsed * 1e6 / files)
+        finally:
+            shutil.rmtree(targetdir, ignore_errors=True)
+
+#-----------------------------------------------------------------------------#
+
+def run_isolated(function, *args):
+    """
+    Run a function in a child process and return its result, which must be
+    JSON serializable, adding the CPU time and peak RSS of the child. Each
+    scenario of a suite runs in its own process, so neither of them grows
+    with the scenarios that came before.
+    """
+    rfd, wfd = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        status = 1
+        try:
+            os.close(rfd)
+            before = os.times()
+            result = function(*args)
+            after = os.times()
+            result['cpu'] = (after[0] - before[0]) + (after[1] - before[1])
+            result['rss'] = get_peak_rss()
+            with os.fdopen(wfd, 'wb') as fd:
+                fd.write(json.dumps(result))
+            status = 0
+        except BaseException:
+            import traceback
+            traceback.print_exc()
+        finally:
+            os._exit(status)
+    os.close(wfd)
+    with os.fdopen(rfd, 'rb') as fd:
+        data = fd.read()
+    os.waitpid(pid, 0)
+    if not data:
+        raise RuntimeError("Benchmark process failed: %s" % function.__name__)
+    return json.loads(data)
+
+def measure(run, metrics):
+    """
+    Time a benchmark run and collect what the L{pycrawl.MetricsHook} saw.
+    """
+    with warnings.catch_warnings(record=True) as errors:
+        warnings.simplefilter('always')
+        start = time.time()
+        run()
+        elapsed = time.time() - start
+    snapshot = metrics.snapshot()
+    failed = sum(snapshot['errors'].itervalues())
+    return {
+        'elapsed':      elapsed,
+        'pages':        snapshot['downloads'] + snapshot['not_modified'],
+        'not_modified': snapshot['not_modified'],
+        'bytes':        snapshot['bytes'],
+        'errors':       max(failed, len(errors)),
+    }
+
+def suite_download(site, targetdir):
+    "Download every page of the site, one after the other."
+    metrics = pycrawl.MetricsHook()
+    options = pycrawl.Downloader._OptionsSiteMirrorMode()
+    options.targetdir = targetdir
+    downloader = pycrawl.Downloader(options, None, [metrics])
+    def run():
+        for index in xrange(site.pages):
+            try:
+                downloader.download(site.get_link(index))
+            except Exception, e:
+                warnings.warn(str(e))
+    try:
+        return measure(run, metrics)
+    finally:
+        downloader.close()
+
+def suite_crawl(site, targetdir, historyfile, workers, maxperhost):
+    "Crawl the site, keeping the history for the next crawl."
+    metrics = pycrawl.MetricsHook()
+    options = pycrawl.Crawler._DefaultOptions()
+    options.targetdir  = targetdir
+    options.workers    = workers
+    options.maxperhost = maxperhost
+    with pycrawl.History(historyfile) as history:
+        history_hook = pycrawl.HistoryHook(history)
+        crawler = pycrawl.Crawler(options, None, [history_hook, metrics])
+        try:
+            return measure(lambda: crawler.crawl(site.get_url(0)), metrics)
+        finally:
+            crawler.close()
+            history_hook.close()
+
+def suite_blob(site, targetdir, size):
+    "Download a large file."
+    metrics = pycrawl.MetricsHook()
+    options = pycrawl.Downloader._OptionsSiteMirrorMode()
+    options.targetdir = targetdir
+    downloader = pycrawl.Downloader(options, None, [metrics])
+    url = 'http://127.0.0.1:%d/blob/%d' % (site.port, size)
+    try:
+        return measure(lambda: downloader.download(url), metrics)
+    finally:
+        downloader.close()
+
+def bench_suite(pages, fanout, hosts, latency, pagesize, sizespread,
+                redirects, attachments, churn, workers, maxperhost, blobsize,
+                jsonfile=None, label=None):
+    """
+    Run the whole benchmark suite against the synthetic site and print the
+    pages per second, megabytes per second, CPU time per page and peak RSS
+    of each scenario:
+     - download: L{pycrawl.Downloader.download} of every page in turn.
+     - crawl: L{pycrawl.Crawler.crawl} of the whole site.
+     - recrawl: the same crawl again, after some pages changed, so the
+       rest are revalidated with C{"304 Not Modified"} answers.
+     - blob: download of a single large file.
+    The server runs in a child process so it doesn't compete with the
+    client for the GIL, and so does every scenario. The results can be
+    appended to a file as a line of JSON, to compare them run to run.
+    """
+    site = Site(pages, fanout, hosts, latency, pagesize,
+                compression = False,    # padding compresses too well
+                sizespread = sizespread, redirects = redirects,
+                attachments = attachments, churn = churn)
+    blob = site.get_blob(blobsize)
+    pid = os.fork()
+    if pid == 0:
+        try:
+            site.serve_forever()
+        finally:
+            os._exit(0)
+    del blob
+    site.server_close()
+    print "Suite: %d pages, fan-out %d, %d hosts, %.3fs latency, " \
+          "%d bytes/page (spread %.1f)" % (pages, fanout, hosts, latency,
+                                           pagesize, sizespread)
+    print "%-10s %8s %8s %8s %10s %8s %12s %8s" % ('', 'pages', '304s',
+        'errors', 'pages/s', 'MB/s', 'CPU ms/page', 'RSS MB')
+    results = {}
+    tempdir = tempfile.mkdtemp(prefix='pycrawl_bench_')
+    historyfile = os.path.join(tempdir, 'history.db')
+    try:
+        scenarios = [
+            ('download', suite_download, (site, os.path.join(tempdir, 'd'))),
+            ('crawl',    suite_crawl,    (site, os.path.join(tempdir, 'c'),
+                                          historyfile, workers, maxperhost)),
+            ('recrawl',  suite_crawl,    (site, os.path.join(tempdir, 'c'),
+                                          historyfile, workers, maxperhost)),
+            ('blob',     suite_blob,     (site, os.path.join(tempdir, 'b'),
+                                          blobsize)),
+        ]
+        for name, function, args in scenarios:
+            if name == 'recrawl':
+                site.generation.value = site.generation.value + 1
+            result = run_isolated(function, *args)
+            results[name] = result
+            elapsed = result['elapsed']
+            count = max(result['pages'], 1)
+            print "%-10s %8d %8d %8d %10.1f %8.2f %12.3f %8d" % (name,
+                result['pages'], result['not_modified'], result['errors'],
+                result['pages'] / elapsed, result['bytes'] / elapsed / 2**20,
+                result['cpu'] * 1000.0 / count, result['rss'] // 1024)
+    finally:
+        shutil.rmtree(tempdir, ignore_errors=True)
+        os.kill(pid, signal.SIGTERM)
+        os.waitpid(pid, 0)
+    if jsonfile:
+        line = {
+            'time': time.time(), 'label': label, 'results': results,
+            'settings': {
+                'pages': pages, 'fanout': fanout, 'hosts': hosts,
+                'latency': latency, 'pagesize': pagesize,
+                'sizespread': sizespread, 'redirects': redirects,
+                'attachments': attachments, 'churn': churn,
+                'workers': workers, 'maxperhost': maxperhost,
+                'blobsize': blobsize,
+            },
+        }
+        with open(jsonfile, 'a') as fd:
+            fd.write(json.dumps(line, sort_keys=True) + '\n')
+
+#-----------------------------------------------------------------------------#
+
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv
+    usage = '%prog <suite|crawl|scan|html|filter|hooks|copy|paths|async> ' \
+            '[options]'
+    parser = optparse.OptionParser(usage=usage)
+    group = optparse.OptionGroup(parser, 'suite',
+                                 'also uses the crawl options')
+    group.add_option('--pagesize', type='int', default=4096,
+                     help='median page size in bytes')
+    group.add_option('--sizespread', type='float', default=1.0,
+                     help='sigma of the log-normal page sizes (0 = fixed)')
+    group.add_option('--redirects', type='int', default=10,
+                     help='link every Nth page through a redirect (0 = off)')
+    group.add_option('--attachments', type='int', default=10,
+                     help='serve every Nth page as an attachment (0 = off)')
+    group.add_option('--churn', type='float', default=0.1,
+                     help='fraction of the pages that change between crawls')
+    group.add_option('--blobsize', type='int', default=64,
+                     help='size of the large file in MB')
+    group.add_option('--json', metavar='FILE',
+                     help='append the results to this file as JSON')
+    group.add_option('--label',
+                     help='label for the results in the JSON file')
+    parser.add_option_group(group)
+    group = optparse.OptionGroup(parser, 'crawl')
+    group.add_option('--pages', type='int', default=2000,
+                     help='number of pages in the synthetic site')
+    group.add_option('--fanout', type='int', default=8,
+                     help='links to child pages in each page')
+    group.add_option('--hosts', type='int', default=16,
+                     help='number of loopback hosts to spread pages across')
+    group.add_option('--latency', type='float', default=0.02,
+                     help='server latency per request in seconds')
+    group.add_option('--workers', default='1,8,64',
+                     help='comma separated list of worker counts')
+    group.add_option('--metrics', action='store_true', default=False,
+                     help='also crawl collecting metrics, to compare')
+    group.add_option('--maxperhost', type='int', default=4,
+                     help='maximum concurrent downloads per host')
+    group.add_option('--poolsize', type='int', default=4,
+                     help='idle keep-alive connections per host (0 = off)')
+    parser.add_option_group(group)
+    group = optparse.OptionGroup(parser, 'copy')
+    group.add_option('--copysize', type='int', default=256,
+                     help='size of the file in megabytes')
+    group.add_option('--repeat', type='int', default=3,
+                     help='downloads per setting, the best one is shown')
+    parser.add_option_group(group)
+    group = optparse.OptionGroup(parser, 'scan, html')
+    group.add_option('--size', type='int', default=None,
+                     help='size of the file in megabytes '
+                          '(default 2048 for scan, 32 for html)')
+    group.add_option('--chunk', type='int', default=1024,
+                     help='chunk size in kilobytes')
+    parser.add_option_group(group)
+    group = optparse.OptionGroup(parser, 'filter')
+    group.add_option('--rules', type='int', default=10000,
+                     help='number of rules in each filter')
+    group.add_option('--urls', type='int', default=100000,
+                     help='number of URLs to filter')
+    parser.add_option_group(group)
+    group = optparse.OptionGroup(parser, 'hooks')
+    group.add_option('--hooks', default='0,5,20',
+                     help='comma separated list of hook chain lengths')
+    group.add_option('--calls', type='int', default=200000,
+                     help='number of requests to run through each chain')
+    parser.add_option_group(group)
+    group = optparse.OptionGroup(parser, 'paths')
+    group.add_option('--files', type='int', default=100000,
+                     help='number of files in the mirror')
+    group.add_option('--perdir', type='int', default=50,
+                     help='number of files in each directory')
+    parser.add_option_group(group)
+    group = optparse.OptionGroup(parser, 'resources')
+    group.add_option('--resources', type='int', default=100000,
+                     help='number of resources')
+    parser.add_option_group(group)
+    group = optparse.OptionGroup(parser, 'history')
+    group.add_option('--lookups', type='int', default=100000,
+                     help='number of URLs to look up')
+    group.add_option('--batch', type='int', default=500,
+                     help='number of URLs to look up at once')
+    parser.add_option_group(group)
+    group = optparse.OptionGroup(parser, 'async')
+    group.add_option('--requests', type='int', default=2000,
+                     help='number of requests')
+    group.add_option('--delay', type='float', default=0.5,
+                     help='server delay per request in seconds')
+    group.add_option('--threads', default='16,256',
+                     help='comma separated list of thread counts '
+                          'for the threaded downloader')
+    group.add_option('--inflight', default='256,1000',
+                     help='comma separated list of limits of requests '
+                          'in flight for the async downloader')
+    parser.add_option_group(group)
+    options, args = parser.parse_args(argv[1:])
+    if args == ['suite']:
+        workers = int(options.workers.split(',')[-1])
+        bench_suite(options.pages, options.fanout, options.hosts,
+                    options.latency, options.pagesize, options.sizespread,
+                    options.redirects, options.attachments, options.churn,
+                    workers, options.maxperhost, options.blobsize * 2**20,
+                    options.json, options.label)
+    elif args == ['crawl']:
+        workers = [int(x) for x in options.workers.split(',')]
+        bench_crawl(workers, options.pages, options.fanout, options.hosts,
+                    options.latency, options.maxperhost, options.poolsize,
+                    options.metrics)
+    elif args == ['scan']:
+        bench_scan((options.size or 2048) * 2**20, options.chunk * 1024)
+    elif args == ['html']:
+        bench_html((options.size or 32) * 2**20, options.chunk * 1024)
+    elif args == ['filter']:
+        bench_filter(options.rules, options.urls)
+    elif args == ['copy']:
+        bench_copy(options.copysize * 2**20, options.repeat)
+    elif args == ['hooks']:
+        counts = [int(x) for x in options.hooks.split(',')]
+        bench_hooks(counts, options.calls)
+    elif args == ['paths']:
+        bench_paths(options.files, options.perdir, options.hosts)
+    elif args == ['resources']:
+        bench_resources(options.resources)
+    elif args == ['history']:
+        bench_history(options.lookups, options.batch)
+    elif args == ['async']:
+        threads = [int(x) for x in options.threads.split(',')]
+        inflight = [int(x) for x in options.inflight.split(',')]
+        bench_async(options.requests, options.delay, options.hosts,
+                    threads, inflight)
+    else:
+        parser.error('unknown benchmark: %s' % ' '.join(args))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,1007 @@
+#!/usr/bin/env python
+#-----------------------------------------------------------------------------#
+# Copyright (c) 2011, Mario Vilas
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#     * Redistributions of source code must retain the above copyright notice,
+#       this list of conditions and the following disclaimer.
+#     * Redistributions in binary form must reproduce the above copyright
+#       notice,this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution.
+#     * Neither the name of the copyright holder nor the names of its
+#       contributors may be used to endorse or promote products derived from
+#       this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+#-----------------------------------------------------------------------------#
+
+"""Tests for pycrawl, run against the local HTTP server of pycrawl_bench.
+
+Run with: python pycrawl_test.py
+
+Distributed under BSD licence.
+"""
+
+from __future__ import with_statement
+
+import os
+import re
+import sys
+import time
+import zlib
+import random
+import rfc822
+import signal
+import shutil
+import socket
+import sqlite3
+import urllib2
+import hashlib
+import tempfile
+import unittest
+import cookielib
+import threading
+import multiprocessing
+
+from StringIO import StringIO
+
+import pycrawl
+import pycrawl_bench
+
+from pycrawl import FileUtils
+
+#-----------------------------------------------------------------------------#
+
+class SiteTestCase(unittest.TestCase):
+    "Runs a local site and a temporary directory for each test."
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp(prefix='pycrawl_test_')
+        self.site = pycrawl_bench.Site(pages=10, hosts=2, compression=False)
+        self.site.__enter__()
+
+    def tearDown(self):
+        self.site.__exit__(None, None, None)
+        shutil.rmtree(self.tempdir, ignore_errors=True)
+
+    def get_blob_url(self, size, host=1):
+        return 'http://127.0.0.%d:%d/blob/%d' % (host, self.site.port, size)
+
+    def get_options(self, **kwargs):
+        options = pycrawl.Downloader._OptionsSiteMirrorMode()
+        options.targetdir = os.path.join(self.tempdir, 'mirror')
+        options.usefstimes = False
+        for name, value in kwargs.iteritems():
+            setattr(options, name, value)
+        return options
+
+    def download(self, url, **kwargs):
+        downloader = pycrawl.Downloader(self.get_options(**kwargs))
+        try:
+            return downloader.download(url)
+        finally:
+            downloader.close()
+
+    @staticmethod
+    def read(filename):
+        with open(filename, 'rb') as fd:
+            return fd.read()
+
+#-----------------------------------------------------------------------------#
+
+class FilterTest(unittest.TestCase):
+    "Domain and regular expression filters."
+
+    def test_subdomains(self):
+        hook = pycrawl.DomainFilterHook(allow=['Example.com.'],
+                                        deny=['private.example.com'])
+        self.assertTrue(hook.is_allowed('http://example.com/'))
+        self.assertTrue(hook.is_allowed('http://www.EXAMPLE.com./a'))
+        self.assertFalse(hook.is_allowed('http://badexample.com/'))
+        self.assertFalse(hook.is_allowed('http://example.org/'))
+        self.assertFalse(hook.is_allowed('http://private.example.com/'))
+        self.assertFalse(hook.is_allowed('http://a.private.example.com/'))
+
+    def test_deny_before_allow(self):
+        hook = pycrawl.RegexpFilterHook(allow=['example'], deny=[r'\.zip$'])
+        self.assertTrue(hook.is_allowed('http://example.com/a.html'))
+        self.assertFalse(hook.is_allowed('http://example.com/a.zip'))
+        self.assertFalse(hook.is_allowed('http://other.com/a.html'))
+        hook = pycrawl.RegexpFilterHook(deny=[r'\.zip$'])
+        self.assertTrue(hook.is_allowed('http://other.com/a.html'))
+
+    def test_inline_flags_stay_local(self):
+        hook = pycrawl.RegexpFilterHook(allow=['(?i)FOO', 'bar'])
+        self.assertTrue(hook.is_allowed('http://x/foo'))
+        self.assertTrue(hook.is_allowed('http://x/bar'))
+        self.assertFalse(hook.is_allowed('http://x/BAR'))
+        hook = pycrawl.RegexpFilterHook(deny=['bar', '(?x) f o o'])
+        self.assertFalse(hook.is_allowed('http://x/foo'))
+        self.assertTrue(hook.is_allowed('http://x/b a r'))
+        self.assertFalse(hook.is_allowed('http://x/bar'))
+        self.assertTrue(hook.is_allowed('http://x/f o o'))
+
+    def test_group_limit(self):
+        patterns = ['/(a)(b)(%d)$' % x for x in xrange(100)]
+        hook = pycrawl.RegexpFilterHook(allow=patterns)
+        for x in xrange(100):
+            self.assertTrue(hook.is_allowed('http://x/ab%d' % x))
+        self.assertFalse(hook.is_allowed('http://x/ab100'))
+        self.assertEqual(len(hook._allow_re), 4)
+        self.assertRaises(re.error, pycrawl.RegexpFilterHook,
+                          deny=['(a)' * 100])
+        self.assertRaises(re.error, hook.deny, '(a)' * 100)
+
+    def test_duplicate_group_names(self):
+        hook = pycrawl.RegexpFilterHook(deny=['/(?P<x>a)$', '/(?P<x>b)$'])
+        self.assertFalse(hook.is_allowed('http://x/a'))
+        self.assertFalse(hook.is_allowed('http://x/b'))
+        self.assertTrue(hook.is_allowed('http://x/c'))
+
+#-----------------------------------------------------------------------------#
+
+class UrlTest(unittest.TestCase):
+    "Canonical form of URLs."
+
+    def normalize(self, url, sort_query=False):
+        return pycrawl.HttpUtils.normalize_url(url, sort_query)
+
+    def test_canonical_form(self):
+        self.assertEqual(self.normalize('http://Host:80/a/../b#x'),
+                         'http://host/b')
+        self.assertEqual(self.normalize('HTTPS://h:443/./a/./b/..'),
+                         'https://h/a/')
+        self.assertEqual(self.normalize('http://u:p@H:8080'),
+                         'http://u:p@h:8080/')
+        self.assertEqual(self.normalize('http://h/%7e%2f'), 'http://h/~%2F')
+        self.assertEqual(self.normalize('mailto:X@Y#z'), 'mailto:X@Y')
+
+    def test_sort_query(self):
+        url = 'http://h/?b=2&a=1&a=0'
+        self.assertEqual(self.normalize(url), url)
+        self.assertEqual(self.normalize(url, True), 'http://h/?a=0&a=1&b=2')
+
+    def test_ipv6_ports(self):
+        self.assertEqual(self.normalize('http://[::1]:80/'), 'http://[::1]/')
+        self.assertEqual(self.normalize('http://[::1]/'), 'http://[::1]/')
+        self.assertEqual(self.normalize('http://[::1]:8080/a'),
+                         'http://[::1]:8080/a')
+        self.assertEqual(self.normalize('http://[FE80::1]'),
+                         'http://[fe80::1]/')
+
+    def test_stray_escapes(self):
+        self.assertEqual(self.normalize('http://h/a%zz%'),
+                         'http://h/a%25zz%25')
+        self.assertEqual(self.normalize('http://h/?q=%'), 'http://h/?q=%25')
+
+    def test_unicode(self):
+        url = self.normalize(u'http://h/caf\xe9?q=\xe9')
+        self.assertEqual(url, 'http://h/caf%C3%A9?q=%C3%A9')
+        self.assertTrue(isinstance(url, str))
+
+#-----------------------------------------------------------------------------#
+
+class SeenSetTest(unittest.TestCase):
+    "Set of URL fingerprints."
+
+    def test_resize(self):
+        seen = pycrawl.SeenSet()
+        size = len(seen._table)
+        urls = ['http://example.com/%d' % x for x in xrange(size * 4)]
+        for url in urls:
+            self.assertTrue(seen.add(url))
+        self.assertTrue(len(seen._table) > size)
+        self.assertEqual(len(seen), len(urls))
+        for url in urls:
+            self.assertTrue(url in seen)
+            self.assertFalse(seen.add(url))
+        self.assertEqual(len(seen), len(urls))
+        self.assertFalse('http://example.com/x' in seen)
+
+    def test_expected_size(self):
+        seen = pycrawl.SeenSet(100000)
+        size = len(seen._table)
+        self.assertTrue(size * seen._max_load >= 100000)
+        for x in xrange(100000):
+            seen.add('http://example.com/%d' % x)
+        self.assertEqual(len(seen._table), size)
+
+    def test_unicode(self):
+        seen = pycrawl.SeenSet()
+        seen.add(u'http://h/caf\xe9')
+        self.assertTrue('http://h/caf\xc3\xa9' in seen)
+
+#-----------------------------------------------------------------------------#
+
+class DedupTest(SiteTestCase):
+    "Content-addressed storage in dedup mode."
+
+    def test_copies_share_the_object(self):
+        first  = self.download(self.get_blob_url(5000, 1), dedup=True)
+        second = self.download(self.get_blob_url(5000, 2), dedup=True)
+        self.assertEqual(first.digest, second.digest)
+        objname = pycrawl.Downloader(self.get_options()).get_object_filename(
+                                                                first.digest)
+        self.assertTrue(os.path.samefile(first.datafile, objname))
+        self.assertTrue(os.path.samefile(second.datafile, objname))
+        self.assertEqual(os.stat(objname).st_nlink, 3)
+
+    def test_overwrite_after_dedup(self):
+        old = self.download(self.get_blob_url(5000, 1), dedup=True)
+        self.download(self.get_blob_url(5000, 2), dedup=True)
+        objname = pycrawl.Downloader(self.get_options()).get_object_filename(
+                                                                old.digest)
+        olddata = self.read(objname)
+
+        # The same URL changes and is downloaded again without dedup
+        newdata = 'changed!' * 625
+        self.site.set_blob(5000, newdata)
+        new = self.download(self.get_blob_url(5000, 1))
+        self.assertEqual(new.datafile, old.datafile)
+        self.assertTrue(self.read(new.datafile) == newdata)
+        self.assertEqual(os.stat(new.datafile).st_nlink, 1)
+
+        # The object and the other copy must be untouched
+        self.assertEqual(hashlib.sha1(olddata).hexdigest(), old.digest)
+        self.assertTrue(self.read(objname) == olddata)
+        other = os.path.join(self.tempdir, 'mirror', '127.0.0.2', 'blob',
+                             '5000')
+        self.assertTrue(self.read(other) == olddata)
+        self.assertEqual(os.stat(objname).st_nlink, 2)
+
+#-----------------------------------------------------------------------------#
+
+class KeepAliveTest(SiteTestCase):
+    "Persistent connections."
+
+    def test_error_body(self):
+        url = 'http://127.0.0.1:%d/page/1000' % self.site.port
+        downloader = pycrawl.Downloader(self.get_options())
+        try:
+            try:
+                downloader.download(url)
+            except urllib2.HTTPError, e:
+                self.assertEqual(e.code, 404)
+                self.assertTrue('Error code 404' in e.read())
+            else:
+                self.fail("no error raised")
+        finally:
+            downloader.close()
+
+    def test_post_uses_new_connection(self):
+        downloader = pycrawl.Downloader(self.get_options())
+        try:
+            downloader.download(self.site.get_url(0))
+            key = ('http', '127.0.0.1:%d' % self.site.port)
+            idle = downloader._pool._idle[key]
+            self.assertEqual(len(idle), 1)
+            conn = idle[0][1]
+            req = urllib2.Request(self.site.get_url(2), data='x=1')
+            self.assertRaises(urllib2.HTTPError,
+                              downloader._urlopener.open, req)
+            self.assertEqual([x[1] for x in idle], [conn])
+        finally:
+            downloader.close()
+
+#-----------------------------------------------------------------------------#
+
+class AsyncTest(SiteTestCase):
+    "Downloads with the event loop."
+
+    def get_options(self, **kwargs):
+        options = pycrawl.AsyncDownloader._OptionsSiteMirrorMode()
+        options.targetdir = os.path.join(self.tempdir, 'mirror')
+        options.usefstimes = False
+        for name, value in kwargs.iteritems():
+            setattr(options, name, value)
+        return options
+
+    # Get a local port nobody is listening on
+    @staticmethod
+    def get_closed_port():
+        sock = socket.socket()
+        try:
+            sock.bind(('127.0.0.1', 0))
+            return sock.getsockname()[1]
+        finally:
+            sock.close()
+
+    def test_next_address_after_failure(self):
+        dwn = pycrawl.AsyncDownloader(self.get_options())
+        try:
+            hostkey = ('127.0.0.1', self.site.port)
+            bad  = (socket.AF_INET, ('127.0.0.1', self.get_closed_port()))
+            good = (socket.AF_INET, hostkey)
+            dwn._dns[hostkey] = (time.time() + 3600, [bad, good])
+            resource = dwn.download(self.site.get_url(0))
+            self.assertTrue(os.path.exists(resource.datafile))
+            expires, addresses = dwn._dns[hostkey]
+            self.assertEqual(addresses, [good, bad])
+        finally:
+            dwn.close()
+
+    def test_failed_host_is_resolved_again(self):
+        dwn = pycrawl.AsyncDownloader(self.get_options())
+        try:
+            hostkey = ('127.0.0.1', self.site.port)
+            bad = (socket.AF_INET, ('127.0.0.1', self.get_closed_port()))
+            dwn._dns[hostkey] = (time.time() + 3600, [bad])
+            self.assertRaises(urllib2.URLError, dwn.download,
+                              self.site.get_url(0))
+            self.assertFalse(hostkey in dwn._dns)
+            dwn.download(self.site.get_url(2))
+            expires, addresses = dwn._dns[hostkey]
+            self.assertEqual(addresses[0], (socket.AF_INET, hostkey))
+        finally:
+            dwn.close()
+
+#-----------------------------------------------------------------------------#
+
+class DecoderTest(unittest.TestCase):
+    "Decoding of compressed responses."
+
+    data = '\0' * (16 * 1024 * 1024)
+
+    # Feed the compressed data and decode it in small pieces
+    def decode(self, encoding, encoded):
+        decoder = pycrawl.Downloader._ContentDecoder(encoding)
+        decoder.feed(encoded)
+        decoded = []
+        while decoder.pending or decoder.held:
+            data = decoder.decode(4096)
+            self.assertTrue(len(data) <= 4096)
+            decoded.append(data)
+        decoded.append(decoder.flush())
+        self.assertTrue(''.join(decoded) == self.data)
+
+    def test_gzip_output_is_capped(self):
+        compressor = zlib.compressobj(9, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        self.decode('gzip', compressor.compress(self.data) +
+                            compressor.flush())
+
+    def test_deflate_output_is_capped(self):
+        self.decode('deflate', zlib.compress(self.data, 9))
+
+    @unittest.skipIf(pycrawl.brotli is None, "brotli can't cap its output")
+    def test_brotli_output_is_capped(self):
+        self.decode('br', pycrawl.brotli.compress(self.data))
+
+#-----------------------------------------------------------------------------#
+
+class DirCacheTest(SiteTestCase):
+    "Cache of the directories created for the downloaded files."
+
+    def test_removed_dir_is_created_again(self):
+        path = os.path.join(self.tempdir, 'mirror', '127.0.0.1', 'blob')
+        rename = pycrawl.Downloader.ON_DUPLICATE_RENAME
+        for options in ({}, {'dedup': True}, {'partialsize': 1000},
+                        {'onduplicate': rename}):
+            downloader = pycrawl.Downloader(self.get_options(**options))
+            try:
+                downloader.download(self.get_blob_url(5000))
+                shutil.rmtree(path)
+                res = downloader.download(self.get_blob_url(6000))
+                self.assertEqual(os.path.getsize(res.datafile), 6000)
+            finally:
+                downloader.close()
+            shutil.rmtree(os.path.join(self.tempdir, 'mirror'))
+
+    def test_cache_is_bounded(self):
+        downloader = pycrawl.Downloader(self.get_options(namecache=2))
+        try:
+            for index in xrange(3):
+                downloader.download(self.site.get_url(index))
+                downloader.download(self.get_blob_url(100, index % 2 + 1))
+            self.assertEqual(len(downloader._created_dirs), 2)
+        finally:
+            downloader.close()
+
+#-----------------------------------------------------------------------------#
+
+class RangeTest(SiteTestCase):
+    "Resumed and segmented downloads of large files."
+
+    size = 300000
+
+    def get_digest(self, size):
+        return hashlib.sha1(self.site.get_blob(size)).hexdigest()
+
+    def get_part_files(self):
+        path = os.path.join(self.tempdir, 'mirror', '127.0.0.1', 'blob')
+        return sorted(x for x in os.listdir(path) if '.part' in x)
+
+    # Start a download and drop the connection after the given bytes
+    def download_dropped(self, url, dropped):
+        self.site.drop_after = dropped
+        self.assertRaises(IOError, self.download, url, partialsize=1000)
+        self.assertEqual(self.site.ranges, [(0, self.size - 1)])
+        self.assertEqual(self.get_part_files(),
+                         ['%d.part' % self.size, '%d.part.info' % self.size])
+
+    def test_resume_after_drop(self):
+        url = self.get_blob_url(self.size)
+        self.download_dropped(url, 100000)
+        res = self.download(url, partialsize=1000)
+        self.assertEqual(self.site.ranges,
+                         [(0, self.size - 1), (100000, self.size - 1)])
+        self.assertEqual(res.digest, self.get_digest(self.size))
+        self.assertEqual(FileUtils.hash_file(res.datafile), res.digest)
+        self.assertEqual(self.get_part_files(), [])
+
+    def test_restart_if_changed(self):
+        url = self.get_blob_url(self.size)
+        self.download_dropped(url, 100000)
+        self.site.set_blob(self.size, 'changed!' * (self.size // 8))
+
+        # If-Range doesn't match, so the server sends the whole file again
+        res = self.download(url, partialsize=1000)
+        self.assertEqual(self.site.ranges,
+                         [(0, self.size - 1), (0, self.size - 1)])
+        self.assertEqual(res.digest, self.get_digest(self.size))
+        self.assertEqual(FileUtils.hash_file(res.datafile), res.digest)
+
+    def test_segmented(self):
+        res = self.download(self.get_blob_url(200000), partialsize=1000,
+                            segments=4, segmentsize=50000)
+        self.assertEqual(sorted(self.site.ranges), [(0, 199999),
+                         (50000, 99999), (100000, 149999), (150000, 199999)])
+        self.assertEqual(res.digest, self.get_digest(200000))
+        self.assertEqual(FileUtils.hash_file(res.datafile), res.digest)
+
+#-----------------------------------------------------------------------------#
+
+class HistoryTest(unittest.TestCase):
+    "History files."
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp(prefix='pycrawl_test_')
+        self.filename = os.path.join(self.tempdir, 'history.db')
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir, ignore_errors=True)
+
+    def test_digest_round_trip(self):
+        url = 'http://example.com/a'
+        digest = hashlib.sha1('a').hexdigest()
+        with pycrawl.History(self.filename) as history:
+            history.add(pycrawl.Resource(1700000000, url, url, '/mirror/a',
+                                         None, '', 1, 1, None, digest))
+        with pycrawl.History(self.filename) as history:
+            self.assertEqual([x.digest for x in history.get(url)], [digest])
+            self.assertEqual([x.digest for x in
+                              history.get_many([url])[url]], [digest])
+            self.assertEqual(history.get_latest(url).digest, digest)
+            self.assertEqual(history.get_validators(url).digest, digest)
+
+    def test_digest_column_added(self):
+        db = sqlite3.connect(self.filename)
+        db.execute("CREATE TABLE resources (id INTEGER PRIMARY KEY, "
+                   "location TEXT NOT NULL, timestamp REAL, url TEXT, "
+                   "datafile TEXT, referer TEXT, headers TEXT)")
+        db.execute("INSERT INTO resources (location, timestamp, url) "
+                   "VALUES (?, 1, ?)", ('http://example.com/a',) * 2)
+        db.commit()
+        db.close()
+        with pycrawl.History(self.filename) as history:
+            old = history.get_latest('http://example.com/a')
+            self.assertEqual(old.digest, None)
+
+#-----------------------------------------------------------------------------#
+
+class HistoryHookTest(unittest.TestCase):
+    "Batched writes of the history hook."
+
+    batchsize = 50
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp(prefix='pycrawl_test_')
+        self.filename = os.path.join(self.tempdir, 'history.db')
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir, ignore_errors=True)
+
+    @staticmethod
+    def make_resource(index):
+        url = 'http://example.com/page/%d' % index
+        return pycrawl.Resource(1700000000, url, url,
+                                '/mirror/page/%d' % index, None,
+                                'ETag: "%d"\r\n' % index)
+
+    # Run a writer in a child process, calling stall() from add_many after
+    # the given number of batches, then kill it. Returns the rows found.
+    def run_writer(self, stall_after=None, kill_after=None):
+        rfd, wfd = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            try:
+                os.close(rfd)
+                batches = [0]
+                class StallingHistory(pycrawl.History):
+                    def add_many(self, resources):
+                        pycrawl.History.add_many(self, resources)
+                        if batches[0] == stall_after:
+                            os.write(wfd, 'x')
+                            time.sleep(3600)    # killed mid transaction
+                        batches[0] = batches[0] + 1
+                history = StallingHistory(self.filename)
+                history.open()
+                hook = pycrawl.HistoryHook(history, self.batchsize, 3600.0)
+                if stall_after is None:
+                    os.write(wfd, 'x')
+                index = 0
+                while True:
+                    hook.filter_resource(None, self.make_resource(index))
+                    index = index + 1
+            finally:
+                os._exit(1)
+        os.close(wfd)
+        try:
+            os.read(rfd, 1)
+            if kill_after:
+                time.sleep(kill_after)
+        finally:
+            os.kill(pid, signal.SIGKILL)
+            os.waitpid(pid, 0)
+            os.close(rfd)
+        db = sqlite3.connect(self.filename)
+        try:
+            self.assertEqual(db.execute("PRAGMA integrity_check").fetchone(),
+                             (u'ok',))
+            resources = db.execute(
+                "SELECT COUNT(*) FROM resources").fetchone()[0]
+            validators = db.execute(
+                "SELECT COUNT(*) FROM validators").fetchone()[0]
+        finally:
+            db.close()
+        self.assertEqual(resources, validators)
+        return resources
+
+    def test_redirect_drops_validators(self):
+        options = pycrawl.Downloader._OptionsSiteMirrorMode()
+        options.targetdir = os.path.join(self.tempdir, 'mirror')
+        dwn = pycrawl.Downloader(options)
+        old_url = 'http://example.com/old'
+        new_url = 'http://example.com/new'
+        datafile = os.path.join(*dwn.calc_local_name(old_url))
+        FileUtils.makedirs(os.path.dirname(datafile))
+        open(datafile, 'wb').close()
+        history = pycrawl.History(self.filename)
+        history.open()
+        try:
+            hook = pycrawl.HistoryHook(history)
+            hook.filter_resource(dwn, pycrawl.Resource(1700000000, old_url,
+                old_url, datafile, None,
+                'ETag: "1"\r\nLast-Modified: %s\r\n' %
+                    rfc822.formatdate(1700000000)))
+            hook.close()
+            req = urllib2.Request(old_url)
+            hook.filter_request(dwn, req, old_url)
+            self.assertEqual(req.get_header('If-none-match'), '"1"')
+            self.assertTrue(req.validators is not None)
+            hook.filter_redirect(dwn, req, new_url)
+            self.assertFalse(req.has_header('If-none-match'))
+            self.assertFalse(req.has_header('If-modified-since'))
+            self.assertTrue(req.validators is None)
+        finally:
+            history.close()
+
+    def test_kill_mid_batch(self):
+        rows = self.run_writer(stall_after=3)
+        self.assertEqual(rows, 3 * self.batchsize)
+
+    def test_kill_at_random(self):
+        for run in xrange(5):
+            self.filename = os.path.join(self.tempdir, 'history%d.db' % run)
+            rows = self.run_writer(kill_after=random.uniform(0.05, 0.3))
+            self.assertEqual(rows % self.batchsize, 0)
+
+    def test_flush_does_not_block_requests(self):
+        started = threading.Event()
+        release = threading.Event()
+        class SlowHistory(pycrawl.History):
+            def add_many(self, resources):
+                started.set()
+                release.wait(10)
+                pycrawl.History.add_many(self, resources)
+        with SlowHistory(self.filename) as history:
+            hook = pycrawl.HistoryHook(history, 1000, 3600.0)
+            hook.filter_resource(None, self.make_resource(0))
+            flusher = threading.Thread(target=hook.flush)
+            flusher.start()
+            try:
+                self.assertTrue(started.wait(10))
+                start = time.time()
+                hook.filter_resource(None, self.make_resource(1))
+                self.assertTrue(time.time() - start < 1.0)
+            finally:
+                release.set()
+                flusher.join()
+            hook.close()
+            self.assertTrue(history.contains('http://example.com/page/0'))
+            self.assertTrue(history.contains('http://example.com/page/1'))
+
+#-----------------------------------------------------------------------------#
+
+class CookiesTest(unittest.TestCase):
+    "Cookies file shared by several processes."
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp(prefix='pycrawl_test_')
+        self.filename = os.path.join(self.tempdir, 'cookies.txt')
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir, ignore_errors=True)
+
+    def make_jar(self):
+        options = pycrawl.Cookies._DefaultOptions()
+        options.cookie_file = self.filename
+        return pycrawl.Cookies(options)
+
+    @staticmethod
+    def make_cookie(name):
+        return cookielib.Cookie(0, name, '1', None, False, 'example.com',
+                                False, False, '/', True, False,
+                                int(time.time()) + 3600, False, None, None,
+                                {})
+
+    @staticmethod
+    def get_names(jar):
+        return sorted(cookie.name for cookie in jar)
+
+    def test_merge_only_new_cookies(self):
+        first = self.make_jar()
+        first.set_cookie(self.make_cookie('a'))
+        first.set_cookie(self.make_cookie('b'))
+        first.save()
+
+        # Both processes load the file, one removes a cookie and the
+        # other adds one, and they save in turn
+        with self.make_jar() as one:
+            with self.make_jar() as other:
+                one.clear('example.com', '/', 'a')
+                other.set_cookie(self.make_cookie('c'))
+        self.assertEqual(self.get_names(one), ['b', 'c'])
+        with self.make_jar() as last:
+            self.assertEqual(self.get_names(last), ['b', 'c'])
+
+    def test_removed_after_save(self):
+        jar = self.make_jar()
+        jar.set_cookie(self.make_cookie('a'))
+        jar.save()
+        jar.clear()
+        jar.save()
+        with self.make_jar() as last:
+            self.assertEqual(self.get_names(last), [])
+
+#-----------------------------------------------------------------------------#
+
+class PrefetchTest(SiteTestCase):
+    "History prefetched for the links found while crawling."
+
+    # Crawl the site, returning the number of single URL lookups
+    def crawl(self, delay=0.0):
+        lookups = []
+        class CountingHistory(pycrawl.History):
+            def get_validators(self, url):
+                lookups.append(url)
+                return pycrawl.History.get_validators(self, url)
+            def get_validators_many(self, urls):
+                time.sleep(delay)
+                return pycrawl.History.get_validators_many(self, urls)
+        options = pycrawl.Crawler._DefaultOptions()
+        options.targetdir = os.path.join(self.tempdir, 'mirror')
+        options.obeyrobots = False
+        filename = os.path.join(self.tempdir, 'history.db')
+        with CountingHistory(filename) as history:
+            with pycrawl.HistoryHook(history) as hook:
+                crawler = pycrawl.Crawler(options, hooks=[hook])
+                try:
+                    crawler.crawl(self.site.get_url(0))
+                finally:
+                    crawler.close()
+        return len(lookups)
+
+    def test_prefetch_before_queueing(self):
+        self.assertEqual(self.crawl(delay=0.2), 1)
+
+    def test_prefetch_expires(self):
+        self.crawl()
+        hook = pycrawl.HistoryHook
+        old_age, hook.max_prefetch_age = hook.max_prefetch_age, -1.0
+        try:
+            self.assertEqual(self.crawl(), 10)
+        finally:
+            hook.max_prefetch_age = old_age
+
+#-----------------------------------------------------------------------------#
+
+class ParseTest(unittest.TestCase):
+    "Links found in the downloaded files."
+
+    # Make up a text with URLs of all lengths, some quoted
+    @staticmethod
+    def make_text(rnd, size):
+        maxlen = pycrawl.Crawler._max_url_length
+        parts = []
+        length = 0
+        while length < size:
+            kind = rnd.random()
+            if kind < 0.5:
+                part = rnd.choice(['foo', 'bar.', ' ', '\n', '<a>', 'x"y'])
+            else:
+                path = 'p' * rnd.choice([1, 10, 100, 1000, 1, 10, 100,
+                                         maxlen - 20, maxlen + 50])
+                part = rnd.choice(['http://', 'HTTPS://', 'ftp://']) + \
+                       'h%d.example.com/%s' % (rnd.randint(0, 9), path)
+                if kind < 0.6:
+                    part = '"%s"' % part.replace('p', ' ', 1)
+                elif kind < 0.7:
+                    part = "'%s'." % part
+            parts.append(part)
+            length = length + len(part)
+        return ''.join(parts)
+
+    def test_scan_urls_chunk_boundaries(self):
+        pattern = pycrawl.Crawler._reURL
+        overlap = pycrawl.Crawler._max_match_length
+        rnd = random.Random(1234)
+        for run in xrange(20):
+            text = self.make_text(rnd, overlap * 10)
+            expected = [m.group(m.lastindex) for m in pattern.finditer(text)]
+            self.assertTrue(len(expected) > 5)
+            for chunk_size in (overlap, overlap + 1, rnd.randint(1, 30000)):
+                found = []
+                for urls in pycrawl.Crawler.scan_urls(StringIO(text),
+                                                      chunk_size):
+                    found.extend(urls)
+                self.assertEqual(found, expected)
+
+        # No word boundary where the carried over tail begins
+        text = ' ' * (overlap - 1) + 'xhttp://h.example.com/a' + ' ' * overlap
+        found = list(pycrawl.Crawler.scan_urls(StringIO(text), overlap))
+        self.assertEqual(found, [])
+
+    # Find the links in an HTML document, feeding it in small chunks
+    @staticmethod
+    def scan_html(html, base='http://h/dir/page.html'):
+        found = []
+        for urls in pycrawl.Crawler.scan_html(StringIO(html), base, 7):
+            found.extend(urls)
+        return found
+
+    def test_attributes(self):
+        html = ('<a href="a.html">a</a><IMG SRC="/i.png" lowsrc=" l.png ">'
+                '<object data="o.swf"></object><a href="">x</a>'
+                '<a href="mailto:x@h">x</a><td background="bg.png"/>'
+                '<div href="not/a/link"></div>')
+        self.assertEqual(self.scan_html(html), [
+            'http://h/dir/a.html', 'http://h/i.png', 'http://h/dir/l.png',
+            'http://h/dir/o.swf', 'http://h/dir/bg.png'])
+
+    def test_srcset(self):
+        html = ('<img srcset="a.png 1x, /b.png 2x,, c.png">'
+                '<picture><source srcset="d.webp 100w"></picture>')
+        self.assertEqual(self.scan_html(html), [
+            'http://h/dir/a.png', 'http://h/b.png', 'http://h/dir/c.png',
+            'http://h/dir/d.webp'])
+
+    def test_base(self):
+        html = ('<a href="a.html">a</a><base href="http://other/x/">'
+                '<a href="b.html">b</a><base href="http://third/">'
+                '<a href="c.html">c</a>')
+        self.assertEqual(self.scan_html(html), [
+            'http://h/dir/a.html', 'http://other/x/b.html',
+            'http://other/x/c.html'])
+
+    def test_meta_refresh(self):
+        html = ('<meta http-equiv="Refresh" content="5; URL=\'next.html\'">'
+                '<meta http-equiv="refresh" content="0;url=http://o/">'
+                '<meta http-equiv="refresh" content="10">'
+                '<meta name="refresh" content="0; url=no.html">')
+        self.assertEqual(self.scan_html(html), [
+            'http://h/dir/next.html', 'http://o/'])
+
+    def test_entities(self):
+        html = ('<a href="/a?x=1&amp;y=2">a</a><a href="/caf&eacute;">b</a>'
+                '<a href="/&#233;&#xE9;">c</a><a href="/?&bogus;">d</a>')
+        self.assertEqual(self.scan_html(html), [
+            'http://h/a?x=1&y=2', 'http://h/caf\xc3\xa9',
+            'http://h/\xc3\xa9\xc3\xa9', 'http://h/?&bogus;'])
+
+    def test_parse_error_fallback(self):
+        tempdir = tempfile.mkdtemp(prefix='pycrawl_test_')
+        try:
+            datafile = os.path.join(tempdir, 'page.html')
+            with open(datafile, 'wb') as fd:
+                fd.write('<a href="/a.html">a</a><![bogus[ x ]]>\n'
+                         'see http://h/text.html\n')
+            found = []
+            class CollectingCrawler(pycrawl.Crawler):
+                def add_targets(self, urls, referer=None):
+                    found.extend(urls)
+            options = pycrawl.Crawler._DefaultOptions()
+            options.targetdir = tempdir
+            crawler = CollectingCrawler(options)
+            try:
+                crawler.parse(pycrawl.Resource(1700000000, 'http://h/',
+                              'http://h/', datafile, None,
+                              'Content-Type: text/html\r\n'))
+            finally:
+                crawler.close()
+            self.assertTrue('http://h/text.html' in found)
+        finally:
+            shutil.rmtree(tempdir, ignore_errors=True)
+
+#-----------------------------------------------------------------------------#
+
+class FrontierTest(SiteTestCase):
+    "Crawl frontiers kept on disk."
+
+    def get_filename(self):
+        return os.path.join(self.tempdir, 'frontier.db')
+
+    # Run the command line tool with the home directory in our temp dir
+    def run_main(self, *args):
+        home = os.environ.get('HOME')
+        os.environ['HOME'] = self.tempdir
+        stdout, stderr = sys.stdout, sys.stderr
+        sys.stdout = sys.stderr = open(os.devnull, 'w')
+        try:
+            pycrawl.Main().run(['pycrawl', '--no-history', '--no-load-cookies',
+                                '--no-save-cookies', '--ignore-robots',
+                                '-d', os.path.join(self.tempdir, 'mirror')]
+                               + list(args))
+        finally:
+            sys.stdout.close()
+            sys.stdout, sys.stderr = stdout, stderr
+            if home is None:
+                del os.environ['HOME']
+            else:
+                os.environ['HOME'] = home
+
+    def test_in_memory_unless_asked(self):
+        default = os.path.join(self.tempdir,
+                               pycrawl.DiskFrontier.default_filename)
+        self.run_main('-r', self.site.get_url(0))
+        self.assertFalse(os.path.exists(default))
+        self.run_main('-r', '--frontier', self.get_filename(),
+                      self.site.get_url(0))
+        self.assertTrue(os.path.exists(self.get_filename()))
+        self.assertFalse(os.path.exists(default))
+
+    def test_resume_needs_the_file(self):
+        default = os.path.join(self.tempdir,
+                               pycrawl.DiskFrontier.default_filename)
+        self.assertRaises(SystemExit, self.run_main, '--resume')
+        self.assertRaises(SystemExit, self.run_main, '--resume',
+                          '--frontier', self.get_filename())
+        self.assertFalse(os.path.exists(default))
+        self.assertFalse(os.path.exists(self.get_filename()))
+        self.run_main('-r', '--frontier', default, self.site.get_url(0))
+        self.run_main('--resume')
+
+    def test_not_with_processes(self):
+        self.assertRaises(SystemExit, self.run_main, '--processes', '2',
+                          '--resume')
+        self.assertRaises(SystemExit, self.run_main, '--processes', '2',
+                          '-r', '--frontier', self.get_filename(),
+                          self.site.get_url(0))
+        self.assertFalse(os.path.exists(self.get_filename()))
+
+    def test_rows_missing(self):
+        frontier = pycrawl.DiskFrontier(self.get_filename())
+        try:
+            frontier.put('http://example.com/a')
+            frontier.put('http://example.com/b')
+            frontier._db.execute("DELETE FROM frontier")
+            self.assertEqual(frontier.get(1.0), None)
+            self.assertEqual(len(frontier), 0)
+        finally:
+            frontier.close()
+
+    def test_crawler_closes_the_file(self):
+        options = pycrawl.Crawler._DefaultOptions()
+        options.targetdir = os.path.join(self.tempdir, 'mirror')
+        options.frontierfile = self.get_filename()
+        options.obeyrobots = False
+        crawler = pycrawl.Crawler(options)
+        crawler.crawl(self.site.get_url(0))
+        self.assertTrue(crawler.frontier._db is not None)
+        crawler.close()
+        self.assertTrue(crawler.frontier._db is None)
+
+#-----------------------------------------------------------------------------#
+
+class RobotsTest(unittest.TestCase):
+    "Rules from robots.txt files."
+
+    text = ("User-agent: *\nDisallow: /private\n\n"
+            "User-agent: %s\nDisallow: /\n")
+
+    def test_whole_token_matches(self):
+        for agent in ('pycrawl', 'PyCrawl'):
+            rules = pycrawl.RobotsRules(self.text % agent, 'PyCrawl 0.1')
+            self.assertFalse(rules.allowed('http://example.com/page'))
+        for agent in ('c', 'craw', 'pycrawler'):
+            rules = pycrawl.RobotsRules(self.text % agent, 'PyCrawl 0.1')
+            self.assertTrue(rules.allowed('http://example.com/page'))
+            self.assertFalse(rules.allowed('http://example.com/private'))
+
+    def test_delay_after_first_request(self):
+        frontier = pycrawl.Frontier()
+        frontier.put('http://example.com/a')
+        frontier.put('http://example.com/b')
+        url, _ = frontier.get()
+
+        # The crawl delay is only known after robots.txt was read
+        frontier.set_delay('example.com', 0.5)
+        frontier.task_done(url)
+        start = time.time()
+        url, _ = frontier.get()
+        self.assertTrue(time.time() - start >= 0.4)
+        frontier.task_done(url)
+
+#-----------------------------------------------------------------------------#
+
+class ShardTest(unittest.TestCase):
+    "Multi-process crawls."
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp(prefix='pycrawl_test_')
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir, ignore_errors=True)
+
+    def test_shard_dies(self):
+        site = pycrawl_bench.Site(pages=1000, hosts=3, latency=0.02)
+        with site:
+            crawler = pycrawl.Main()
+            options = crawler._DefaultOptions()
+            options.targetdir = os.path.join(self.tempdir, 'mirror')
+            options.history_file = os.path.join(self.tempdir, 'history.db')
+            options.load_cookies = options.save_cookies = False
+            options.processes = 3
+            options.workers = 2
+            crawler.options = options
+            crawler.targets = [site.get_url(0)]
+            errors = []
+            def run():
+                try:
+                    crawler._Main__run()
+                except RuntimeError, e:
+                    errors.append(e)
+            thread = threading.Thread(target=run)
+            thread.daemon = True
+            stdout = sys.stdout
+            sys.stdout = open(os.devnull, 'w')
+            try:
+                thread.start()
+                time.sleep(1.0)
+                os.kill(multiprocessing.active_children()[0].pid,
+                        signal.SIGKILL)
+                thread.join(20.0)
+            finally:
+                sys.stdout.close()
+                sys.stdout = stdout
+            self.assertFalse(thread.is_alive())
+            self.assertEqual(multiprocessing.active_children(), [])
+        self.assertEqual(len(errors), 1)
+        self.assertTrue('exit code -9' in str(errors[0]))
+
+#-----------------------------------------------------------------------------#
+
+if __name__ == '__main__':
+    unittest.main()